@@ -1,136 +1,134 @@
-import sys
-import paho.mqtt.client as mqtt
-import time
-import os
-import queue
-import argparse
-
-import numpy as np
-
-import io
-from scipy.io import wavfile
-
-import pyaudio
-import wave
-
-##############
-# Parameters #
-##############
-
-parser = argparse.ArgumentParser()
-
-parser.add_argument("--sub_client_name", help="The name of the MQTT subscribing client", type=str, required=False, default="jetson-audio-receiver")
-parser.add_argument("--sub_mqtt_host", help="The MQTT host for the subscribing client", type=str, required=True)
-parser.add_argument("--sub_mqtt_port", help="The MQTT port for the subscribing client", type=int, required=False, default=1883)
-parser.add_argument("--sub_qos", help="The MQTT quality of service for the subscribing client", type=int, required=False, default=2)
-parser.add_argument("--sub_topic", help="The MQTT topic the subscribing client should subscribe to", type=str, required=False, default="jetson/audio")
-
-args = parser.parse_args()
-
-##############
-# Core Logic #
-##############
-
-# make a queue of wav files to play
-wav_bytes_queue = queue.Queue()
-wav_files_queue = queue.Queue()
-
-def on_log(client, userdata, level, buf):
-   print(buf)
-
-def on_connect(client, userdata, flags, rc):
-   if (rc == 0):
-      print("connected OK")
-   else:
-      print("Bad connection retruned code = ", rc)
-      client.loop_stop()
-
-def on_disconnect(client, userdata, rc):
-   print("client disconnected ok")
-
-def on_subscribe(client, userdata, mid, granted_qos):
-   print("subscribed")   
-
-def convert_wav_bytes_to_wav_file(wav_bytes, wav_num):
-   rate, data = wavfile.read(io.BytesIO(wav_bytes))
-   outfile = save_wav(data, rate, wav_num)
-   wav_files_queue.put(outfile, block=True)
-
-wav_num = 0
-def on_message(client, userdata, message):
-   print("message topic=", message.topic)
-   print("message qos=", message.qos)
-   print("message retain flag=", message.retain)
-   print("\n")
-
-   # queue up message to be played
-   #wav_bytes_queue.put(message.payload, block=True)
-   global wav_num
-   convert_wav_bytes_to_wav_file(message.payload, wav_num)
-   wav_num += 1
-
-   
-# Set up client & callbacks
-client = mqtt.Client(args.sub_client_name)
-client.on_log = on_log
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_message = on_message
-client.on_subscribe = on_subscribe
-client.connect(args.sub_mqtt_host, args.sub_mqtt_port)
-
-# start client & subscribe client to topic
-client.loop_start()
-client.subscribe(args.sub_topic, args.sub_qos)
-
-def save_wav(byte_data, rate, wav_num):
-   outfile = '{}{}.wav'.format("./tmp/", wav_num)
-   wavfile.write(outfile, rate, byte_data.astype(np.int16))
-   return outfile
-
-# https://stackoverflow.com/questions/17657103/how-to-play-wav-file-in-python/17657304#17657304
-def pyaudio_play_wav(wav_file_name):
-   f = wave.open(wav_file_name,"rb")
-   p = pyaudio.PyAudio()
-   stream = p.open(format = p.get_format_from_width(f.getsampwidth()),  
-                channels = f.getnchannels(),  
-                rate = f.getframerate(),  
-                output = True)
-
-   chunk = 1024  # define stream chunk   
-   data = f.readframes(chunk) # read data
-
-   # play stream  
-   while data:  
-       stream.write(data)  
-       data = f.readframes(chunk) 
-
-   # stop stream  
-   stream.stop_stream()  
-   stream.close()  
-
-   # close PyAudio  
-   p.terminate()   
-
-
-def process_wav_bytes():
-   # Wait for messages until disconnected by system interrupt
-   while True:
-      try:
-         if (wav_files_queue.qsize() > 0):
-            # case: queuing file paths to saved wav files
-            pyaudio_play_wav(wav_files_queue.get(block=True))
-      except KeyboardInterrupt:
-         exit(0)
-      '''
-      except Exception as e:
-         print(e)
-         continue
-      '''
-
-# Run the process wav bytes function
-process_wav_bytes()
-
-
-
-
+import sys
+import paho.mqtt.client as mqtt
+import time
+import os
+import queue
+import argparse
+
+import numpy as np
+
+import io
+from scipy.io import wavfile
+
+import pyaudio
+
+from audio_message import is_audio_message, decode_audio_message, track_sequence
+
+##############
+# Parameters #
+##############
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--sub_client_name", help="The name of the MQTT subscribing client", type=str, required=False, default="jetson-audio-receiver")
+parser.add_argument("--sub_mqtt_host", help="The MQTT host for the subscribing client", type=str, required=True)
+parser.add_argument("--sub_mqtt_port", help="The MQTT port for the subscribing client", type=int, required=False, default=1883)
+parser.add_argument("--sub_qos", help="The MQTT quality of service for the subscribing client", type=int, required=False, default=2)
+parser.add_argument("--sub_topic", help="The MQTT topic the subscribing client should subscribe to", type=str, required=False, default="jetson/audio")
+
+args = parser.parse_args()
+
+##############
+# Core Logic #
+##############
+
+# make a queue of (sample rate, int16 PCM bytes) clips to play
+pcm_queue = queue.Queue()
+
+# sequence number of the last audio message received from each stream, to detect lost chunks
+last_sequences = {}
+
+def on_log(client, userdata, level, buf):
+   print(buf)
+
+def on_connect(client, userdata, flags, rc):
+   if (rc == 0):
+      print("connected OK")
+   else:
+      print("Bad connection retruned code = ", rc)
+      client.loop_stop()
+
+def on_disconnect(client, userdata, rc):
+   print("client disconnected ok")
+
+def on_subscribe(client, userdata, mid, granted_qos):
+   print("subscribed")   
+
+def convert_wav_bytes_to_pcm(wav_bytes):
+   # Legacy payloads are whole (float) wav files
+   rate, data = wavfile.read(io.BytesIO(wav_bytes))
+   return rate, data.astype(np.int16).tobytes()
+
+def check_sequence(audio):
+   lost = track_sequence(last_sequences, audio)
+   if (lost > 0):
+      print("stream [{}]: {} audio chunks lost (#{} to #{})".format(
+         audio.stream_id, lost, audio.sequence - lost, audio.sequence - 1))
+   elif (lost < 0):
+      print("stream [{}]: sequence restarted at #{} (synthesizer restarted?)".format(audio.stream_id, audio.sequence))
+
+def on_message(client, userdata, message):
+   print("message topic=", message.topic)
+   print("message qos=", message.qos)
+   print("message retain flag=", message.retain)
+
+   # queue up message to be played, PCM16 audio messages are played as is
+   if (is_audio_message(message.payload)):
+      audio = decode_audio_message(message.payload)
+      print("stream [{}] #{}: {:.2f} s of audio, {:.0f} ms after synthesis started".format(
+         audio.stream_id, audio.sequence, len(audio.samples) / audio.sample_rate,
+         (time.time() - audio.start_time) * 1000))
+      check_sequence(audio)
+      pcm_queue.put((audio.sample_rate, audio.samples.tobytes()))
+   else:
+      pcm_queue.put(convert_wav_bytes_to_pcm(message.payload))
+   print("\n")
+
+   
+# Set up client & callbacks
+client = mqtt.Client(args.sub_client_name)
+client.on_log = on_log
+client.on_connect = on_connect
+client.on_disconnect = on_disconnect
+client.on_message = on_message
+client.on_subscribe = on_subscribe
+client.connect(args.sub_mqtt_host, args.sub_mqtt_port)
+
+# start client & subscribe client to topic
+client.loop_start()
+client.subscribe(args.sub_topic, args.sub_qos)
+
+def process_wav_bytes():
+   # A single output stream is kept open (and only reopened if the sample rate changes)
+   p = pyaudio.PyAudio()
+   stream = None
+   stream_rate = None
+
+   # Wait for messages until disconnected by system interrupt
+   while True:
+      try:
+         try:
+            rate, pcm = pcm_queue.get(block=True, timeout=1)
+         except queue.Empty:
+            continue
+         if (rate != stream_rate):
+            if (stream is not None):
+               stream.stop_stream()
+               stream.close()
+            stream = p.open(format=pyaudio.paInt16, channels=1, rate=rate, output=True)
+            stream_rate = rate
+         stream.write(pcm)
+      except KeyboardInterrupt:
+         if (stream is not None):
+            stream.stop_stream()
+            stream.close()
+         p.terminate()
+         exit(0)
+      '''
+      except Exception as e:
+         print(e)
+         continue
+      '''
+
+# Run the process wav bytes function
+process_wav_bytes()
@@ -0,0 +1,84 @@
+# Compact audio message exchanged between the audio synthesizer and the audio player over MQTT
+# NOTE: audio_synthesizer/audio_message.py and audio_player/audio_message.py are the same file
+# (the containers are built separately), keep them in sync
+#
+# Layout (little-endian):
+#   magic        4s   b"JLRA"
+#   version      B    VERSION
+#   flags        B    FLAG_END_OF_STREAM if the message ends the current utterance
+#   id_length    H    length of the utf-8 stream id following the header
+#   sample_rate  I    in Hz
+#   sequence     I    number of the message within its stream
+#   start_time   d    unix time at which the window of faces was ready for synthesis
+#   sent_time    d    unix time at which the message was published
+#   stream id    id_length bytes
+#   samples      int16 mono PCM until the end of the payload
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b"JLRA"
+VERSION = 1
+FLAG_END_OF_STREAM = 0x1
+
+_HEADER = struct.Struct("<4sBBHIIdd")
+
+AudioMessage = namedtuple("AudioMessage", ("samples", "sample_rate", "stream_id", "sequence",
+                                           "start_time", "sent_time", "end_of_stream"))
+
+
+def is_audio_message(payload):
+   return bytes(payload[:len(MAGIC)]) == MAGIC
+
+def encode_audio_message(samples, sample_rate, stream_id="", sequence=0, start_time=None, end_of_stream=False):
+   '''
+   Packs samples (already scaled to the int16 range) into an audio message
+   '''
+   stream_id = stream_id.encode("utf-8")
+   sent_time = time.time()
+   header = _HEADER.pack(MAGIC, VERSION, FLAG_END_OF_STREAM if end_of_stream else 0, len(stream_id),
+                         sample_rate, sequence, sent_time if start_time is None else start_time, sent_time)
+   pcm = np.clip(np.rint(samples), -32768, 32767).astype("<i2")
+   return header + stream_id + pcm.tobytes()
+
+def decode_audio_message(payload):
+   '''
+   Unpacks an audio message, the samples are an int16 view on the payload (no copy)
+   '''
+   if (len(payload) < _HEADER.size or not is_audio_message(payload)):
+      raise ValueError("not an audio message")
+   magic, version, flags, id_length, sample_rate, sequence, start_time, sent_time = _HEADER.unpack_from(payload)
+   if (version != VERSION):
+      raise ValueError("unsupported audio message version {}".format(version))
+   offset = _HEADER.size + id_length
+   stream_id = bytes(payload[_HEADER.size:offset]).decode("utf-8")
+   samples = np.frombuffer(payload, dtype="<i2", offset=offset)
+   return AudioMessage(samples, sample_rate, stream_id, sequence, start_time, sent_time,
+                       bool(flags & FLAG_END_OF_STREAM))
+
+def split_audio_messages(samples, sample_rate, chunk_samples, stream_id="", first_sequence=0, start_time=None,
+                         end_of_stream=False):
+   '''
+   Splits samples into audio messages of chunk_samples samples (a single message if chunk_samples <= 0)
+   numbered from first_sequence, only the last one carries end_of_stream
+   '''
+   chunk = chunk_samples if chunk_samples > 0 else max(1, len(samples))
+   return [encode_audio_message(samples[start:start + chunk], sample_rate, stream_id=stream_id,
+                                sequence=first_sequence + i, start_time=start_time,
+                                end_of_stream=end_of_stream and start + chunk >= len(samples))
+           for i, start in enumerate(range(0, len(samples), chunk))]
+
+def track_sequence(last_sequences, message):
+   '''
+   Records the sequence number of message in last_sequences (last sequence number of each stream id),
+   returns the number of messages of its stream lost before it, or -1 if its sequence restarted
+   '''
+   last = last_sequences.get(message.stream_id)
+   last_sequences[message.stream_id] = message.sequence
+   if (last is None):
+      return 0
+   elif (message.sequence <= last):
+      return -1
+   return message.sequence - last - 1
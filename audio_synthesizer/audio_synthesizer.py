@@ -1,20 +1,30 @@
+# Start the startup timeline before any heavy import
+from synthesizer.utils import startup
+
 # System-related & MQTT imports
 import time
-import sys, os, pickle, argparse, subprocess
-from tqdm import tqdm
+import os, argparse
+import threading
+import asyncio, signal, traceback
+from concurrent.futures import ThreadPoolExecutor
 from profilehooks import timecall
-import queue
 import paho.mqtt.client as mqtt
 
 # Synthesizer imports
-import synthesizer
 from synthesizer import inference as sif
+from synthesizer.streaming import WindowStitcher, WindowAssembler, FrameDecoder, EncoderFeatureCache, FrameRef, FrameRingBuffer, INGEST_POLICIES
+from synthesizer.models.modules import EncoderConvolutions3D
+from synthesizer.pipeline import StagePipeline, WindowBatcher
+from synthesizer.hotswap import SwappableSynthesizer, stream_hparams
+from synthesizer.pool import ModelPool, RoutedSynthesizer
+from synthesizer.workers import WorkerLost, WorkerPool
+from synthesizer.aio import AsyncMqttClient, ingest
+from audio_message import split_audio_messages
 import numpy as np
-import cv2
-from shutil import copy
-from glob import glob
 from scipy.io import wavfile
 import io
+import json
+startup.mark("imports done")
 
 ##############
 # Parameters #
@@ -27,21 +37,43 @@ parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=
 parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
 parser.add_argument("--wav_action", help="What to do with the generated wav files", type=str, required=False, choices=["save", "forward"], default="forward")
 parser.add_argument("--results_root", help="Speaker folder path, only needed if wav_action=='save'", required=False)
-parser.add_argument("--method_of_synthesis", help="The method of synthesis to used (cpu-based or gpu-based) to generate wav files", type=str, required=False, choices=["cpu", "gpu"], default="gpu")
+parser.add_argument("--method_of_synthesis", help="The method of synthesis to used (cpu-based, gpu-based or cpu-based with the quantized model of --quantized_model) to generate wav files", type=str, required=False, choices=["cpu", "gpu", "quantized"], default="gpu")
+parser.add_argument("--quantized_model", help="Path of the TFLite model converted by synthesizer/quantize.py, required if method_of_synthesis=='quantized'", type=str, required=False, default=None)
+parser.add_argument("--synthesis_mode", help="Synthesize disjoint windows of hparams.T frames or overlapping windows every --hop frames", type=str, required=False, choices=["windowed", "streaming"], default="windowed")
+parser.add_argument("--hop", help="Number of new frames between two windows in streaming mode (defaults to hparams.T - hparams.overlap, hparams.overlap being the number of frames two consecutive windows share)", type=str, required=False, default=None)
+parser.add_argument("--encoder_cache", help="In streaming mode, reuse the encoder convolution features of the frames shared by consecutive windows (approximate, see README)", action="store_true")
+parser.add_argument("--pipelined", help="In cpu mode, generate the mel spectrogram of the next window while vocoding the current one", action="store_true")
+parser.add_argument("--pipeline_depth", help="Number of windows that can wait in front of each pipeline stage", type=int, required=False, default=1)
+parser.add_argument("--workers", help="Number of worker processes, each with its own model, the streams are spread over (0 synthesizes in the main process)", type=int, required=False, default=0)
+parser.add_argument("--max_batch_size", help="Maximum number of windows (of one or several streams) synthesized by a single model call, 1 disables batching", type=int, required=False, default=1)
+parser.add_argument("--max_batch_delay", help="Maximum number of seconds a window waits for other windows to fill a batch", type=float, required=False, default=0.01)
+parser.add_argument("--speakers", help="JSON file mapping stream ids to the model of their speaker, {<id>: {\"checkpoint\": <ckpt>, \"preset\": <json>}}, the other streams use --checkpoint and --preset", type=str, required=False, default=None)
+parser.add_argument("--model_memory_mb", help="Memory budget (MB of checkpoint files) of the models kept loaded, including the default model: the least recently used models of the speakers are unloaded beyond it (<= 0 for no limit)", type=int, required=False, default=0)
+parser.add_argument("--frozen_graph_dir", help="Directory caching the frozen inference graph of the checkpoint and preset, exported on the first start and imported on the next ones", type=str, required=False, default=None)
+parser.add_argument("--xla_jit", help="Compile the model with the XLA JIT (falls back to the regular executor if the compilation fails)", action="store_true")
+parser.add_argument("--runtime", help="Serve the streams with a thread per stream and paho network threads, or from an asyncio event loop", type=str, required=False, choices=["threads", "asyncio"], default="threads")
+parser.add_argument("--decode_workers", help="Number of threads decoding the received faces", type=int, required=False, default=2)
+parser.add_argument("--ingest_policy", help="What to do with new faces when synthesis falls more than --max_lag behind: block the receiver, drop the oldest hop of frames or skip whole windows", type=str, required=False, choices=INGEST_POLICIES, default="block")
+parser.add_argument("--max_lag", help="Maximum number of seconds of faces buffered before the ingest policy kicks in", type=float, required=False, default=6.0)
+parser.add_argument("--idle_timeout", help="Seconds without new faces after which a partial window is padded and synthesized (<= 0 to disable)", type=float, required=False, default=1.0)
 
 # Subscribing client params
 parser.add_argument("--sub_client_name", help="The name of the MQTT subscribing client", type=str, required=False, default="jetson-face-receiver")
 parser.add_argument("--sub_mqtt_host", help="The MQTT host for the subscribing client", type=str, required=True)
 parser.add_argument("--sub_mqtt_port", help="The MQTT port for the subscribing client", type=int, required=False, default=1883)
 parser.add_argument("--sub_qos", help="The MQTT quality of service for the subscribing client", type=int, required=False, default=2)
-parser.add_argument("--sub_topic", help="The MQTT topic the subscribing client should subscribe to", type=str, required=False, default="jetson/faces")
+parser.add_argument("--sub_topic", help="The MQTT topic the subscribing client should subscribe to, faces of stream <id> can also be published to <sub_topic>/<id>", type=str, required=False, default="jetson/faces")
+parser.add_argument("--control_topic", help="The MQTT topic of the control messages, e.g. {\"checkpoint\": <ckpt>, \"preset\": <json>} to swap in the model of another speaker without restarting, adding \"stream\": <id> to route a single stream to it", type=str, required=False, default="jetson/control")
+parser.add_argument("--session_timeout", help="Seconds without faces after which a stream's session is evicted", type=float, required=False, default=60.0)
 
 # Publishing client params
 parser.add_argument("--pub_client_name", help="The name of the MQTT publishing client", type=str, required=False, default="jetson-audio-sender")
 parser.add_argument("--pub_mqtt_host", help="The MQTT host for the publishing client", type=str, required=True)
 parser.add_argument("--pub_mqtt_port", help="The MQTT port for the publishing client", type=int, required=False, default=1883)
 parser.add_argument("--pub_qos", help="The MQTT quality of service for the publishing client", type=int, required=False, default=2)
-parser.add_argument("--pub_topic", help="The MQTT topic the publishing client should publish to", type=str, required=False, default="jetson/audio")
+parser.add_argument("--audio_format", help="Forward the audio as compact PCM16 messages (see audio_message.py) or as legacy wav files", type=str, required=False, choices=["pcm16", "wav"], default="pcm16")
+parser.add_argument("--chunk_ms", help="Duration of the pcm16 audio messages in milliseconds, the audio of a window is split into chunks published as soon as it is ready (<= 0 publishes a message per window)", type=int, required=False, default=100)
+parser.add_argument("--pub_topic", help="The MQTT topic the publishing client should publish to, audio of stream <id> is published to <pub_topic>/<id>", type=str, required=False, default="jetson/audio")
 
 args = parser.parse_args()
 
@@ -54,6 +86,32 @@ args = parser.parse_args()
 with open(args.preset) as f:
    sif.hparams.parse_json(f.read()) ## add speaker-specific parameters
 sif.hparams.set_hparam('eval_ckpt', args.checkpoint)
+if (args.xla_jit):
+   sif.hparams.set_hparam('xla_jit', True)
+# "none" is the default of the QUANTIZED_MODEL, SPEAKERS and HOP variables of the container
+if (args.quantized_model == "none"):
+   args.quantized_model = None
+if (args.speakers == "none"):
+   args.speakers = None
+if (args.hop == "none"):
+   args.hop = None
+elif (args.hop is not None):
+   args.hop = int(args.hop)
+if (args.method_of_synthesis == "quantized" and args.quantized_model is None):
+   raise ValueError("--quantized_model is required with --method_of_synthesis quantized")
+if (args.encoder_cache and args.method_of_synthesis == "quantized"):
+   raise ValueError("--encoder_cache is not supported with --method_of_synthesis quantized")
+if (args.workers > 0 and (args.max_batch_size > 1 or args.pipelined)):
+   raise ValueError("--workers is not supported with --max_batch_size above 1 or --pipelined")
+if (args.speakers is not None and args.method_of_synthesis == "quantized"):
+   raise ValueError("--speakers is not supported with --method_of_synthesis quantized")
+
+# Model (checkpoint, preset) of the streams routed to another speaker than --checkpoint, see on_control
+stream_speakers = {}
+if (args.speakers is not None):
+   with open(args.speakers) as f:
+      stream_speakers = {stream_id: (speaker["checkpoint"], speaker["preset"])
+                         for stream_id, speaker in json.load(f).items()}
 
 if (args.wav_action == "save"):
    WAVS_ROOT = os.path.join(args.results_root, 'wavs/')
@@ -61,10 +119,560 @@ if (args.wav_action == "save"):
       os.mkdir(WAVS_ROOT)
 
 # Set params for processing
-num_frames = sif.hparams.T
+streaming = args.synthesis_mode == "streaming"
+# The quantized model synthesizes mel spectrograms, vocoded on the CPU like in cpu mode
+cpu_based = args.method_of_synthesis in ("cpu", "quantized")
+pipelined = args.pipelined and cpu_based
+batched = args.max_batch_size > 1
+# The features are cached per stream, batched windows are synthesized without the cache
+encoder_cached = args.encoder_cache and streaming and not batched
+
+# Number of windows a stream can have in synthesis at once
+pinned_windows = args.pipeline_depth + 2 if pipelined else (args.max_batch_size if batched else 1)
+
+
+class StreamLayout(object):
+   '''
+   Sizes of the windows and buffers of a stream, from the StreamHparams (see synthesizer/hotswap.py)
+   of the model it is synthesized by: the streams routed to models with other hparams are sized
+   differently, and a stream is resized when its model changes (see StreamSession.update_layout)
+   Raises ValueError if --hop does not fit the windows of the model
+   '''
+   def __init__(self, shape):
+      super(StreamLayout, self).__init__()
+      self.shape = shape
+      self.num_frames = shape.T
+      self.img_size = shape.img_size
+      # Consecutive windows share hparams.overlap frames by default, as in bulk_synthesize.py
+      hop = args.hop if args.hop is not None else self.num_frames - shape.overlap
+      if (streaming and not 0 < hop <= self.num_frames):
+         raise ValueError("--hop must be in (0, {}], got {}".format(self.num_frames, hop))
+      # The assembler hands out windows of num_frames faces every window_hop faces
+      self.window_hop = hop if streaming else self.num_frames
+      # Bound the faces waiting for a window to --max_lag seconds (but at least one window), the ring
+      # buffer also needs room for the frames still pinned by the windows being synthesized
+      self.max_buffered = max(self.num_frames, int(round(args.max_lag * shape.fps)))
+      self.buffer_frames = self.max_buffered + self.window_hop * pinned_windows
+
+# Layout of the streams of the model of --checkpoint and --preset, until the model of a stream changes
+default_layout = StreamLayout(stream_hparams(sif.hparams))
+
+# The model (and the batcher running it) is loaded once by process_faces() and shared by the
+# sessions of all streams, the models of the routed streams are loaded in the pool on demand
+shared_synthesizer = None
+shared_batcher = None
+shared_pool = None
+synthesizer_loaded = threading.Event()
+# With --workers, the windows are synthesized by the worker processes instead (see SynthesisWorker)
+shared_workers = None
+
+
+class StreamSession(object):
+   '''
+   State of a single stream of faces: its own decoder pool, window assembler and synthesis thread
+   (with its own Generator state), sharing the loaded model with the other streams
+   '''
+   def __init__(self, stream_id):
+      super(StreamSession, self).__init__()
+      self.stream_id = stream_id
+      self.pub_topic = args.pub_topic if stream_id == "" else "{}/{}".format(args.pub_topic, stream_id)
+      self.wav_prefix = "" if stream_id == "" else stream_id + "_"
+      self.last_active = time.time()
+      # Sized for the default model until the stream is synthesized (see update_layout)
+      self.layout = default_layout
+      # With --workers, the StreamHparams of the model of the worker of the stream
+      self.worker_shape = default_layout.shape
+      self.generator = None
+
+      # Faces are resized once by the decoder pool and normalized once into the assembler's ring buffer
+      layout = self.layout
+      self.assembler = WindowAssembler(layout.num_frames, layout.window_hop, (layout.img_size, layout.img_size, 3),
+                                       capacity=layout.buffer_frames,
+                                       idle_timeout=args.idle_timeout if args.idle_timeout > 0 else None,
+                                       max_buffered=layout.max_buffered, policy=args.ingest_policy,
+                                       shared=shared_workers is not None)
+
+      # Define a decoder pool so that faces are not decoded on the network thread
+      self.decoder = FrameDecoder(self.assembler.put, num_workers=args.decode_workers, size=layout.img_size,
+                                  max_pending=4 * args.decode_workers * layout.window_hop, policy=args.ingest_policy)
+
+      self.thread = threading.Thread(target=self.process_faces, name="stream-" + stream_id, daemon=True)
+      self.thread.start()
+
+   def print_ingest_stats(self):
+      # Lag = faces received but not synthesized yet, dropped = faces shed by the ingest policy
+      buffered, dropped = self.assembler.stats()
+      decoding = self.decoder.qsize()
+      lag = (buffered + decoding) / self.layout.shape.fps
+      dropped += self.decoder.dropped_frames
+      print("[{}] lag = {:.2f} s ({} frames buffered, {} decoding), dropped = {} frames".format(
+         self.stream_id, lag, buffered, decoding, dropped))
 
-# Define a frame queue 
-face_queue = queue.Queue()
+   def model_shape(self):
+      '''
+      StreamHparams of the model the next window of the stream goes to, as last reported by the
+      worker of the stream with --workers
+      '''
+      if (shared_workers is not None):
+         return self.worker_shape
+      return self.generator.model_shape()
+
+   def update_layout(self):
+      '''
+      Resizes the windows and buffers of the stream for the model it is synthesized by, once it was
+      routed or swapped to a model with other stream hparams. Called between two windows: the
+      buffered faces are carried over to the new windows, the audio starts a new stream
+      '''
+      shape = self.model_shape()
+      if (shape == self.layout.shape):
+         return
+      layout = self.layout = StreamLayout(shape)
+      print("[{}] resizing the stream to windows of {} faces of {}x{} pixels every {} faces".format(
+         self.stream_id, layout.num_frames, layout.img_size, layout.img_size, layout.window_hop))
+      self.decoder.set_size(layout.img_size)
+      self.decoder.max_pending = 4 * args.decode_workers * layout.window_hop
+      self.assembler.reshape(layout.num_frames, layout.window_hop, (layout.img_size, layout.img_size, 3),
+                             capacity=layout.buffer_frames, max_buffered=layout.max_buffered)
+      self.generator.set_layout(layout)
+
+   def worker_output(self, output):
+      '''
+      wav of a window synthesized by the worker of the stream (--workers), which also reports the
+      StreamHparams of its model
+      '''
+      wav, shape = output
+      if (shape != self.worker_shape):
+         self.worker_shape = shape
+         # Published with the sample rate of the model it was synthesized by, the assembler is
+         # resized before the next window
+         self.generator.set_layout(StreamLayout(shape))
+      return wav
+
+   def close(self):
+      '''
+      Synthesizes the faces still buffered, then stops the session's thread
+      '''
+      self.decoder.close()
+      self.assembler.close()
+      self.thread.join()
+
+   def process_faces(self):
+      synthesizer_loaded.wait()
+      generator = self.generator = Generator(cpu_based=cpu_based, streaming=streaming,
+                                             synthesizer=stream_synthesizer(self.stream_id), batcher=shared_batcher,
+                                             stream_id=self.stream_id, pub_topic=self.pub_topic, wav_prefix=self.wav_prefix,
+                                             layout=self.layout)
+
+      # In pipelined mode, the mel spectrogram of window N + 1 is synthesized while window N is vocoded
+      def mel_stage(item):
+         window, wav_num, start_time = item
+         try:
+            mel_spec, hparams = generator.synthesize_mel_spec(window.frames, window_start(window))
+         except WindowShapeError as e:
+            print("[" + self.stream_id + "] dropping window: " + str(e))
+            return None
+         finally:
+            self.assembler.release(window)
+         return (mel_spec, hparams, window.num_valid, window.is_final, wav_num, start_time)
+
+      def vocoder_stage(item):
+         mel_spec, hparams, num_valid, is_final, wav_num, start_time = item
+         generator.output_wav(generator.vocode_mel_spec(mel_spec, hparams, num_valid), wav_num, start_time, is_final)
+
+      def new_pipeline():
+         return StagePipeline([("mel", mel_stage), ("vocoder", vocoder_stage)],
+                              depth=args.pipeline_depth, report_every=1) if pipelined else None
+
+      pipeline = new_pipeline()
+      audio_sample_num = 1
+      while True:
+         if (self.model_shape() != self.layout.shape):
+            if (pipeline is not None):
+               # The windows in flight are vocoded with the stitchers of the previous layout
+               pipeline.close()
+               pipeline = new_pipeline()
+            self.update_layout()
+         # Block until a full window is ready (or a partial one is flushed after idle_timeout)
+         window = self.assembler.get_window()
+         start_time = time.time()
+         if (window is None):
+            if (pipeline is not None):
+               pipeline.close() # drain the windows in flight
+            break
+         if (window.is_final):
+            print("[" + self.stream_id + "] flushing " + str(window.num_valid) + " frames after idle timeout")
+         else:
+            print("[" + self.stream_id + "] reached " + str(len(window.frames)) + " frames")
+         self.print_ingest_stats()
+
+         # Process frames and generate synthesized audio as wav file data
+         # Save as wav file or forward via mqtt
+         if (pipeline is not None):
+            pipeline.put((window, audio_sample_num, start_time))
+            audio_sample_num += 1
+         elif (shared_workers is not None):
+            # The worker maps the frames from the shared ring, the window stays pinned until it is done
+            output = shared_workers.submit(self.stream_id, "generate_wav", worker_frames(self.assembler, window),
+                                           window.num_valid, window_start(window))
+            try:
+               wav = self.worker_output(output.result())
+            except WorkerLost as e:
+               # The stream continues on the replacement worker, which reports the shape of its model
+               print("[" + self.stream_id + "] dropping window: " + str(e))
+               wav = None
+            finally:
+               self.assembler.release(window)
+            generator.output_wav(wav, audio_sample_num, start_time, window.is_final)
+            audio_sample_num += 1
+         elif (batched and not generator.synthesizer.routed):
+            # Submit the backlog of ready windows at once so that it is synthesized in one batch
+            windows = [window]
+            while len(windows) < args.max_batch_size:
+               next_window = self.assembler.try_get_window()
+               if (next_window is None):
+                  break
+               windows.append(next_window)
+            outputs = [shared_batcher.submit(window.frames) for window in windows]
+            for window, output in zip(windows, outputs):
+               try:
+                  wav = generator.generate_wav_from_output(output.result(), window.num_valid)
+               except WindowShapeError as e:
+                  print("[" + self.stream_id + "] dropping window: " + str(e))
+                  wav = None
+               finally:
+                  self.assembler.release(window)
+               generator.output_wav(wav, audio_sample_num, start_time, window.is_final)
+               audio_sample_num += 1
+         else:
+            try:
+               wav = generator.generate_wav(window.frames, window.num_valid, window_start(window))
+            except WindowShapeError as e:
+               print("[" + self.stream_id + "] dropping window: " + str(e))
+               wav = None
+            finally:
+               self.assembler.release(window)
+            generator.output_wav(wav, audio_sample_num, start_time, window.is_final)
+            audio_sample_num += 1
+      if (shared_workers is not None):
+         shared_workers.release(self.stream_id, "close_stream")
+
+
+class AsyncStreamSession(object):
+   '''
+   asyncio version of StreamSession: faces are still decoded by a decoder pool, but partial windows
+   are flushed by an event loop timer and windows are synthesized on an executor, so that inference
+   never blocks the handling of messages
+   '''
+   def __init__(self, stream_id, loop, executor):
+      super(AsyncStreamSession, self).__init__()
+      self.stream_id = stream_id
+      self.pub_topic = args.pub_topic if stream_id == "" else "{}/{}".format(args.pub_topic, stream_id)
+      self.wav_prefix = "" if stream_id == "" else stream_id + "_"
+      self.loop = loop
+      self.executor = executor
+      self.last_active = loop.time()
+      self.layout = default_layout
+      self.worker_shape = default_layout.shape
+
+      # The idle timeout is handled by flush_timer rather than by the assembler
+      layout = self.layout
+      self.assembler = WindowAssembler(layout.num_frames, layout.window_hop, (layout.img_size, layout.img_size, 3),
+                                       capacity=layout.buffer_frames, max_buffered=layout.max_buffered,
+                                       policy=args.ingest_policy, shared=shared_workers is not None)
+      self.decoder = FrameDecoder(self.deliver, num_workers=args.decode_workers, size=layout.img_size,
+                                  max_pending=4 * args.decode_workers * layout.window_hop, policy=args.ingest_policy)
+      self.generator = Generator(cpu_based=cpu_based, streaming=streaming,
+                                 synthesizer=stream_synthesizer(self.stream_id), batcher=shared_batcher, stream_id=self.stream_id,
+                                 pub_topic=self.pub_topic, wav_prefix=self.wav_prefix, layout=layout)
+
+      self.wake = asyncio.Event()
+      self.flush_timer = None
+      self.flush_due = False
+      self.closing = False
+      self.task = loop.create_task(self.process_faces())
+
+   print_ingest_stats = StreamSession.print_ingest_stats
+   model_shape = StreamSession.model_shape
+   update_layout = StreamSession.update_layout
+   worker_output = StreamSession.worker_output
+
+   async def submit(self, payload):
+      self.last_active = self.loop.time()
+      if (args.ingest_policy == "block"):
+         # submit() blocks while the decoder is full, which stops the ingest until it catches up
+         await self.loop.run_in_executor(None, self.decoder.submit, payload)
+      else:
+         self.decoder.submit(payload)
+
+   def deliver(self, frame):
+      # Called on a decoder thread
+      self.assembler.put(frame)
+      self.loop.call_soon_threadsafe(self.on_frame)
+
+   def on_frame(self):
+      if (args.idle_timeout > 0):
+         if (self.flush_timer is not None):
+            self.flush_timer.cancel()
+         self.flush_timer = self.loop.call_later(args.idle_timeout, self.on_idle)
+      self.wake.set()
+
+   def on_idle(self):
+      self.flush_timer = None
+      self.flush_due = True
+      self.wake.set()
+
+   def next_windows(self):
+      '''
+      Takes the backlog of ready windows (a single one unless batching), or flushes the buffered
+      frames once the stream went idle or is closing
+      '''
+      windows = []
+      while len(windows) < args.max_batch_size:
+         window = self.assembler.try_get_window()
+         if (window is None):
+            break
+         windows.append(window)
+      if (not windows and (self.flush_due or self.closing)):
+         self.flush_due = False
+         window = self.assembler.flush()
+         if (window is not None):
+            windows.append(window)
+      return windows
+
+   def output_window(self, window, wav_num, start_time, output=None):
+      try:
+         if (output is None):
+            wav = self.generator.generate_wav(window.frames, window.num_valid, window_start(window))
+         else:
+            wav = self.generator.generate_wav_from_output(output, window.num_valid)
+      except WindowShapeError as e:
+         print("[" + self.stream_id + "] dropping window: " + str(e))
+         wav = None
+      self.generator.output_wav(wav, wav_num, start_time, window.is_final)
+
+   async def synthesize(self, windows, wav_num):
+      start_time = time.time()
+      if (shared_workers is not None):
+         # The worker of the stream synthesizes the windows in order, only the publishing uses the executor
+         outputs = [asyncio.wrap_future(shared_workers.submit(self.stream_id, "generate_wav",
+                                                              worker_frames(self.assembler, window),
+                                                              window.num_valid, window_start(window)))
+                    for window in windows]
+      else:
+         # With batching the model runs on the batcher thread, only the vocoding uses the executor
+         # (the batches run the default model, the windows of a routed stream are synthesized one by one)
+         batcher = shared_batcher if not self.generator.synthesizer.routed else None
+         outputs = [asyncio.wrap_future(batcher.submit(window.frames)) if batcher is not None else None
+                    for window in windows]
+      for window, output in zip(windows, outputs):
+         if (window.is_final):
+            print("[" + self.stream_id + "] flushing " + str(window.num_valid) + " frames after idle timeout")
+         else:
+            print("[" + self.stream_id + "] reached " + str(len(window.frames)) + " frames")
+         try:
+            if (output is not None):
+               output = await output
+            if (shared_workers is not None):
+               await self.loop.run_in_executor(self.executor, self.generator.output_wav, self.worker_output(output),
+                                               wav_num, start_time, window.is_final)
+            else:
+               await self.loop.run_in_executor(self.executor, self.output_window, window, wav_num, start_time, output)
+         except (WindowShapeError, WorkerLost) as e:
+            print("[" + self.stream_id + "] dropping window: " + str(e))
+         except Exception:
+            traceback.print_exc()
+         finally:
+            self.assembler.release(window)
+         wav_num += 1
+
+   async def process_faces(self):
+      wav_num = 1
+      while True:
+         await self.wake.wait()
+         self.wake.clear()
+         while True:
+            # Between two windows, the assembler is resized if the model of the stream changed
+            self.update_layout()
+            windows = self.next_windows()
+            if (not windows):
+               break
+            await self.synthesize(windows, wav_num)
+            wav_num += len(windows)
+         if (self.closing):
+            break
+
+   async def close(self):
+      '''
+      Synthesizes the faces still buffered (or being decoded), then stops the session
+      '''
+      if (self.flush_timer is not None):
+         self.flush_timer.cancel()
+      await self.loop.run_in_executor(None, self.decoder.close)
+      self.closing = True
+      self.wake.set()
+      await self.task
+      self.assembler.close()
+      if (shared_workers is not None):
+         shared_workers.release(self.stream_id, "close_stream")
+
+
+def window_start(window):
+   '''
+   Index of the first frame of a window in its stream, or None for a flushed window (its padding
+   frames are not part of the stream, so its encoder features are not cached)
+   '''
+   return None if window.is_final else window.start
+
+def worker_frames(assembler, window):
+   '''
+   Frames of a window sent to the worker of its stream (--workers): a FrameRef on the shared ring
+   of the stream, which has to stay pinned until the worker is done, or a flushed window itself
+   '''
+   ref = assembler.frame_ref(window)
+   return ref if ref is not None else window.frames
+
+class WindowShapeError(ValueError):
+   '''
+   Raised for a window that does not fit the model it goes to: the stream was routed or swapped to
+   a model with other stream hparams after the window was assembled, the window is dropped
+   '''
+
+def check_window(hparams, images):
+   if (images.shape[:2] != (hparams.T, hparams.img_size)):
+      raise WindowShapeError("the window has {} faces of {} pixels, the model takes {} faces of {} pixels".format(
+         images.shape[0], images.shape[1], hparams.T, hparams.img_size))
+
+def synthesize_shared_batch(windows):
+   '''
+   Synthesizes a batch of windows (of the streams that are not routed) with the shared model
+   '''
+   with shared_synthesizer.pinned() as (synthesizer, _):
+      for window in windows:
+         check_window(synthesizer.hparams, window)
+      outputs = synthesizer.synthesize_batch(windows, cpu_based=cpu_based)
+      return [(output, synthesizer.hparams) for output in outputs]
+
+def new_synthesizer(hparams, quantized_model=None):
+   '''
+   Synthesizer (not loaded yet) of the model described by hparams, used to load the first model,
+   the models swapped in by control messages and those of the routed streams
+   Raises ValueError if the streams cannot be sized for hparams (see StreamLayout)
+   '''
+   StreamLayout(stream_hparams(hparams))
+   if (args.method_of_synthesis == "quantized" and quantized_model is None):
+      raise ValueError("a quantized_model is required with --method_of_synthesis quantized")
+   return sif.Synthesizer(verbose=False, frozen_graph_dir=args.frozen_graph_dir, hparams=hparams,
+                          quantized_model=quantized_model if args.method_of_synthesis == "quantized" else None)
+
+def stream_synthesizer(stream_id):
+   '''
+   Synthesizer of a stream: the model of its speaker in the pool if it is routed to one (see
+   stream_speakers), the shared model otherwise
+   '''
+   return RoutedSynthesizer(shared_pool, shared_synthesizer, lambda: stream_speakers.get(stream_id))
+
+def on_control(payload):
+   '''
+   Handles a control message: {"checkpoint": <path>, "preset": <path>} (and "quantized_model" in
+   quantized mode) loads that model in the background and swaps it in between windows
+   With "stream": <id>, only that stream is routed to the model (loaded in the pool), and
+   {"stream": <id>} alone routes it back to the shared model
+   With --workers, the message is handled by every worker for its own models (and again by the
+   workers that replace dead ones)
+   '''
+   if (shared_workers is not None):
+      shared_workers.broadcast("control", payload, replay=True)
+      return
+   try:
+      command = json.loads(payload.decode("utf-8"))
+      stream_id = command.get("stream")
+      if (stream_id is None or "checkpoint" in command):
+         checkpoint, preset = command["checkpoint"], command["preset"]
+      else:
+         checkpoint, preset = None, None
+   except (ValueError, KeyError, AttributeError) as e:
+      print("ignoring malformed control message: " + str(e))
+      return
+   if (shared_synthesizer is None):
+      print("ignoring control message, the model is not loaded yet")
+      return
+   if (stream_id is not None):
+      route_stream(stream_id, checkpoint, preset)
+      return
+   print("swapping in the model of " + checkpoint + " (" + preset + ")")
+   options = {"quantized_model": command["quantized_model"]} if "quantized_model" in command else {}
+   shared_synthesizer.start_swap(checkpoint, preset, **options)
+
+def route_stream(stream_id, checkpoint, preset):
+   '''
+   Routes the windows of stream_id to the model of checkpoint and preset from its next window on
+   (to the shared model if checkpoint is None), the model is loaded in the background
+   '''
+   if (checkpoint is None):
+      print("routing stream [" + stream_id + "] to the shared model")
+      stream_speakers.pop(stream_id, None)
+      return
+   if (args.method_of_synthesis == "quantized"):
+      print("ignoring control message, streams cannot be routed with --method_of_synthesis quantized")
+      return
+   key = (checkpoint, preset)
+   try:
+      StreamLayout(stream_hparams(shared_pool.hparams(key)))
+   except (ValueError, OSError) as e:
+      print("ignoring control message: " + str(e))
+      return
+   print("routing stream [" + stream_id + "] to the model of " + checkpoint + " (" + preset + ")")
+   shared_pool.start_load(key)
+   stream_speakers[stream_id] = key
+
+def stream_id_of(topic):
+   '''
+   Faces published to <sub_topic>/<id> belong to stream <id>, faces published to <sub_topic> itself
+   belong to the default stream ""
+   '''
+   return "" if topic == args.sub_topic else topic[len(args.sub_topic) + 1:]
+
+
+class StreamSessions(object):
+   '''
+   Sessions of the streams currently publishing faces, keyed by stream id
+   Faces published to <sub_topic>/<id> belong to stream <id>, faces published to <sub_topic> itself
+   belong to the default stream ""
+   '''
+   def __init__(self):
+      super(StreamSessions, self).__init__()
+      self.sessions = {}
+      self.lock = threading.Lock()
+
+   def submit(self, topic, payload):
+      stream_id = stream_id_of(topic)
+      with self.lock:
+         session = self.sessions.get(stream_id)
+         if (session is None):
+            print("new stream [" + stream_id + "], " + str(len(self.sessions) + 1) + " active streams")
+            session = StreamSession(stream_id)
+            self.sessions[stream_id] = session
+         session.last_active = time.time()
+         session.decoder.submit(payload)
+
+   def evict_idle(self, timeout):
+      now = time.time()
+      with self.lock:
+         idle = [session for session in self.sessions.values() if now - session.last_active > timeout]
+         for session in idle:
+            del self.sessions[session.stream_id]
+      for session in idle:
+         print("evicting idle stream [" + session.stream_id + "]")
+         session.close()
+
+   def close_all(self):
+      with self.lock:
+         sessions = list(self.sessions.values())
+         self.sessions.clear()
+      for session in sessions:
+         session.close()
+
+stream_sessions = StreamSessions()
 
 
 def on_log(client, userdata, level, buf):
@@ -77,6 +685,19 @@ def on_connect(client, userdata, flags, rc):
       print("Bad connection retruned code = ", rc)
       client.loop_stop()
 
+def on_receiver_connect(client, userdata, flags, rc):
+   on_connect(client, userdata, flags, rc)
+   if (rc == 0):
+      startup.mark("receiver connected")
+      # (Re)subscribe on every connection, sessions buffer faces until the model is loaded
+      client.subscribe([(args.sub_topic, args.sub_qos), (args.sub_topic + "/+", args.sub_qos),
+                        (args.control_topic, args.sub_qos)])
+
+def on_sender_connect(client, userdata, flags, rc):
+   on_connect(client, userdata, flags, rc)
+   if (rc == 0):
+      startup.mark("sender connected")
+
 def on_disconnect(client, userdata, rc):
    print("client disconnected ok")
 
@@ -87,88 +708,202 @@ def on_subscribe(client, userdata, mid, granted_qos):
    print("subscribed")
 
 def on_message(client, userdata, message):
-   # Put frame to python queue to be processed when batches of num_frames are available
-   face = np.asarray(bytearray(message.payload), dtype="uint8")
-   face = cv2.imdecode(face, cv2.IMREAD_COLOR)
-   face_queue.put(face, block=True)
-
-
-# Set up receiver client & callbacks
-receiver_client = mqtt.Client(args.sub_client_name)
-receiver_client.on_log = on_log
-receiver_client.on_connect = on_connect
-receiver_client.on_disconnect = on_disconnect
-receiver_client.on_message = on_message
-receiver_client.on_subscribe = on_subscribe
-receiver_client.connect(args.sub_mqtt_host, args.sub_mqtt_port)
+   if (message.topic == args.control_topic):
+      on_control(message.payload)
+      return
+   # Hand the encoded frame to the decoder pool of its stream, decoded frames are put to the
+   # stream's assembler in order to be processed when windows of num_frames are available
+   stream_sessions.submit(message.topic, message.payload)
 
 
-# Set up sender client & callbacks
-sender_client = mqtt.Client(args.pub_client_name)
-#sender_client.on_log = on_log
-sender_client.on_connect = on_connect
-sender_client.on_disconnect = on_disconnect
-#sender_client.on_publish = on_publish
-sender_client.connect(args.pub_mqtt_host, args.pub_mqtt_port)
+# The asyncio runtime connects its own clients from the event loop (see run_async)
+sender_client = None
+if (args.runtime == "threads"):
+   # Set up receiver client & callbacks
+   receiver_client = mqtt.Client(args.sub_client_name)
+   receiver_client.on_log = on_log
+   receiver_client.on_connect = on_receiver_connect
+   receiver_client.on_disconnect = on_disconnect
+   receiver_client.on_message = on_message
+   receiver_client.on_subscribe = on_subscribe
+   receiver_client.connect_async(args.sub_mqtt_host, args.sub_mqtt_port)
 
 
-# start clients & subscribe receiver client to topic
-receiver_client.loop_start()
-sender_client.loop_start()
-receiver_client.subscribe(args.sub_topic, args.sub_qos)
+   # Set up sender client & callbacks
+   sender_client = mqtt.Client(args.pub_client_name)
+   #sender_client.on_log = on_log
+   sender_client.on_connect = on_sender_connect
+   sender_client.on_disconnect = on_disconnect
+   #sender_client.on_publish = on_publish
+   sender_client.connect_async(args.pub_mqtt_host, args.pub_mqtt_port)
 
 class Generator(object):
-   def __init__(self, cpu_based):
+   def __init__(self, cpu_based, streaming=False, synthesizer=None, batcher=None, stream_id="", pub_topic=args.pub_topic, wav_prefix="", layout=None):
+      '''
+      layout is the StreamLayout of the windows of the stream, that of the model of synthesizer if None
+      '''
       super(Generator, self).__init__()
       self.cpu_based = cpu_based
+      self.streaming = streaming
+      self.batcher = batcher
+      self.stream_id = stream_id
+      self.sequence = 0 # of the next audio message of the stream
+      self.pub_topic = pub_topic
+      self.wav_prefix = wav_prefix
 
-      self.synthesizer = sif.Synthesizer(verbose=False)
-      self.synthesizer.load(cpu_based=self.cpu_based)
+      # Load the model unless it is shared with another generator
+      # (swappable for another model, see on_control)
+      if (synthesizer is None):
+         synthesizer = SwappableSynthesizer(new_synthesizer(sif.hparams, args.quantized_model),
+                                            self.cpu_based, new_synthesizer)
+         synthesizer.load(cpu_based=self.cpu_based)
+      self.synthesizer = synthesizer
 
       # for CPU-based approach
       self.mel_batches_per_wav_file = 1
       self.mel_batch = None
       self.num_mels = 0
 
+      # The encoder features of the frames shared with the previous window are reused, only the
+      # new frames (and the context of their convolutions) go through the encoder convolutions
+      self.encoder_cached = encoder_cached and streaming and batcher is None
+      self.encoder_cache = None
+      self.encoder_cache_generation = None
+
+      self.set_layout(layout if layout is not None else StreamLayout(self.model_shape()))
+
+   def model_shape(self):
+      '''
+      StreamHparams of the model the next window of the stream goes to
+      '''
+      return stream_hparams(self.synthesizer.hparams)
+
+   def set_layout(self, layout):
+      '''
+      Sizes the audio of the stream for the windows of layout (the stream was routed or swapped to a
+      model with other stream hparams), the next window starts a new audio stream
+      '''
+      self.layout = layout
+      shape = layout.shape
+      self.chunk_samples = args.chunk_ms * shape.sample_rate // 1000
+
+      # for streaming approach: consecutive windows overlap by (num_frames - hop) frames, so only
+      # the output of the last hop frames of each window is new
+      self.hop_size = sif.audio.get_hop_size(shape)
+      mel_hop = self.num_mel_frames(layout.window_hop)
+      self.mel_stitcher = WindowStitcher(shape.mel_step_size, mel_hop, shape.mel_overlap)
+      self.wav_stitcher = WindowStitcher(shape.mel_step_size * self.hop_size,
+                                         mel_hop * self.hop_size, shape.mel_overlap * self.hop_size)
+      self.vocoder_context = None
+      self.mel_batch = None
+      self.num_mels = 0
+      # Rebuilt for the windows of the model by the next window
+      self.encoder_cache = None
+      self.encoder_cache_generation = None
+
    # Run a single round of inference to force model init
    def force_model_init(self):
-      # use the same face for simplicity--the inference results doesn't need to be reasonable
-      model_init_face = "./forced_model_init_face.jpg"
-      fnames = [model_init_face for i in range(0, num_frames)]
-      assert len(fnames) == num_frames
-
-      images = [cv2.imread(fname, cv2.IMREAD_COLOR) for fname in fnames]
+      # use a synthetic window for simplicity--the inference results doesn't need to be reasonable
+      images = np.full((self.layout.num_frames, self.layout.img_size, self.layout.img_size, 3), 0.5, dtype=np.float32)
       self.generate_wav(images)
+      self.reset_stream()
+
+   def reset_stream(self):
+      '''
+      Drops the stitching state so the next window starts a new audio stream
+      '''
+      self.mel_stitcher.reset()
+      self.wav_stitcher.reset()
+      self.vocoder_context = None
+      if (self.encoder_cache is not None):
+         self.encoder_cache.reset()
 
-   def resize_and_nparrize_images(self, images):
-      images = [cv2.resize(img, (sif.hparams.img_size, sif.hparams.img_size)) for img in images]
-      images = np.asarray(images) / 255.
-      return images
+   def num_mel_frames(self, num_images):
+      '''
+      Number of mel frames synthesized for num_images frames of a window
+      '''
+      return int(round(num_images * self.layout.shape.mel_step_size / self.layout.num_frames))
+
+   def num_valid_mel_frames(self, num_valid):
+      '''
+      Number of mel frames synthesized from the real frames of a window, None if it has no padding
+      frames (num_valid is None or the window length)
+      '''
+      if (num_valid is None or num_valid == self.layout.num_frames):
+         return None
+      return self.num_mel_frames(num_valid)
 
    def post_process_wav(self, wav):
       wav *= 32767 / max(0.01, np.max(np.abs(wav)))
       return wav
 
-   def generate_mel_spec(self, images):
-      # Synthesize Spectrogram
-      mel_spec = self.synthesizer.synthesize_spectrograms(images)[0]         
+   def synthesize_window(self, images, start=None):
+      '''
+      Runs the model on a window, through the batcher if there is one: returns its mel spectrogram
+      with the CPU-based method, its wav with the GPU-based one, and the hparams of the model that
+      synthesized it (the mel spectrogram is vocoded with them, even if the model was swapped since)
+      start is the index of the first frame of the window in the stream, its encoder features are
+      taken from the cache when it is set
+      Raises WindowShapeError if the window does not fit the model
+      '''
+      if (self.batcher is not None and not self.synthesizer.routed):
+         return self.batcher.submit(images).result()
+      # The window (and its cached features) go through the model it was checked against
+      with self.synthesizer.pinned() as (synthesizer, generation):
+         check_window(synthesizer.hparams, images)
+         if (self.encoder_cached and start is not None):
+            if (generation != self.encoder_cache_generation):
+               self.encoder_cache = EncoderFeatureCache(len(images), EncoderConvolutions3D.temporal_radius(synthesizer.hparams))
+               self.encoder_cache_generation = generation
+            features = self.encoder_cache.features(
+               lambda chunk: synthesizer.encoder_features(chunk, cpu_based=self.cpu_based), images, start)
+            output = synthesizer.synthesize_batch([images], cpu_based=self.cpu_based, encoder_features=[features])[0]
+         elif (self.cpu_based):
+            output = synthesizer.synthesize_spectrograms(images)[0]
+         else:
+            output = synthesizer.synthesize_wavs(images)
+         return output, synthesizer.hparams
+
+   def synthesize_mel_spec(self, images, start=None):
+      '''
+      First stage of the CPU-based method: synthesizes the mel spectrogram of a window, returns it
+      with the hparams of the model that synthesized it
+      '''
+      return self.synthesize_window(images, start)
+
+   def generate_mel_spec(self, mel_spec, num_valid=None):
+      # Drop the part of the Spectrogram synthesized from padding frames
+      mel_valid = self.num_valid_mel_frames(num_valid)
+      if (mel_valid is not None):
+         mel_spec = mel_spec[:, :mel_valid]
          
       # Concatenate batches of mel spectrograms (to get longer wav file samples)
       if self.num_mels == 0:
          self.mel_batch = mel_spec
          self.num_mels = 1
       else:
-         self.mel_batch = np.concatenate((self.mel_batch, mel_spec[:, sif.hparams.mel_overlap:]), axis=1)
+         self.mel_batch = np.concatenate((self.mel_batch, mel_spec[:, self.layout.shape.mel_overlap:]), axis=1)
          self.num_mels += 1
 
    @timecall(immediate=True)
-   def generate_wav_cpu_based(self, images):
+   def generate_wav_cpu_based(self, images, num_valid=None, start=None):
       '''
       CPU-based method of converting batches of face images to wav files
       '''
-      # Generate mel spectrogram first
-      images = self.resize_and_nparrize_images(images)
-      self.generate_mel_spec(images)
+      mel_spec, hparams = self.synthesize_mel_spec(images, start)
+      return self.vocode_mel_spec(mel_spec, hparams, num_valid)
+
+   def vocode_mel_spec(self, mel_spec, hparams, num_valid=None):
+      '''
+      Second stage of the CPU-based method: converts the mel spectrogram of a window to a wav file
+      with Griffin-Lim (with the hparams of the model that synthesized it), returns None if no wav
+      file is ready yet
+      '''
+      if (self.streaming):
+         return self.vocode_mel_spec_streaming(mel_spec, hparams, num_valid)
+
+      # Accumulate mel spectrogram first
+      self.generate_mel_spec(mel_spec, num_valid)
 
       # Synthesize wav file from spectrogram when ready
       if (self.num_mels != self.mel_batches_per_wav_file):
@@ -176,7 +911,7 @@ class Generator(object):
          return None
       else:
          print("Generating wav file of mel spectrograms")
-         wav = self.synthesizer.griffin_lim(self.mel_batch)
+         wav = self.synthesizer.griffin_lim(self.mel_batch, hparams)
          wav = self.post_process_wav(wav)
 
          self.num_mels = 0
@@ -184,86 +919,364 @@ class Generator(object):
          return wav
 
    @timecall(immediate=True)
-   def generate_wav_gpu_based(self, images):
+   def generate_wav_gpu_based(self, images, num_valid=None, start=None):
       '''
       GPU-based method of converting batches of face images to wav files
       '''
-      images = self.resize_and_nparrize_images(images)
-      wav = self.synthesizer.synthesize_wavs(images)
+      return self.trim_wav(self.synthesize_window(images, start)[0], num_valid)
+
+   def trim_wav(self, wav, num_valid=None):
+      '''
+      Drops the samples of a GPU-synthesized wav that come from padding frames
+      '''
+      mel_valid = self.num_valid_mel_frames(num_valid)
+      if (mel_valid is not None):
+         wav = wav[:mel_valid * self.hop_size]
       wav = self.post_process_wav(wav)
       return wav
 
-   def generate_wav(self, images):
-      if (self.cpu_based):
-         return self.generate_wav_cpu_based(images)
-      else:
-         return self.generate_wav_gpu_based(images)
+   def vocode_mel_chunk(self, mel_chunk, hparams):
+      '''
+      Runs Griffin-Lim on a stitched mel chunk, using the end of the previous chunk as left context
+      so that consecutive chunks join up more smoothly
+      '''
+      context = self.vocoder_context
+      mel = mel_chunk if context is None else np.concatenate((context, mel_chunk), axis=1)
+      wav = self.synthesizer.griffin_lim(mel, hparams)
+      self.vocoder_context = mel_chunk[:, -self.layout.shape.mel_overlap:]
 
-   def generate_wav_and_save(self, images, root_dir, wav_num):
+      # Drop the samples of the context and pad the chunk to its exact duration
+      if context is not None:
+         wav = wav[context.shape[1] * self.hop_size:]
+      num_samples = mel_chunk.shape[1] * self.hop_size
+      return np.pad(wav[:num_samples], (0, max(0, num_samples - len(wav))), mode="constant")
+
+   def vocode_mel_spec_streaming(self, mel_spec, hparams, num_valid=None):
       '''
-      Generates wav files from batches of images and saves the wav to an output file
+      Streaming version of the second stage of the CPU-based method: stitches overlapping windows in
+      the mel domain and only vocodes the new part of the window
+      A window with padding frames (num_valid < num_frames) ends the stream
+      '''
+      mel_valid = self.num_valid_mel_frames(num_valid)
+      mel_chunk = self.mel_stitcher.push(mel_spec, valid_len=mel_valid)
+      wav = self.vocode_mel_chunk(mel_chunk, hparams) if mel_chunk.shape[1] > 0 else None
+      if (mel_valid is not None):
+         self.reset_stream()
+      if (wav is None):
+         return None # nothing new to play
+      wav = self.post_process_wav(wav)
+      return wav
+
+   @timecall(immediate=True)
+   def generate_wav_streaming(self, images, num_valid=None, start=None):
+      '''
+      GPU-based streaming method of converting overlapping windows of face images to wav chunks
+      The graph vocodes the whole window, so windows are stitched in the wav domain
+      A window with padding frames (num_valid < num_frames) ends the stream
+      '''
+      return self.stitch_wav(self.synthesize_window(images, start)[0], num_valid)
+
+   def stitch_wav(self, wav, num_valid=None):
+      '''
+      Stitches the wav of an overlapping window to the previous ones, returns None if there is
+      nothing new to play
       '''
-      wav = self.generate_wav(images)
+      mel_valid = self.num_valid_mel_frames(num_valid)
+      wav = self.wav_stitcher.push(wav[:self.wav_stitcher.window_len],
+                                   valid_len=mel_valid * self.hop_size if mel_valid is not None else None)
+      if (mel_valid is not None):
+         self.reset_stream()
+      if (len(wav) == 0):
+         return None # nothing new to play
+      wav = self.post_process_wav(wav)
+      return wav
+
+   def generate_wav_from_output(self, output, num_valid=None):
+      '''
+      Turns the model output of a window (see synthesize_window) into a wav, returns None if no wav
+      is ready yet
+      '''
+      output, hparams = output
+      if (self.cpu_based):
+         return self.vocode_mel_spec(output, hparams, num_valid)
+      elif (self.streaming):
+         return self.stitch_wav(output, num_valid)
+      else:
+         return self.trim_wav(output, num_valid)
+
+   def generate_wav(self, images, num_valid=None, start=None):
+      if (self.cpu_based):
+         return self.generate_wav_cpu_based(images, num_valid, start)
+      elif (self.streaming):
+         return self.generate_wav_streaming(images, num_valid, start)
+      else:
+         return self.generate_wav_gpu_based(images, num_valid, start)
+
+   def save_wav(self, wav, root_dir, wav_num):
       if (wav is None):
          return # not ready yet
       else:
          print("saving wav file")
          outfile = '{}{}.wav'.format(root_dir, wav_num)
-         sif.audio.save_wav(wav, outfile, sr=sif.hparams.sample_rate)
+         sif.audio.save_wav(wav, outfile, sr=self.layout.shape.sample_rate)
 
    # Inspiration from here: https://gist.github.com/hadware/8882b980907901426266cb07bfbfcd20
-   def generate_wav_and_forward(self, images, mqtt_client, topic, qos):
-      '''
-      Generates wav files from batches of images and forwards them via MQTT
-      '''
-      wav = self.generate_wav(images)
+   def forward_wav(self, wav, mqtt_client, topic, qos, start_time=None, end_of_stream=False):
       if (wav is None):
          return # not ready yet
+      elif (args.audio_format == "pcm16"):
+         # Publish small chunks so that the player can start playing before the whole window arrived,
+         # their sequence numbers let it detect lost chunks
+         payloads = split_audio_messages(wav, self.layout.shape.sample_rate, self.chunk_samples,
+                                         stream_id=self.stream_id, first_sequence=self.sequence,
+                                         start_time=start_time, end_of_stream=end_of_stream)
+         print("forwarding audio via MQTT in " + str(len(payloads)) + " messages")
+         for payload in payloads:
+            mqtt_client.publish(topic, payload=payload, qos=qos)
+         self.sequence += len(payloads)
       else:
          print("forwarding wav file via MQTT")
          byte_io = io.BytesIO(bytes())
-         wavfile.write(byte_io, sif.hparams.sample_rate, wav)
-         wav_bytes = byte_io.read()
+         wavfile.write(byte_io, self.layout.shape.sample_rate, wav)
+         wav_bytes = byte_io.getvalue()
          mqtt_client.publish(topic, payload=wav_bytes, qos=qos)
 
+   def generate_wav_and_save(self, images, root_dir, wav_num, num_valid=None):
+      '''
+      Generates wav files from batches of images and saves the wav to an output file
+      '''
+      self.save_wav(self.generate_wav(images, num_valid), root_dir, wav_num)
 
-def process_faces():
-   # Initialize audio generator
-   generator = Generator(cpu_based = args.method_of_synthesis == "cpu")
+   def generate_wav_and_forward(self, images, mqtt_client, topic, qos, num_valid=None):
+      '''
+      Generates wav files from batches of images and forwards them via MQTT
+      '''
+      self.forward_wav(self.generate_wav(images, num_valid), mqtt_client, topic, qos)
+
+   def output_wav(self, wav, wav_num, start_time=None, end_of_stream=False):
+      '''
+      Saves or forwards a wav file depending on --wav_action
+      start_time (when the window was ready) and end_of_stream are only forwarded in pcm16 messages,
+      which are numbered per stream rather than per window
+      '''
+      if (args.wav_action == "save"):
+         self.save_wav(wav, WAVS_ROOT + self.wav_prefix, wav_num)
+      elif (args.wav_action == "forward"):
+         self.forward_wav(wav, sender_client, self.pub_topic, args.pub_qos, start_time, end_of_stream)
+
+
+class SynthesisWorker(object):
+   '''
+   State of a worker process (--workers): the models loaded by load_model() in the worker, and the
+   Generators of the streams dispatched to it, which turn their windows into wavs published by the
+   main process
+   '''
+   def __init__(self, num_workers):
+      super(SynthesisWorker, self).__init__()
+      # The cores are split between the workers, unless the preset sets the thread pools
+      if (not sif.hparams.intra_op_threads and not sif.hparams.inter_op_threads):
+         threads = max(1, os.cpu_count() // num_workers)
+         sif.hparams.set_hparam("intra_op_threads", threads)
+         sif.hparams.set_hparam("inter_op_threads", threads)
+      load_model()
+      self.generators = {}
+      # Shared ring of the frames of each stream, mapped from the main process
+      self.rings = {}
+
+   def ready(self):
+      return os.getpid()
+
+   def map_frames(self, stream_id, ref):
+      '''
+      Frames of a FrameRef on the shared ring of stream_id, mapped again once the ring is resized
+      '''
+      ring = self.rings.get(stream_id)
+      if (ring is None or ring.path != ref.path):
+         ring = self.rings[stream_id] = FrameRingBuffer.attach(ref)
+      return ring.window(ref.start, ref.length)
+
+   def generate_wav(self, stream_id, images, num_valid, start):
+      '''
+      Synthesizes a window of stream_id (its frames, or a FrameRef on them), returns its wav (None if
+      there is nothing to play) and the StreamHparams of the model of the stream, which the main
+      process sizes its next windows for
+      '''
+      if (isinstance(images, FrameRef)):
+         images = self.map_frames(stream_id, images)
+      generator = self.generators.get(stream_id)
+      if (generator is None):
+         generator = Generator(cpu_based=cpu_based, streaming=streaming,
+                               synthesizer=stream_synthesizer(stream_id), stream_id=stream_id)
+         self.generators[stream_id] = generator
+      shape = generator.model_shape()
+      if (shape != generator.layout.shape):
+         generator.set_layout(StreamLayout(shape))
+      try:
+         wav = generator.generate_wav(images, num_valid, start)
+      except WindowShapeError as e:
+         print("[" + stream_id + "] dropping window: " + str(e))
+         wav = None
+      return wav, shape
+
+   def close_stream(self, stream_id):
+      self.generators.pop(stream_id, None)
+      self.rings.pop(stream_id, None)
+
+   def control(self, payload):
+      on_control(payload)
+
+
+def start_workers():
+   '''
+   Starts the worker processes of --workers, which load their models while the main process connects
+   its clients (they are spawned, see synthesizer/workers.py, so they import this script again)
+   '''
+   global shared_workers
+   if (args.workers > 0):
+      shared_workers = WorkerPool(args.workers, SynthesisWorker, args.workers)
+
+def load_model():
+   global shared_synthesizer, shared_batcher, shared_pool
+
+   if (shared_workers is not None):
+      # The main process only publishes, wait for the workers to load and warm up their models
+      pids = [future.result() for future in shared_workers.broadcast("ready")]
+      startup.mark("warmup done")
+      print(str(len(pids)) + " synthesis workers ready (pids " + ", ".join(map(str, pids)) + ")")
+      return
+
+   # Initialize audio generator, its model is shared by the sessions of all streams
+   generator = Generator(cpu_based=cpu_based, streaming=streaming, layout=default_layout)
    generator.force_model_init()
+   startup.mark("warmup done")
+   shared_synthesizer = generator.synthesizer
+   shared_pool = ModelPool(new_synthesizer, cpu_based, shared_synthesizer,
+                           memory_budget=args.model_memory_mb * 2**20 if args.model_memory_mb > 0 else None)
+   # Fail at startup on a preset the streams cannot be sized for, the models are loaded on first use
+   for key in set(stream_speakers.values()):
+      StreamLayout(stream_hparams(shared_pool.hparams(key)))
+   if (batched):
+      shared_batcher = WindowBatcher(synthesize_shared_batch, max_batch_size=args.max_batch_size,
+                                     max_delay=args.max_batch_delay)
+
+
+def close_models():
+   if (shared_batcher is not None):
+      shared_batcher.close()
+   if (shared_pool is not None):
+      shared_pool.close()
+   if (shared_workers is not None):
+      shared_workers.close()
 
-   # Wait for messages until disconnected by system interrupt
+def process_faces():
+   start_workers()
+   # start clients, they connect in the background while the model is loaded (the receiver client
+   # subscribes to the topics once connected)
+   receiver_client.loop_start()
+   sender_client.loop_start()
+   load_model()
+   synthesizer_loaded.set()
+
+   # Wait for messages until disconnected by system interrupt, evicting the streams that went idle
+   startup.mark("ready")
+   print(startup.report())
    print("\n########################\n Ready to receive faces \n########################\n")
-   audio_sample_num = 1
-   num_frames = sif.hparams.T
-   while True:
-      print("queue size = " + str(face_queue.qsize()))
+   try:
+      while True:
+         time.sleep(1)
+         stream_sessions.evict_idle(args.session_timeout)
+   except KeyboardInterrupt:
+      stream_sessions.close_all()
+      close_models()
+      exit(0)
 
-      # Check to see if queue has enough frames
-      if (face_queue.qsize() >= num_frames):
-         print("reached " + str(num_frames) + " frames")
+async def serve(client_factory=AsyncMqttClient):
+   '''
+   Runs the asyncio runtime until interrupted, client_factory(client_id, host, port) creates its MQTT
+   clients (e.g. LocalBroker.client to run without a broker)
+   '''
+   global sender_client
+   loop = asyncio.get_event_loop()
+   start_workers()
 
-         # Fetch num_frames faces to process from the queue
-         faces_to_process = []
-         while (len(faces_to_process) != num_frames):
-            faces_to_process.append(face_queue.get(block=True))
+   # Windows are synthesized on this executor, the batcher needs several windows in flight to batch them
+   executor = ThreadPoolExecutor(max_workers=args.max_batch_size)
+   # Connect to the brokers while the model is loaded, but only subscribe once it is ready
+   receiver = client_factory(args.sub_client_name, args.sub_mqtt_host, args.sub_mqtt_port)
+   sender = client_factory(args.pub_client_name, args.pub_mqtt_host, args.pub_mqtt_port)
+   await asyncio.gather(loop.run_in_executor(executor, load_model), receiver.connect(), sender.connect())
+   sender_client = sender
+   receiver.subscribe([(args.sub_topic, args.sub_qos), (args.sub_topic + "/+", args.sub_qos),
+                       (args.control_topic, args.sub_qos)])
 
-         # Process frames and generate synthesized audio as wav file data
-         # Save as wav file or forward via mqtt
-         try:
-            if (args.wav_action == "save"):
-               generator.generate_wav_and_save(faces_to_process, WAVS_ROOT, audio_sample_num)
-            elif (args.wav_action == "forward"):
-               generator.generate_wav_and_forward(faces_to_process, sender_client, args.pub_topic, args.pub_qos)
+   sessions = {}
+   closing = set()
 
-            audio_sample_num += 1
-         except KeyboardInterrupt:
-            exit(0)
-         '''
-         except Exception as e:
-            print(e)
-            continue
-         '''
-
-# Run the process face function
-process_faces()
+   def close_session(session):
+      task = loop.create_task(session.close())
+      closing.add(task)
+      task.add_done_callback(closing.discard)
+
+   # Print the ingest stats and evict the streams that went idle every second
+   def on_tick():
+      nonlocal tick_timer
+      now = loop.time()
+      for stream_id, session in list(sessions.items()):
+         if (now - session.last_active > args.session_timeout):
+            print("evicting idle stream [" + stream_id + "]")
+            close_session(sessions.pop(stream_id))
+         else:
+            session.print_ingest_stats()
+      tick_timer = loop.call_later(1, on_tick)
+
+   async def on_message(topic, payload):
+      if (topic == args.control_topic):
+         on_control(payload)
+      else:
+         stream_id = stream_id_of(topic)
+         session = sessions.get(stream_id)
+         if (session is None):
+            print("new stream [" + stream_id + "], " + str(len(sessions) + 1) + " active streams")
+            session = AsyncStreamSession(stream_id, loop, executor)
+            sessions[stream_id] = session
+         await session.submit(payload)
+
+   stop = asyncio.Event()
+   for signum in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(signum, stop.set)
+   tick_timer = loop.call_later(1, on_tick)
+   ingest_task = loop.create_task(ingest(receiver, on_message))
+   stop_task = loop.create_task(stop.wait())
+
+   # Wait for messages until disconnected or interrupted
+   startup.mark("ready")
+   print(startup.report())
+   print("\n########################\n Ready to receive faces \n########################\n")
+   await asyncio.wait([ingest_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+   # Graceful shutdown: stop receiving, then drain the windows in flight before disconnecting the sender
+   print("shutting down, draining " + str(len(sessions)) + " streams")
+   tick_timer.cancel()
+   stop_task.cancel()
+   ingest_task.cancel()
+   await receiver.disconnect()
+   for session in sessions.values():
+      close_session(session)
+   if (closing):
+      await asyncio.wait(list(closing))
+   close_models()
+   await sender.disconnect()
+   executor.shutdown()
+
+
+def run_async():
+   loop = asyncio.get_event_loop()
+   loop.run_until_complete(serve())
+
+
+# Run the process face function (not in the worker processes, which import this script)
+if (__name__ == "__main__"):
+   if (args.runtime == "asyncio"):
+      run_async()
+   else:
+      process_faces()
@@ -0,0 +1,222 @@
+# Offline counterpart of audio_synthesizer.py: synthesizes whole Lip2Wav cut directories
+# (cut-N/<frame>.jpg, the layout replayed by fake_face_detector.py) without any broker
+import os
+from os import listdir, path
+import argparse
+import time
+from functools import partial
+from multiprocess.pool import Pool
+from tqdm import tqdm
+
+# Synthesizer imports
+from synthesizer import inference as sif
+from synthesizer.streaming import WindowStitcher
+import numpy as np
+import cv2
+
+##############
+# Parameters #
+##############
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=True)
+parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
+parser.add_argument("--source_directory", help="Either the full directory of cut directories or an individual cut directory", type=str, required=True)
+parser.add_argument("--results_root", help="Directory the wav files (one per cut) are written to", type=str, required=True)
+parser.add_argument("--method_of_synthesis", help="The method of synthesis to used (cpu-based, gpu-based or cpu-based with the quantized model of --quantized_model) to generate wav files", type=str, required=False, choices=["cpu", "gpu", "quantized"], default="gpu")
+parser.add_argument("--quantized_model", help="Path of the TFLite model converted by synthesizer/quantize.py, required if method_of_synthesis=='quantized'", type=str, required=False, default=None)
+parser.add_argument("--frozen_graph_dir", help="Directory caching the frozen inference graph of the checkpoint and preset", type=str, required=False, default=None)
+parser.add_argument("--xla_jit", help="Compile the model with the XLA JIT (falls back to the regular executor if the compilation fails)", action="store_true")
+parser.add_argument("--batch_size", help="Number of windows synthesized by a single model call", type=int, required=False, default=8)
+parser.add_argument("--decode_workers", help="Number of processes decoding and resizing the faces", type=int, required=False, default=os.cpu_count())
+parser.add_argument("--vocode_workers", help="Number of processes running Griffin-Lim in cpu mode", type=int, required=False, default=os.cpu_count())
+
+
+##############
+# Core Logic #
+##############
+
+def list_cut_directories(source_directory):
+   '''
+   Returns the (cut directory, cut number) tuples of source_directory in numerical order
+   Note that this is specific to how Lip2Wav preprocessing works on YouTube videos
+   '''
+   if ("cut" in os.path.basename(os.path.normpath(source_directory))):
+      # path to single cut directory with face frames specified
+      return [(source_directory, 0)]
+
+   # path to multiple cut directories each with own set of face frames specified
+   cutdirs_and_nums = [(path.join(source_directory, d), int(d[4:])) for d in listdir(source_directory) if os.path.isdir(path.join(source_directory, d))]
+   cutdirs_and_nums.sort(key=lambda x: x[1])
+   return cutdirs_and_nums
+
+def list_frames(cutdir):
+   '''
+   Returns the face image file names of a cut directory in numerical order
+   '''
+   fnames_and_nums = [(path.join(cutdir, f), int(f[0:-4])) for f in listdir(cutdir) if f[-4:] == ".jpg"]
+   fnames_and_nums.sort(key=lambda x: x[1])
+   return [fname for (fname, num) in fnames_and_nums]
+
+def load_face(fname, size):
+   '''
+   Decodes and resizes a face on a worker process, returns None for invalid files
+   '''
+   face = cv2.imread(fname, cv2.IMREAD_COLOR)
+   if np.shape(face) == ():
+      return None
+   return cv2.resize(face, (size, size))
+
+def num_mel_frames(num_images):
+   '''
+   Number of mel frames synthesized for num_images frames of a window
+   '''
+   return int(round(num_images * sif.hparams.mel_step_size / sif.hparams.T))
+
+def post_process_wav(wav):
+   wav *= 32767 / max(0.01, np.max(np.abs(wav)))
+   return wav
+
+def vocode_and_save(mel, outfile):
+   '''
+   Runs Griffin-Lim on the stitched mel spectrogram of a cut and saves it, on a worker process
+   '''
+   wav = post_process_wav(sif.Synthesizer.griffin_lim(mel))
+   sif.audio.save_wav(wav, outfile, sr=sif.hparams.sample_rate)
+   return outfile
+
+
+class CutWriter(object):
+   '''
+   Stitches the outputs of the overlapping windows of a cut, in the mel domain in cpu mode or in the
+   wav domain in gpu mode (where the graph already ran Griffin-Lim), and writes the cut's wav file
+   '''
+   def __init__(self, outfile, cpu_based, vocode_pool):
+      super(CutWriter, self).__init__()
+      self.outfile = outfile
+      self.cpu_based = cpu_based
+      self.vocode_pool = vocode_pool
+      self.chunks = []
+
+      # Consecutive windows overlap by hparams.overlap frames, i.e. hparams.mel_overlap mel frames
+      mel_hop = num_mel_frames(sif.hparams.T - sif.hparams.overlap)
+      self.unit = 1 if cpu_based else sif.audio.get_hop_size(sif.hparams)
+      self.stitcher = WindowStitcher(sif.hparams.mel_step_size * self.unit, mel_hop * self.unit,
+                                     sif.hparams.mel_overlap * self.unit)
+
+   def push(self, output, num_valid, is_last):
+      '''
+      Adds the model output of the next window, returns an AsyncResult once the wav file is being
+      vocoded (cpu mode), True once it is written (gpu mode) and None otherwise
+      '''
+      output = output[..., :self.stitcher.window_len]
+      valid_len = num_mel_frames(num_valid) * self.unit if num_valid != sif.hparams.T else None
+      self.chunks.append(self.stitcher.push(output, valid_len=valid_len))
+      if (not is_last):
+         return None
+
+      tail = self.stitcher.flush()
+      if (tail is not None):
+         self.chunks.append(tail)
+      stitched = np.concatenate(self.chunks, axis=-1)
+      self.chunks = []
+      if (self.cpu_based):
+         return self.vocode_pool.apply_async(vocode_and_save, (stitched, self.outfile))
+      sif.audio.save_wav(post_process_wav(stitched), self.outfile, sr=sif.hparams.sample_rate)
+      return True
+
+
+def windows_of(faces):
+   '''
+   Splits the faces of a cut into windows of hparams.T frames overlapping by hparams.overlap frames
+   Yields (window, number of real frames, is last window) tuples, the last window being padded
+   with its last real frame
+   '''
+   T = sif.hparams.T
+   hop = T - sif.hparams.overlap
+   start = 0
+   while True:
+      window = faces[start:start + T]
+      num_valid = len(window)
+      if (num_valid < T):
+         window = window + [window[-1]] * (T - num_valid)
+      is_last = start + T >= len(faces)
+      yield np.asarray(window, dtype=np.float32) / 255., num_valid, is_last
+      if (is_last):
+         break
+      start += hop
+
+
+def main():
+   args = parser.parse_args()
+   with open(args.preset) as f:
+      sif.hparams.parse_json(f.read()) ## add speaker-specific parameters
+   sif.hparams.set_hparam('eval_ckpt', args.checkpoint)
+   if (args.xla_jit):
+      sif.hparams.set_hparam('xla_jit', True)
+   if (args.method_of_synthesis == "quantized" and args.quantized_model is None):
+      parser.error("--quantized_model is required with --method_of_synthesis quantized")
+   cpu_based = args.method_of_synthesis in ("cpu", "quantized")
+   os.makedirs(args.results_root, exist_ok=True)
+
+   # The pools are forked before tensorflow is initialized (and after the preset is parsed)
+   decode_pool = Pool(args.decode_workers)
+   vocode_pool = Pool(args.vocode_workers) if cpu_based else None
+
+   synthesizer = sif.Synthesizer(verbose=False, frozen_graph_dir=args.frozen_graph_dir,
+                                 quantized_model=args.quantized_model if args.method_of_synthesis == "quantized" else None)
+   synthesizer.load(cpu_based=cpu_based)
+
+   cuts = list_cut_directories(args.source_directory)
+   load = partial(load_face, size=sif.hparams.img_size)
+   start = time.time()
+
+   # Windows of consecutive cuts are batched together, the next cut is decoded while the current
+   # one is synthesized
+   batch = []
+   pending_wavs = []
+   num_frames = 0
+   def run_batch():
+      outputs = synthesizer.synthesize_batch([window for (_, window, _, _) in batch], cpu_based=cpu_based)
+      for (writer, _, num_valid, is_last), output in zip(batch, outputs):
+         result = writer.push(output, num_valid, is_last)
+         if (result is not None):
+            pending_wavs.append(result)
+      del batch[:]
+
+   next_faces = decode_pool.map_async(load, list_frames(cuts[0][0])) if cuts else None
+   for i, (cutdir, dirnum) in enumerate(tqdm(cuts)):
+      faces = [face for face in next_faces.get() if face is not None]
+      if (i + 1 < len(cuts)):
+         next_faces = decode_pool.map_async(load, list_frames(cuts[i + 1][0]))
+      if (not faces):
+         print("skipping " + cutdir + ": no valid faces")
+         continue
+      num_frames += len(faces)
+
+      outfile = path.join(args.results_root, os.path.basename(os.path.normpath(cutdir)) + ".wav")
+      writer = CutWriter(outfile, cpu_based, vocode_pool)
+      for window, num_valid, is_last in windows_of(faces):
+         batch.append((writer, window, num_valid, is_last))
+         if (len(batch) == args.batch_size):
+            run_batch()
+   if (batch):
+      run_batch()
+
+   # Wait for the wav files still being vocoded
+   for result in pending_wavs:
+      if (result is not True):
+         result.get()
+   decode_pool.close()
+   if (vocode_pool is not None):
+      vocode_pool.close()
+
+   duration = time.time() - start
+   audio_duration = num_frames / sif.hparams.fps
+   print("synthesized {} cuts ({:.1f} s of video) in {:.1f} s ({:.1f}x real time)".format(
+      len(cuts), audio_duration, duration, audio_duration / max(duration, 1e-6)))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,235 @@
+from paho.mqtt.client import topic_matches_sub
+import paho.mqtt.client as mqtt
+import asyncio
+import traceback
+
+
+class AsyncMqttClient:
+    """Drives a paho MQTT client from an asyncio event loop instead of a loop_start() thread.
+
+    The client socket is watched with the reader/writer callbacks of the event loop and the
+    keepalive is handled by a task, so all the MQTT traffic is handled on the loop thread.
+    Received messages are queued and handed out by get_message(). Once max_pending messages are
+    queued the socket is not read anymore, which applies backpressure to the publishers until
+    the consumer catches up.
+
+    Like the loop_start() thread, the client reconnects when the connection is lost, waiting
+    min_reconnect_delay seconds before the first attempt and doubling the delay after every
+    failed one (up to max_reconnect_delay). The topics are subscribed again once reconnected.
+    """
+
+    def __init__(self, client_id, host, port=1883, max_pending=256, loop=None,
+                 min_reconnect_delay=1, max_reconnect_delay=120):
+        """
+        Args:
+            client_id: string, MQTT client id
+            host: string, host of the broker
+            port: integer, port of the broker
+            max_pending: integer, number of received messages queued before reading is paused
+            loop: event loop driving the client (defaults to the current event loop)
+            min_reconnect_delay: float, seconds before the first reconnection attempt
+            max_reconnect_delay: float, maximum number of seconds between two attempts
+        """
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._messages = asyncio.Queue()
+        self._connected = None
+        self._disconnected = asyncio.Event()
+        self._closing = False
+        self._reconnecting = None
+        self._reconnect_delay = min_reconnect_delay
+        self._subscriptions = []
+        self._misc = None
+        self._sock = None
+        self._paused = False
+
+        self._client = mqtt.Client(client_id)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    async def connect(self):
+        """
+        Connects to the broker, raises ConnectionError if the connection is refused.
+        """
+        self._connected = self._loop.create_future()
+        self._client.connect(self.host, self.port)
+        rc = await self._connected
+        if rc != 0:
+            raise ConnectionError("MQTT connection to {}:{} refused with code {}".format(
+                self.host, self.port, rc))
+
+    def subscribe(self, topics):
+        """
+        Args:
+            topics: list of (topic, qos) tuples, subscribed again after every reconnection
+        """
+        self._subscriptions.extend(topics)
+        self._client.subscribe(topics)
+
+    def publish(self, topic, payload=None, qos=0):
+        """
+        Publishes a message. Can be called from any thread, the message is sent from the loop.
+        """
+        self._loop.call_soon_threadsafe(self._client.publish, topic, payload, qos)
+
+    async def get_message(self):
+        """
+        :return: the next (topic, payload) tuple, or None once disconnect() was called
+        """
+        message = await self._messages.get()
+        if self._paused and self._messages.qsize() <= self.max_pending // 2:
+            self._paused = False
+            if self._sock is not None:
+                self._loop.add_reader(self._sock, self._client.loop_read)
+        return message
+
+    async def disconnect(self):
+        """
+        Disconnects from the broker once the messages already published are sent.
+        """
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        # Let the messages published from other threads reach the client first
+        await asyncio.sleep(0)
+        if self._sock is None:
+            self._closed()
+        else:
+            self._client.disconnect()
+        await self._disconnected.wait()
+
+    def _closed(self):
+        if not self._disconnected.is_set():
+            self._disconnected.set()
+            self._messages.put_nowait(None)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_result(rc)
+        elif rc == 0:
+            self._reconnect_delay = self.min_reconnect_delay
+            if self._subscriptions:
+                client.subscribe(self._subscriptions)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if self._closing:
+            self._closed()
+        elif self._reconnecting is None or self._reconnecting.done():
+            # Connection lost, unlike paho's own loop the event loop doesn't reconnect by itself
+            print("MQTT connection to {}:{} lost (code {}), reconnecting".format(self.host, self.port, rc))
+            self._reconnecting = self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._closing:
+            await asyncio.sleep(self._reconnect_delay)
+            # The delay keeps growing until the broker accepts a connection (see _on_connect)
+            self._reconnect_delay = min(2 * self._reconnect_delay, self.max_reconnect_delay)
+            try:
+                self._client.reconnect()
+                return
+            except (OSError, ValueError) as e:
+                print("MQTT reconnection to {}:{} failed ({}), next attempt in {} s".format(
+                    self.host, self.port, e, self._reconnect_delay))
+
+    def _on_message(self, client, userdata, message):
+        self._messages.put_nowait((message.topic, message.payload))
+        if not self._paused and self._messages.qsize() >= self.max_pending:
+            self._paused = True
+            self._loop.remove_reader(self._sock)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._sock = sock
+        if not self._paused:
+            self._loop.add_reader(sock, client.loop_read)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        self._sock = None
+        if self._misc is not None:
+            self._misc.cancel()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # Keepalive pings and retries of unacknowledged messages
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+async def ingest(client, on_message):
+    """
+    Hands the messages received by client to the coroutine on_message(topic, payload), one after
+    the other, until the client is disconnected. A failing message is logged and skipped.
+    """
+    while True:
+        message = await client.get_message()
+        if message is None:
+            return
+        try:
+            await on_message(*message)
+        except Exception:
+            traceback.print_exc()
+
+
+class LocalBroker:
+    """In-process stand-in for an MQTT broker, to run the asyncio runtime without a broker (e.g.
+    in tests). Its clients have the same interface as AsyncMqttClient, client() takes the same
+    arguments as its constructor so that it can be passed as the client factory of the runtime.
+    """
+
+    def __init__(self):
+        self._clients = []
+
+    def client(self, client_id=None, host=None, port=None, loop=None):
+        """
+        :return: a new LocalMqttClient connected to this broker once connect() is awaited
+        """
+        return LocalMqttClient(self, loop)
+
+    def _route(self, topic, payload):
+        for client in list(self._clients):
+            if any(topic_matches_sub(sub, topic) for sub in client.subscriptions):
+                client._deliver(topic, payload)
+
+
+class LocalMqttClient:
+    def __init__(self, broker, loop=None):
+        self.subscriptions = []
+        self._broker = broker
+        self._loop = loop or asyncio.get_event_loop()
+        self._messages = asyncio.Queue()
+
+    async def connect(self):
+        self._broker._clients.append(self)
+
+    def subscribe(self, topics):
+        self.subscriptions.extend(topic for topic, _ in topics)
+
+    def publish(self, topic, payload=None, qos=0):
+        self._loop.call_soon_threadsafe(self._broker._route, topic, payload)
+
+    async def get_message(self):
+        return await self._messages.get()
+
+    async def disconnect(self):
+        if self in self._broker._clients:
+            self._broker._clients.remove(self)
+        self._messages.put_nowait(None)
+
+    def _deliver(self, topic, payload):
+        self._loop.call_soon_threadsafe(self._messages.put_nowait, (topic, payload))
@@ -1,13 +1,14 @@
-import librosa
-import librosa.filters
 import numpy as np
 import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
 from profilehooks import timecall
 
+# librosa is slow to import, so it is only imported by the functions that use it
+
 
 def load_wav(path, sr):
+    import librosa
     return librosa.core.load(path, sr=sr)[0]
 
 def save_wav(wav, path, sr):
@@ -15,6 +16,7 @@ def save_wav(wav, path, sr):
     wavfile.write(path, sr, wav.astype(np.int16))
 
 def save_wavenet_wav(wav, path, sr):
+    import librosa
     librosa.output.write_wav(path, wav, sr=sr)
 
 def preemphasis(wav, k, preemphasize=True):
@@ -156,12 +158,14 @@ def _griffin_lim_tensorflow(S, hparams):
     return tf.squeeze(y, 0)
 
 def _stft(y, hparams):
+    import librosa
     if hparams.use_lws:
         return _lws_processor(hparams).stft(y).T
     else:
         return librosa.stft(y=y, n_fft=hparams.n_fft, hop_length=get_hop_size(hparams), win_length=hparams.win_size)
 
 def _istft(y, hparams):
+    import librosa
     return librosa.istft(y, hop_length=get_hop_size(hparams), win_length=hparams.win_size)
 
 def _stft_tensorflow(signals, hparams):
@@ -201,38 +205,42 @@ def librosa_pad_lr(x, fsize, fshift):
     return 0, (x.shape[0] // fshift + 1) * fshift - x.shape[0]
 
 # Conversions
-_mel_basis = None
-_inv_mel_basis = None
+# Mel bases of the hparams in use (the models of a process can have different presets), keyed by
+# _mel_basis_key
+_mel_basis = {}
+_inv_mel_basis = {}
+
+def _mel_basis_key(hparams):
+    return (hparams.sample_rate, hparams.n_fft, hparams.num_mels, hparams.fmin, hparams.fmax)
 
 def _linear_to_mel(spectogram, hparams):
-    global _mel_basis
-    if _mel_basis is None:
-        _mel_basis = _build_mel_basis(hparams)
-    return np.dot(_mel_basis, spectogram)
+    key = _mel_basis_key(hparams)
+    if key not in _mel_basis:
+        _mel_basis[key] = _build_mel_basis(hparams)
+    return np.dot(_mel_basis[key], spectogram)
 
 def _mel_to_linear(mel_spectrogram, hparams):
-    global _inv_mel_basis
-    if _inv_mel_basis is None:
-        _inv_mel_basis = np.linalg.pinv(_build_mel_basis(hparams))
-    return np.maximum(1e-10, np.dot(_inv_mel_basis, mel_spectrogram))
+    key = _mel_basis_key(hparams)
+    if key not in _inv_mel_basis:
+        _inv_mel_basis[key] = np.linalg.pinv(_build_mel_basis(hparams))
+    return np.maximum(1e-10, np.dot(_inv_mel_basis[key], mel_spectrogram))
 
 def _mel_to_linear_tensorflow(mel_spectrogram, hparams):
-    global _inv_mel_basis
-    #if _inv_mel_basis is None:
-    _inv_mel_basis = tf.linalg.pinv(_build_mel_basis_tensorflow(hparams))
-    #print(mel_spectrogram)
-    #print(_inv_mel_basis)
+    # A tensor of the graph being built, not to be cached with the numpy basis of _mel_to_linear
+    inv_mel_basis = tf.linalg.pinv(_build_mel_basis_tensorflow(hparams))
     mel_spectrogram= tf.reshape(mel_spectrogram, [hparams.num_mels,hparams.mel_step_size])   
-    x = tf.matmul(_inv_mel_basis, mel_spectrogram)
+    x = tf.matmul(inv_mel_basis, mel_spectrogram)
     #print(tf.shape(x))
     return tf.math.maximum(tf.ones(tf.shape(x)) * 1e-10, x)
 
 def _build_mel_basis(hparams):
+    import librosa.filters
     assert hparams.fmax <= hparams.sample_rate // 2
     return librosa.filters.mel(hparams.sample_rate, hparams.n_fft, n_mels=hparams.num_mels,
                                fmin=hparams.fmin, fmax=hparams.fmax)
 
 def _build_mel_basis_tensorflow(hparams):
+    import librosa.filters
     assert hparams.fmax <= hparams.sample_rate // 2
     return tf.convert_to_tensor(librosa.filters.mel(hparams.sample_rate, hparams.n_fft, n_mels=hparams.num_mels,
                                fmin=hparams.fmin, fmax=hparams.fmax), tf.float32)
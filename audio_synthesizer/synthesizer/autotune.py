@@ -0,0 +1,159 @@
+"""
+Sizes the thread pools of the inference session for the host it runs on.
+
+The autotune command sweeps (intra_op_threads, inter_op_threads) configurations against a
+synthetic window, measuring the latency of a single window and the throughput of a batch, and
+saves the best configuration as a profile keyed by the host name and the preset. Synthesizer.load
+applies the profile of the host and preset when it exists.
+
+On a Jetson the tensorflow default (one thread per core in each pool) competes for the cores with
+the MQTT clients, the decoding of the faces and Griffin-Lim, so fewer threads are usually faster.
+
+Usage: python -m synthesizer.autotune --checkpoint <ckpt> --preset <json> [--method_of_synthesis cpu|gpu]
+       [--objective latency|throughput] [--profile_dir <dir>] [--frozen_graph_dir <dir>]
+"""
+from synthesizer.infolog import log
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+import numpy as np
+
+# Bumped whenever the content of the profiles changes, to ignore the existing ones
+PROFILE_VERSION = 1
+
+
+def default_profile_dir(hparams):
+    """Profiles are saved next to the checkpoint by default."""
+    return os.path.join(os.path.dirname(hparams.eval_ckpt), "profiles")
+
+def profile_path(directory, hparams, cpu_based):
+    """
+    Path of the profile of this host for the preset in hparams and the (mel or wav) model.
+    """
+    # Imported here as synthesizer.export imports tensorflow
+    from synthesizer.export import RUNTIME_HPARAMS
+    values = {name: value for name, value in hparams.values().items() if name not in RUNTIME_HPARAMS}
+    key = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    name = "{}_{}_{}.json".format(socket.gethostname(), "mel" if cpu_based else "wav", key)
+    return os.path.join(directory, name)
+
+def load_profile(directory, hparams, cpu_based):
+    """
+    Returns the profile of this host and preset saved under directory, or None.
+    """
+    path = profile_path(directory, hparams, cpu_based)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    if profile.get("version") != PROFILE_VERSION:
+        return None
+    return profile
+
+def apply_profile(directory, hparams, cpu_based):
+    """
+    Returns the hparams to load the (mel or wav) model with: a copy of hparams with the thread
+    pools of the profile of this host and preset, or hparams itself if there is no profile or the
+    thread pools were set explicitly. hparams are left as is, the mel and wav models of a
+    synthesizer can have different profiles.
+    """
+    if hparams.intra_op_threads or hparams.inter_op_threads:
+        return hparams
+    profile = load_profile(directory, hparams, cpu_based)
+    if profile is None:
+        return hparams
+    profiled = type(hparams)(**hparams.values())
+    profiled.set_hparam("intra_op_threads", profile["intra_op_threads"])
+    profiled.set_hparam("inter_op_threads", profile["inter_op_threads"])
+    log("Thread profile applied: intra_op_threads=%d, inter_op_threads=%d" % (
+        profile["intra_op_threads"], profile["inter_op_threads"]))
+    return profiled
+
+def save_profile(directory, hparams, cpu_based, profile):
+    path = profile_path(directory, hparams, cpu_based)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dict(profile, version=PROFILE_VERSION), f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def candidates(num_cores):
+    """
+    (intra_op_threads, inter_op_threads) configurations swept, (0, 0) being the tensorflow default.
+    """
+    intra = sorted(set(n for n in (1, 2, 3, 4, 6, 8, num_cores) if n <= num_cores))
+    return [(0, 0)] + [(i, j) for i in intra for j in (1, 2) if j <= num_cores]
+
+def measure(synthesizer, cpu_based, window, runs, batch_size):
+    """
+    Returns (median seconds per single window, windows per second in batches of batch_size).
+    """
+    synthesizer.synthesize_batch([window], cpu_based=cpu_based)
+    latencies = []
+    for _ in range(runs):
+        start = time.time()
+        synthesizer.synthesize_batch([window], cpu_based=cpu_based)
+        latencies.append(time.time() - start)
+
+    batch = [window] * batch_size
+    synthesizer.synthesize_batch(batch, cpu_based=cpu_based)
+    start = time.time()
+    for _ in range(max(1, runs // batch_size)):
+        synthesizer.synthesize_batch(batch, cpu_based=cpu_based)
+    throughput = max(1, runs // batch_size) * batch_size / (time.time() - start)
+    return float(np.median(latencies)), throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweeps the thread pools of the inference session and saves the best profile for this host")
+    parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=True)
+    parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
+    parser.add_argument("--method_of_synthesis", help="Tune the cpu-based (mel) or gpu-based (wav) model", type=str, required=False, choices=["cpu", "gpu"], default="gpu")
+    parser.add_argument("--objective", help="Keep the configuration with the lowest single window latency or the highest batch throughput", type=str, required=False, choices=["latency", "throughput"], default="latency")
+    parser.add_argument("--windows", help="Number of timed windows per configuration", type=int, required=False, default=10)
+    parser.add_argument("--batch_size", help="Number of windows per batch when measuring the throughput", type=int, required=False, default=4)
+    parser.add_argument("--profile_dir", help="Directory the profile is saved to (defaults to <checkpoint directory>/profiles)", type=str, required=False, default=None)
+    parser.add_argument("--frozen_graph_dir", help="Tune the frozen graph cached in this directory (much faster to reload for each configuration)", type=str, required=False, default=None)
+    args = parser.parse_args()
+
+    from synthesizer import inference as sif
+    with open(args.preset) as f:
+        sif.hparams.parse_json(f.read())
+    sif.hparams.set_hparam("eval_ckpt", args.checkpoint)
+    cpu_based = args.method_of_synthesis == "cpu"
+    profile_dir = args.profile_dir or default_profile_dir(sif.hparams)
+    window = np.random.RandomState(0).uniform(
+        size=(sif.hparams.T, sif.hparams.img_size, sif.hparams.img_size, 3)).astype(np.float32)
+
+    sweep = []
+    for intra_op_threads, inter_op_threads in candidates(os.cpu_count()):
+        sif.hparams.set_hparam("intra_op_threads", intra_op_threads)
+        sif.hparams.set_hparam("inter_op_threads", inter_op_threads)
+        synthesizer = sif.Synthesizer(verbose=False, frozen_graph_dir=args.frozen_graph_dir, thread_profile_dir=False)
+        synthesizer.load(cpu_based=cpu_based)
+        latency, throughput = measure(synthesizer, cpu_based, window, args.windows, args.batch_size)
+        # With a shared graph the session tuned is that of the wav model, see Synthesizer.load
+        profile_cpu_based = cpu_based and not synthesizer.shared_graph
+        synthesizer.close()
+        sweep.append({"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads,
+                      "latency": latency, "throughput": throughput})
+        print("intra_op_threads={:<3} inter_op_threads={:<3} latency {:7.1f} ms  throughput {:6.2f} windows/s".format(
+            intra_op_threads, inter_op_threads, latency * 1000, throughput))
+
+    if args.objective == "latency":
+        best = min(sweep, key=lambda result: (result["latency"], -result["throughput"]))
+    else:
+        best = max(sweep, key=lambda result: (result["throughput"], -result["latency"]))
+    profile = dict(best, objective=args.objective, host=socket.gethostname(), sweep=sweep)
+    path = save_profile(profile_dir, sif.hparams, profile_cpu_based, profile)
+    print("best: intra_op_threads={} inter_op_threads={}, saved to {}".format(
+        best["intra_op_threads"], best["inter_op_threads"], path))
+
+
+if __name__ == "__main__":
+    main()
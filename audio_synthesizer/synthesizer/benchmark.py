@@ -0,0 +1,79 @@
+"""
+Per-window latency of the inference model, with and without the XLA JIT (hparams.xla_jit), and
+with the windows fed through a feed_dict (Session.run) or through make_callable (the default, see
+session.WindowCallable). The difference between the last two is the python overhead saved.
+
+Usage: python -m synthesizer.benchmark --checkpoint <ckpt> --preset <json> [--method_of_synthesis cpu|gpu]
+       [--cpu_only] [--windows 20] [--batch_size 1] [--frozen_graph_dir <dir>]
+"""
+import argparse
+import os
+import time
+import numpy as np
+
+
+def measure(synthesizer, cpu_based, windows, runs):
+    """
+    Returns the latencies (in seconds) of runs synthesis calls on a batch of windows, after a
+    warmup call.
+    """
+    synthesizer.synthesize_batch(windows, cpu_based=cpu_based)
+    latencies = []
+    for _ in range(runs):
+        start = time.time()
+        synthesizer.synthesize_batch(windows, cpu_based=cpu_based)
+        latencies.append(time.time() - start)
+    return np.asarray(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the per-window latency with and without the XLA JIT, and with and without make_callable")
+    parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=True)
+    parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
+    parser.add_argument("--method_of_synthesis", help="Benchmark the cpu-based (mel) or gpu-based (wav) model", type=str, required=False, choices=["cpu", "gpu"], default="cpu")
+    parser.add_argument("--cpu_only", help="Hide the GPUs from tensorflow to benchmark on the CPU", action="store_true")
+    parser.add_argument("--windows", help="Number of timed windows per configuration", type=int, required=False, default=20)
+    parser.add_argument("--batch_size", help="Number of windows per synthesis call", type=int, required=False, default=1)
+    parser.add_argument("--frozen_graph_dir", help="Benchmark the frozen graph cached in this directory", type=str, required=False, default=None)
+    args = parser.parse_args()
+
+    # Must be set before tensorflow is initialized
+    if args.cpu_only:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    from synthesizer import inference as sif
+
+    with open(args.preset) as f:
+        sif.hparams.parse_json(f.read())
+    sif.hparams.set_hparam("eval_ckpt", args.checkpoint)
+    cpu_based = args.method_of_synthesis == "cpu"
+    random = np.random.RandomState(0)
+    windows = [random.uniform(size=(sif.hparams.T, sif.hparams.img_size, sif.hparams.img_size, 3)).astype(np.float32)
+               for _ in range(args.batch_size)]
+
+    results = []
+    for xla_jit in (False, True):
+        sif.hparams.set_hparam("xla_jit", xla_jit)
+        synthesizer = sif.Synthesizer(verbose=False, frozen_graph_dir=args.frozen_graph_dir)
+        synthesizer.load(cpu_based=cpu_based)
+        # With a shared graph, the CPU-based method runs on the wav model
+        model = synthesizer._model_tacotron2 if cpu_based and not synthesizer.shared_graph else synthesizer._model_tacotron_tpg
+        jit_name = "xla_jit" if model.xla_jit else "no_jit" if not xla_jit else "no_jit (jit failed)"
+        for use_callable in (False, True):
+            model.use_callable = use_callable
+            latencies = measure(synthesizer, cpu_based, windows, args.windows) / args.batch_size
+            results.append(("{} {}".format(jit_name, "callable" if use_callable else "feed_dict"), latencies))
+        synthesizer.close()
+
+    window_duration = sif.hparams.T / sif.hparams.fps
+    print("{:<30} {:>10} {:>10} {:>10} {:>10}".format("", "mean (ms)", "p50 (ms)", "p95 (ms)", "x real time"))
+    for name, latencies in results:
+        print("{:<30} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.2f}".format(
+            name, latencies.mean() * 1000, np.percentile(latencies, 50) * 1000,
+            np.percentile(latencies, 95) * 1000, window_duration / latencies.mean()))
+    for feed_dict, callable_ in zip(results[::2], results[1::2]):
+        print("{:<30} {:>10.2f} ms per window saved by make_callable".format(
+            callable_[0].rsplit(" ", 1)[0], (feed_dict[1].mean() - callable_[1].mean()) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import pytest
+
+
+class StubSynthesizer:
+    """Stands in for a loaded Synthesizer, its outputs are the checkpoint of its hparams."""
+
+    def __init__(self, hparams, closed):
+        self.hparams = hparams
+        self._closed = closed
+
+    def load(self, cpu_based=True):
+        pass
+
+    def synthesize_batch(self, windows, cpu_based=True, encoder_features=None):
+        return [self.hparams.eval_ckpt for _ in windows]
+
+    def close(self):
+        self._closed.append(self.hparams.eval_ckpt)
+
+
+@pytest.fixture
+def closed():
+    """Checkpoints of the stub models closed by the test, in order."""
+    return []
+
+@pytest.fixture
+def new_synthesizer(closed):
+    """Factory of stub models from their hparams."""
+    return lambda hparams: StubSynthesizer(hparams, closed)
@@ -0,0 +1,244 @@
+"""
+Frozen inference graphs: the restored model is folded into a single GraphDef (variables turned
+into constants, training and unused nodes pruned) that is imported directly on the next startup,
+instead of rebuilding the model in python and restoring the checkpoint.
+
+The artifact is keyed by the checkpoint and the preset, so a new checkpoint or preset is exported
+again instead of silently reusing a stale graph.
+
+The exported graph is optimized for inference (constants folded, batch normalizations folded
+into the encoder convolutions, see synthesizer/optimize.py), unless the optimized encoder does not
+match the original one.
+
+Usage: python -m synthesizer.export --checkpoint <ckpt> --preset <json> --output_dir <dir> [--mel_only]
+"""
+from synthesizer.infolog import log
+from synthesizer.utils import startup
+from synthesizer.session import open_session, WindowCallable
+from synthesizer import audio, optimize
+import tensorflow as tf
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+
+# Bumped whenever the exported nodes change, to invalidate the existing artifacts
+FORMAT_VERSION = 4
+# Hparams that do not change the exported graph
+RUNTIME_HPARAMS = ("eval_ckpt", "xla_jit", "intra_op_threads", "inter_op_threads")
+
+# Names given to the placeholders and outputs in tacotron2.py and tacotron_tpg.py
+INPUT_NAMES = ("inputs", "input_lengths", "speaker_embeddings")
+MEL_OUTPUT_NAMES = ("mel_outputs", "alignments")
+WAV_OUTPUT_NAME = "wav_outputs"
+# Deterministic (unlike the outputs of the decoder, whose prenet dropout is also active at
+# inference), the optimized graph is checked against the original one on this output
+ENCODER_OUTPUT_NAME = "encoder_outputs"
+# Encoder convolution features of a chunk of frames, and the features the model can be fed instead
+# of computing them (created in the scope of the model by TacotronEncoderCell)
+ENCODER_CHUNK_NAMES = ("encoder_chunk", "encoder_chunk_features")
+ENCODER_CONV_FEATURES_NAME = "Tacotron_model/inference/encoder_conv_features"
+# Tolerance of the check, relative to the largest encoder output
+VERIFY_TOLERANCE = 1e-4
+# Ops calling back into python, which a GraphDef can not hold (the split of the inputs across
+# several towers, see models/tacotron.py)
+PY_FUNC_OPS = ("PyFunc", "PyFuncStateless", "EagerPyFunc")
+
+
+def output_node_names(with_wav):
+    return (list(MEL_OUTPUT_NAMES) + ([WAV_OUTPUT_NAME] if with_wav else [])
+            + [ENCODER_OUTPUT_NAME, ENCODER_CHUNK_NAMES[1]])
+
+def frozen_graph_path(directory, hparams, with_wav):
+    """
+    Path of the frozen graph of the checkpoint hparams.eval_ckpt under directory.
+    The key covers the checkpoint (the .index file holds the checksum of every saved tensor), the
+    preset (all the hparams but RUNTIME_HPARAMS), the tensorflow version and the outputs.
+    """
+    key = hashlib.sha1()
+    with open(hparams.eval_ckpt + ".index", "rb") as f:
+        key.update(f.read())
+    values = {name: value for name, value in hparams.values().items() if name not in RUNTIME_HPARAMS}
+    key.update(json.dumps(values, sort_keys=True, default=str).encode("utf-8"))
+    key.update("{}:{}:{}".format(tf.__version__, with_wav, FORMAT_VERSION).encode("utf-8"))
+    name = "tacotron_{}_{}.pb".format("wav" if with_wav else "mel", key.hexdigest()[:16])
+    return os.path.join(directory, name)
+
+def verification_feed(graph):
+    """
+    Feed of a random window for the placeholders of the model in graph.
+    """
+    window_shape = graph.get_tensor_by_name(INPUT_NAMES[0] + ":0").shape.as_list()[1:]
+    embedding_size = graph.get_tensor_by_name(INPUT_NAMES[2] + ":0").shape.as_list()[1]
+    return {
+        INPUT_NAMES[0] + ":0": np.random.RandomState(0).uniform(size=[1] + window_shape).astype(np.float32),
+        INPUT_NAMES[1] + ":0": np.asarray([window_shape[0]], dtype=np.int32),
+        INPUT_NAMES[2] + ":0": np.zeros([1, embedding_size], dtype=np.float32),
+    }
+
+def optimize_frozen(frozen, with_wav, feed_dict):
+    """
+    Returns the optimized frozen graph, or frozen itself if the encoder outputs of the optimized
+    graph do not match the original ones on feed_dict.
+    """
+    optimized = optimize.optimize_for_inference(frozen, output_node_names(with_wav))
+    error, magnitude, before, after = optimize.compare(frozen, optimized, feed_dict, [ENCODER_OUTPUT_NAME + ":0"])
+    log("Optimized graph: %d -> %d nodes, encoder %.1f -> %.1f ms, max error %.2e" % (
+        len(frozen.node), len(optimized.node), before * 1000, after * 1000, error))
+    if (error > VERIFY_TOLERANCE * max(magnitude, 1.)):
+        log("Optimized encoder does not match the original one, keeping the original graph")
+        return frozen
+    return optimized
+
+def freeze(session, path, with_wav, optimized=True):
+    """
+    Freezes the model restored in session into path. The devices are cleared so that the graph
+    can be placed on whatever the loading host has.
+    Raises ValueError if the outputs depend on a python function (models with
+    tacotron_num_gpus > 1), the frozen graph could not be imported again.
+    """
+    graph_def = session.graph.as_graph_def()
+    for node in graph_def.node:
+        node.device = ""
+    frozen = tf.graph_util.convert_variables_to_constants(session, graph_def, output_node_names(with_wav))
+    py_funcs = [node.name for node in frozen.node if node.op in PY_FUNC_OPS]
+    if (py_funcs):
+        raise ValueError("Can not freeze a model whose outputs depend on python functions (%s), "
+                         "export it with tacotron_num_gpus=1" % ", ".join(py_funcs))
+    if (optimized):
+        frozen = optimize_frozen(frozen, with_wav, verification_feed(session.graph))
+
+    # Written next to its final path and renamed, a crash never leaves a truncated artifact
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with tf.gfile.GFile(tmp_path, "wb") as f:
+        f.write(frozen.SerializeToString())
+    os.replace(tmp_path, path)
+    log("Frozen graph written to %s (%d nodes)" % (path, len(frozen.node)))
+    return path
+
+
+class FrozenTacotron:
+    """
+    Mel spectrogram model imported from a frozen graph, with the synthesis API of Tacotron2.
+    """
+    with_wav = False
+
+    def __init__(self, path, hparams):
+        log("Loading frozen graph: %s" % path)
+        self._hparams = hparams
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs, self.input_lengths, self.speaker_embeddings = [
+            self.graph.get_tensor_by_name(name + ":0") for name in INPUT_NAMES]
+        self.outputs = [self.graph.get_tensor_by_name(name + ":0")
+                        for name in MEL_OUTPUT_NAMES + ((WAV_OUTPUT_NAME,) if self.with_wav else ())]
+        self.encoder_chunk, self.encoder_chunk_features = [
+            self.graph.get_tensor_by_name(name + ":0") for name in ENCODER_CHUNK_NAMES]
+        self.encoder_conv_features = self.graph.get_tensor_by_name(ENCODER_CONV_FEATURES_NAME + ":0")
+        startup.mark("graph imported")
+
+        def check(session):
+            window = np.zeros((hparams.T, hparams.img_size, hparams.img_size, 3), dtype=np.float32)
+            session.run(self.outputs, feed_dict=self.my_synthesize_prep_input([window]))
+        self.session, self.xla_jit = open_session(hparams, graph=self.graph, check=check)
+
+        # Windows are run through make_callable, unless use_callable is cleared (to compare both)
+        self.use_callable = True
+        placeholders = (self.inputs, self.input_lengths, self.speaker_embeddings)
+        self._synthesize_mels_callable = WindowCallable(self.session, self.outputs[:len(MEL_OUTPUT_NAMES)], *placeholders)
+        if self.with_wav:
+            self._synthesize_callable = WindowCallable(self.session, self.outputs[-1], *placeholders)
+        print ("LOADED MODEL")
+
+    def my_synthesize_prep_input(self, windows):
+        # Same feed as Tacotron2 but split_infos, which the frozen graph does not use
+        input_seqs = np.asarray(windows[0])[np.newaxis] if len(windows) == 1 else np.stack(windows)
+        return {
+            self.inputs: input_seqs,
+            self.input_lengths: np.asarray([len(seqs) for seqs in windows], dtype=np.int32),
+            self.speaker_embeddings: np.zeros([len(windows), 256], dtype=np.float32),
+        }
+
+    def my_encoder_features(self, chunk):
+        return self.session.run(self.encoder_chunk_features,
+                                feed_dict={self.encoder_chunk: np.asarray(chunk)[np.newaxis]})[0]
+
+    def my_synthesize_feed(self, windows, encoder_features=None):
+        feed_dict = self.my_synthesize_prep_input(windows)
+        if encoder_features is not None:
+            feed_dict[self.encoder_conv_features] = np.asarray(encoder_features)
+        return feed_dict
+
+    def my_synthesize(self, seqs):
+        return self.my_synthesize_batch([seqs])
+
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the mel spectrograms of a batch of windows with a single session.run.
+        """
+        if self.use_callable and encoder_features is None:
+            mels, alignments = self._synthesize_mels_callable(windows)
+        else:
+            mels, alignments = self.session.run(self.outputs[:len(MEL_OUTPUT_NAMES)],
+                                                feed_dict=self.my_synthesize_feed(windows, encoder_features))
+        return [mel.T for mel in mels], alignments
+
+
+class FrozenTacotronTpg(FrozenTacotron):
+    """
+    Wav model (Griffin-Lim in the graph) imported from a frozen graph, with the synthesis API of
+    the Tacotron2 of tacotron_tpg.py.
+    """
+    with_wav = True
+
+    def my_synthesize(self, seqs):
+        return self.my_synthesize_batch([seqs])[0]
+
+    # The mel outputs are also in the graph, see tacotron_tpg.MelModel
+    my_synthesize_mels_batch = FrozenTacotron.my_synthesize_batch
+
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the wavs of a batch of windows with a single session.run.
+        """
+        if self.use_callable and encoder_features is None:
+            wavs = self._synthesize_callable(windows)
+        else:
+            wavs = self.session.run(self.outputs[-1], feed_dict=self.my_synthesize_feed(windows, encoder_features))
+        return [audio.inv_preemphasis(wav, self._hparams.preemphasis, self._hparams.preemphasize)
+                for wav in wavs]
+
+
+def main():
+    # Imported here as synthesizer.inference imports this module
+    from synthesizer.hparams import hparams
+    from synthesizer.tacotron2 import Tacotron2
+    from synthesizer.tacotron_tpg import Tacotron2 as Tacotron_tpg
+
+    parser = argparse.ArgumentParser(description="Freezes a checkpoint into an inference graph")
+    parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=True)
+    parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
+    parser.add_argument("--output_dir", help="Directory the frozen graph is written to", type=str, required=True)
+    parser.add_argument("--mel_only", help="Only export the mel outputs, not the Griffin-Lim wav output (the separate mel model of Synthesizer(shared_graph=False) and synthesizer/quantize.py)", action="store_true")
+    parser.add_argument("--no_optimize", help="Export the frozen graph as is, without folding its constants and batch normalizations", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.preset) as f:
+        hparams.parse_json(f.read())
+    hparams.set_hparam("eval_ckpt", args.checkpoint)
+
+    with_wav = not args.mel_only
+    model = (Tacotron_tpg if with_wav else Tacotron2)(None, hparams)
+    print(freeze(model.session, frozen_graph_path(args.output_dir, hparams, with_wav), with_wav,
+                 optimized=not args.no_optimize))
+
+
+if __name__ == "__main__":
+    main()
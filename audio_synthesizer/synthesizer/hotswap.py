@@ -0,0 +1,182 @@
+"""
+Replaces the model of a running synthesizer (a new checkpoint and preset) without restarting it.
+
+SwappableSynthesizer stands in for the Synthesizer shared by the streams. A swap loads the new
+model in a graph and session of its own while the current one keeps synthesizing, warms it up,
+then swaps it in between two calls: every call (a window, or a batch of windows) runs on a single
+model. The previous model is closed once its last call returns.
+
+A swap may change the hparams that shape the streams (STREAM_HPARAMS): the streams compare them
+between two windows and rebuild their buffers for the new model, their audio then starts a new
+stream.
+"""
+from synthesizer.infolog import log
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import threading
+import traceback
+
+# Hparams that shape the windows and the audio of the streams
+STREAM_HPARAMS = ("T", "img_size", "fps", "overlap", "mel_step_size", "mel_overlap", "num_mels",
+                  "sample_rate", "hop_size", "frame_shift_ms")
+StreamHparams = namedtuple("StreamHparams", STREAM_HPARAMS)
+# Hparams set at runtime (from the command line, or the thread pools of a worker process) that carry
+# over to the new model, unless its preset sets them
+CARRIED_HPARAMS = ("xla_jit", "intra_op_threads", "inter_op_threads")
+
+
+def load_hparams(preset_path, checkpoint, current=None):
+    """
+    Returns new hparams: the defaults, updated with the preset at preset_path and the checkpoint
+    (and with the CARRIED_HPARAMS of current hparams if given). The global hparams are left as is.
+    """
+    # Imported here as they import tensorflow
+    from synthesizer.hparams import default_values
+    from tensorflow.contrib.training import HParams
+    hparams = HParams(**default_values)
+    if current is not None:
+        for name in CARRIED_HPARAMS:
+            hparams.set_hparam(name, getattr(current, name))
+    with open(preset_path) as f:
+        hparams.parse_json(f.read())
+    hparams.set_hparam("eval_ckpt", checkpoint)
+    return hparams
+
+def stream_hparams(hparams):
+    """
+    The STREAM_HPARAMS of hparams, as a StreamHparams (comparable, and picklable to be sent
+    between processes).
+    """
+    return StreamHparams(*(getattr(hparams, name) for name in STREAM_HPARAMS))
+
+
+class SwappableSynthesizer:
+    """
+    Synthesizer whose model can be swapped while it is in use, with the synthesis API of
+    Synthesizer.
+    """
+
+    def __init__(self, synthesizer, cpu_based, factory):
+        """
+        Args:
+            synthesizer: the Synthesizer used until the first swap
+            cpu_based: the method of synthesis the models are loaded and warmed up for
+            factory: callable, returns a new (not loaded) Synthesizer from hparams and the keyword
+            arguments given to swap
+        """
+        self.cpu_based = cpu_based
+        self._factory = factory
+        self._synthesizer = synthesizer
+        # Number of calls in flight per synthesizer, a retired synthesizer is closed at 0
+        self._calls = {synthesizer: 0}
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        # Incremented by each swap, state derived from the outputs of a model (the cached encoder
+        # features of the streams) is dropped when it changes
+        self.generation = 0
+
+    @property
+    def hparams(self):
+        return self._synthesizer.hparams
+
+    @contextmanager
+    def pinned(self):
+        """
+        Context yielding (synthesizer, generation) of the current model, which is not closed
+        before the context exits, to run several calls on the same model.
+        """
+        with self._lock:
+            synthesizer, generation = self._synthesizer, self.generation
+            self._calls[synthesizer] += 1
+        try:
+            yield synthesizer, generation
+        finally:
+            with self._lock:
+                self._calls[synthesizer] -= 1
+                closed = synthesizer in self._retired and self._calls[synthesizer] == 0
+                if closed:
+                    self._retired.discard(synthesizer)
+                    del self._calls[synthesizer]
+            if closed:
+                synthesizer.close()
+                log("Previous model released")
+
+    def is_loaded(self, cpu_based=True):
+        return self._synthesizer.is_loaded(cpu_based)
+
+    def load(self, cpu_based=True):
+        self._synthesizer.load(cpu_based)
+
+    def synthesize_spectrograms(self, faces, return_alignments=False):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_spectrograms(faces, return_alignments)
+
+    def synthesize_wavs(self, faces, return_alignments=False):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_wavs(faces, return_alignments)
+
+    def synthesize_batch(self, windows, cpu_based=True, encoder_features=None):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_batch(windows, cpu_based, encoder_features)
+
+    def encoder_features(self, frames, cpu_based=True):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.encoder_features(frames, cpu_based)
+
+    def griffin_lim(self, mel, hparams=None):
+        """
+        Vocodes mel with the hparams of the model that synthesized it (the current one if None),
+        the model can be swapped in between.
+        """
+        from synthesizer.inference import Synthesizer
+        return Synthesizer.griffin_lim(mel, self.hparams if hparams is None else hparams)
+
+    def swap(self, checkpoint, preset, **kwargs):
+        """
+        Loads the model of checkpoint and preset, warms it up and swaps it in. Blocks until the new
+        model is in use, the current one keeps serving the calls in the meantime.
+        Raises ValueError if the factory refuses the hparams of the preset.
+        """
+        with self._swap_lock:
+            hparams = load_hparams(preset, checkpoint, self.hparams)
+
+            log("Loading model for swap: %s" % checkpoint)
+            synthesizer = self._factory(hparams, **kwargs)
+            synthesizer.load(cpu_based=self.cpu_based)
+            window = np.full((hparams.T, hparams.img_size, hparams.img_size, 3), 0.5, dtype=np.float32)
+            synthesizer.synthesize_batch([window], cpu_based=self.cpu_based)
+
+            with self._lock:
+                previous = self._synthesizer
+                self._synthesizer = synthesizer
+                self._calls[synthesizer] = 0
+                self.generation += 1
+                closed = self._calls[previous] == 0
+                if closed:
+                    del self._calls[previous]
+                else:
+                    self._retired.add(previous)
+            if closed:
+                previous.close()
+            log("Swapped in model: %s" % checkpoint)
+
+    def start_swap(self, checkpoint, preset, **kwargs):
+        """
+        Swaps the model from a background thread, failures are logged.
+        """
+        def run():
+            try:
+                self.swap(checkpoint, preset, **kwargs)
+            except Exception:
+                log("Model swap failed:\n%s" % traceback.format_exc())
+        thread = threading.Thread(target=run, name="model-swap", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        with self._lock:
+            synthesizers = list(self._calls)
+        for synthesizer in synthesizers:
+            synthesizer.close()
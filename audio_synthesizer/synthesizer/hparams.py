@@ -340,8 +340,23 @@ hparams = HParams(
     mel_step_size=240,
     img_size=96,
     fps=30,
+
+    # Inference
+    alignment_history=False,
+    # Whether to record the attention alignments of every decoder step at inference (the
+    # "alignments" output, empty otherwise). Always recorded in training, evaluation and GTA
+    xla_jit=False,
+    # Whether to compile the inference graph with the XLA JIT. The regular executor is used if
+    # the compilation fails (see synthesizer/session.py)
+    intra_op_threads=0,
+    inter_op_threads=0,
+    # Thread pools of the inference session, 0 lets tensorflow pick (one thread per core). Set
+    # from the profile saved by synthesizer/autotune.py when it exists
 )
 
+# The defaults, before any preset is parsed into hparams (see synthesizer/hotswap.py)
+default_values = hparams.values()
+
 
 def hparams_debug_string():
     values = hparams.values()
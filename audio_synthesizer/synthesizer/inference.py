@@ -1,16 +1,15 @@
 from synthesizer.tacotron2 import Tacotron2 # CPU-based
 from synthesizer.tacotron_tpg import Tacotron2 as Tacotron_tpg # GPU-Based
+from synthesizer.tacotron_tpg import MelModel
 
 from synthesizer.hparams import hparams
-from multiprocess.pool import Pool  # You're free to use either one
-#from multiprocessing import Pool   # 
-from synthesizer import audio
+from synthesizer.infolog import log
+from synthesizer import audio, autotune, export, quantize
 from pathlib import Path
-from typing import Union, List
+from typing import Union
 import tensorflow as tf
 import numpy as np
-import numba.cuda
-import librosa
+import os
 from profilehooks import timecall
 
 
@@ -18,7 +17,8 @@ class Synthesizer:
     sample_rate = hparams.sample_rate
     hparams = hparams
     
-    def __init__(self, verbose=True, low_mem=False, manual_inference=False):
+    def __init__(self, verbose=True, low_mem=False, manual_inference=False, frozen_graph_dir=None,
+                 thread_profile_dir=None, quantized_model=None, shared_graph=True, hparams=None):
         """
         Creates a synthesizer ready for inference. The actual model isn't loaded in memory until
         needed or until load() is called.
@@ -29,9 +29,30 @@ class Synthesizer:
         :param low_mem: if True, the model will be loaded in a separate process and its resources 
         will be released after each usage. Adds a large overhead, only recommended if your GPU 
         memory is low (<= 2gb)
+        :param frozen_graph_dir: if set, the model is imported from the frozen graph of the
+        checkpoint and preset cached in this directory, which is exported on the first load
+        :param thread_profile_dir: directory of the thread profiles saved by synthesizer/autotune.py
+        (next to the checkpoint if None), the profile of the host and preset is applied on load.
+        False disables the profiles
+        :param quantized_model: path of a TFLite model converted by synthesizer/quantize.py, used
+        instead of the CPU-based model
+        :param shared_graph: the CPU-based (mel) and GPU-based (wav) methods run the same graph
+        and session, that of the GPU-based model, so using both loads the weights once and
+        switching between them costs nothing. Each call only fetches the outputs of its method.
+        False builds a separate mel model for the CPU-based method (the model exported and
+        quantized by synthesizer/quantize.py)
+        :param hparams: hyper-parameters of the model (the global hparams if None). The model is
+        built in a graph of its own, so synthesizers with different checkpoints and presets can be
+        loaded side by side (see synthesizer/hotswap.py)
         """
         self.verbose = verbose
         self._low_mem = low_mem
+        self.frozen_graph_dir = frozen_graph_dir
+        self.thread_profile_dir = thread_profile_dir
+        self.quantized_model = quantized_model
+        self.shared_graph = shared_graph
+        if hparams is not None:
+            self.hparams = hparams
         
         # Prepare the model
         self._model_tacotron2 = None  # type: Tacotron2
@@ -66,12 +87,66 @@ class Synthesizer:
         """
         if self._low_mem:
             raise Exception("Cannot load the synthesizer permanently in low mem mode")
-        tf.reset_default_graph()
-        if (cpu_based):
-            self._model_tacotron2 = Tacotron2(None, hparams)
-        else:
-            self._model_tacotron_tpg = Tacotron_tpg(None, hparams)
+        hparams = self.hparams
+        if self.thread_profile_dir is not False:
+            # With a shared graph, the session is that of the wav model
+            hparams = autotune.apply_profile(self.thread_profile_dir or autotune.default_profile_dir(self.hparams),
+                                             self.hparams, cpu_based and not self.shared_graph)
+
+        if cpu_based and self.quantized_model is not None:
+            self._model_tacotron2 = quantize.TFLiteTacotron(self.quantized_model, hparams)
+            return
+
+        if not self.shared_graph:
+            if (cpu_based):
+                self._model_tacotron2 = self._load_model(hparams, with_wav=False)
+            else:
+                self._model_tacotron_tpg = self._load_model(hparams, with_wav=True)
+            return
+
+        # The mel outputs of the wav model serve the CPU-based method (unless it is quantized)
+        if self._model_tacotron_tpg is None:
+            self._model_tacotron_tpg = self._load_model(hparams, with_wav=True)
+        if self._model_tacotron2 is None and self.quantized_model is None:
+            self._model_tacotron2 = MelModel(self._model_tacotron_tpg)
+
+    def _load_model(self, hparams, with_wav):
+        """
+        Imports the frozen graph of the mel (or wav) model of hparams if it is cached, otherwise
+        builds the model and restores the checkpoint (and freezes it for the next load).
+        """
+        frozen_graph_path = None
+        if self.frozen_graph_dir is not None:
+            frozen_graph_path = export.frozen_graph_path(self.frozen_graph_dir, hparams, with_wav=with_wav)
+            if os.path.exists(frozen_graph_path):
+                if (with_wav):
+                    return export.FrozenTacotronTpg(frozen_graph_path, hparams)
+                return export.FrozenTacotron(frozen_graph_path, hparams)
+
+        # A graph of its own rather than the default one, which may hold another loaded model
+        with tf.Graph().as_default():
+            if (with_wav):
+                model = Tacotron_tpg(None, hparams)
+            else:
+                model = Tacotron2(None, hparams)
+        if frozen_graph_path is not None:
+            # Exported for the next startup
+            try:
+                export.freeze(model.session, frozen_graph_path, with_wav=with_wav)
+            except ValueError as e:
+                log("Not exporting a frozen graph: %s" % e)
+        return model
             
+    def close(self):
+        """
+        Releases the sessions of the loaded models.
+        """
+        for model in (self._model_tacotron2, self._model_tacotron_tpg):
+            # A MelModel shares the session of the wav model
+            if model is not None and hasattr(model, "session") and not isinstance(model, MelModel):
+                model.session.close()
+        self._model_tacotron2 = self._model_tacotron_tpg = None
+
     def synthesize_spectrograms(self, faces, return_alignments=False):
         """
         Synthesizes mel spectrograms from texts and speaker embeddings.
@@ -114,6 +189,34 @@ class Synthesizer:
         wav = self._model_tacotron_tpg.my_synthesize(faces)
         return wav
 
+    def synthesize_batch(self, windows, cpu_based=True, encoder_features=None):
+        """
+        Runs the model on a batch of windows with a single session.run.
+        :param windows: a list of N windows of hparams.T faces
+        :param cpu_based: if True, mel spectrograms are synthesized with the CPU-based model,
+        otherwise wavs are synthesized with the GPU-based one
+        :param encoder_features: the encoder convolution features of the windows (see
+        encoder_features), computed by the model if None
+        :return: a list of N mel spectrograms as numpy arrays of shape (80, M), or a list of N wavs
+        """
+        if not self.is_loaded(cpu_based=cpu_based):
+            self.load(cpu_based=cpu_based)
+
+        if cpu_based:
+            specs, _ = self._model_tacotron2.my_synthesize_batch(windows, encoder_features)
+            return specs
+        return self._model_tacotron_tpg.my_synthesize_batch(windows, encoder_features)
+
+    def encoder_features(self, frames, cpu_based=True):
+        """
+        Runs the encoder convolutions on consecutive frames (any number of them).
+        :return: the features of the frames as a numpy array of shape (frames, features)
+        """
+        if not self.is_loaded(cpu_based=cpu_based):
+            self.load(cpu_based=cpu_based)
+        model = self._model_tacotron2 if cpu_based else self._model_tacotron_tpg
+        return model.my_encoder_features(frames)
+
     @staticmethod
     def _one_shot_synthesize_spectrograms(checkpoint_fpath, texts, embeddings):
         # Load the model and forward the inputs
@@ -125,6 +228,7 @@ class Synthesizer:
         specs, alignments = [spec.copy() for spec in specs], alignments.copy()
         
         # Close cuda for this process
+        import numba.cuda
         model.session.close()
         numba.cuda.select_device(0)
         numba.cuda.close()
@@ -137,6 +241,7 @@ class Synthesizer:
         Loads and preprocesses an audio file under the same conditions the audio files were used to
         train the synthesizer. 
         """
+        import librosa
         wav = librosa.load(fpath, hparams.sample_rate)[0]
         if hparams.rescale:
             wav = wav / np.abs(wav).max() * hparams.rescaling_max
@@ -157,10 +262,10 @@ class Synthesizer:
         return mel_spectrogram
 
     @staticmethod
-    def griffin_lim(mel):
+    def griffin_lim(mel, hparams=hparams):
         """
         Inverts a mel spectrogram using Griffin-Lim. The mel spectrogram is expected to have been built
-        with the same parameters present in hparams.py.
+        with the same parameters present in hparams.py (or in the hparams given).
         """
         return audio.inv_mel_spectrogram(mel, hparams)
     
@@ -31,13 +31,25 @@ class TacotronEncoderCell(RNNCell):
 		self._convolutions = convolutional_layers
 		self._cell = lstm_layer
 
-	def __call__(self, inputs, input_lengths=None):
+	def conv_features(self, inputs):
+		"""Features of each frame computed by the convolutional layers, [batch_size, frames, features]
+		(the convolutions are not strided in time, so any number of frames can be passed)
+		"""
 		#Pass input sequence through a stack of convolutional layers
 		conv_output = self._convolutions(inputs)
 		d = conv_output.shape[4]*conv_output.shape[3]*conv_output.shape[2]
 		conv_output = tf.reshape(conv_output, (-1, tf.shape(conv_output)[1], d))
 
 		conv_output.set_shape((None,None, d))
+		return conv_output
+
+	def __call__(self, inputs, input_lengths=None):
+		conv_output = self.conv_features(inputs)
+		#The features can be fed instead of computed, e.g. from a cache of the features of the frames
+		#shared with the previous window (see EncoderFeatureCache in synthesizer/streaming.py)
+		conv_output = tf.placeholder_with_default(conv_output, conv_output.shape, name="encoder_conv_features")
+		self.conv_features_input = conv_output
+
 		#Extract hidden representation from encoder lstm cells		
 		hidden_representation = self._cell(conv_output, input_lengths)
 
@@ -86,7 +98,7 @@ class TacotronDecoderCell(RNNCell):
 	"""
 
 	#def __init__(self, prenet, attention_mechanism, rnn_cell, frame_projection, stop_projection):
-	def __init__(self, prenet, attention_mechanism, rnn_cell, frame_projection):
+	def __init__(self, prenet, attention_mechanism, rnn_cell, frame_projection, alignment_history=True):
 		"""Initialize decoder parameters
 
 		Args:
@@ -98,6 +110,8 @@ class TacotronDecoderCell(RNNCell):
 		    stop_projection: tensorflow fully connected layer, expected to project to a scalar
 			    and through a sigmoid activation
 			mask_finished: Boolean, Whether to mask decoder frames after the <stop_token>
+			alignment_history: Boolean, Whether to record the alignments of every step in the
+				state (an empty tuple otherwise)
 		"""
 		super(TacotronDecoderCell, self).__init__()
 		#Initialize decoder layers
@@ -106,8 +120,9 @@ class TacotronDecoderCell(RNNCell):
 		self._cell = rnn_cell
 		self._frame_projection = frame_projection
 		#self._stop_projection = stop_projection
+		self._alignment_history = alignment_history
 
-		self._attention_layer_size = self._attention_mechanism.values.get_shape()[-1].value
+		self._attention_layer_size = self._attention_mechanism.context_size
 
 	def _batch_size_checks(self, batch_size, error_message):
 		return [check_ops.assert_equal(batch_size,
@@ -164,7 +179,7 @@ class TacotronDecoderCell(RNNCell):
 				  dtype),
 				alignments=self._attention_mechanism.initial_alignments(batch_size, dtype),
 				alignment_history=tensor_array_ops.TensorArray(dtype=dtype, size=0,
-				dynamic_size=True))
+				dynamic_size=True) if self._alignment_history else ())
 
 	def __call__(self, inputs, state):
 		#Information bottleneck (essential for learning attention)
@@ -198,7 +213,10 @@ class TacotronDecoderCell(RNNCell):
 		#stop_tokens = self._stop_projection(projections_input)
 
 		#Save alignment history
-		alignment_history = previous_alignment_history.write(state.time, alignments)
+		if self._alignment_history:
+			alignment_history = previous_alignment_history.write(state.time, alignments)
+		else:
+			alignment_history = ()
 
 		#Prepare next decoder state
 		next_state = TacotronDecoderCellState(
@@ -27,6 +27,11 @@ def _compute_attention(attention_mechanism, cell_output, attention_state,
 	context = math_ops.matmul(expanded_alignments, attention_mechanism.values)
 	context = array_ops.squeeze(context, [1])
 
+	# A condition folded out of the memory is the same at every memory step and the alignments sum
+	# to 1, so its part of the context is the condition itself
+	if attention_mechanism.memory_condition is not None:
+		context = array_ops.concat([context, attention_mechanism.memory_condition], axis=-1)
+
 	if attention_layer is not None:
 		attention = attention_layer(array_ops.concat([cell_output, context], 1))
 	else:
@@ -116,6 +121,7 @@ class LocationSensitiveAttention(BahdanauAttention):
 				 memory_sequence_length=None,
 				 smoothing=False,
 				 cumulate_weights=True,
+				 folded_memory=None,
 				 name="LocationSensitiveAttention"):
 		"""Construct the Attention mechanism.
 		Args:
@@ -142,6 +148,11 @@ class LocationSensitiveAttention(BahdanauAttention):
 					We still keep it implemented in case we want to test it. They used it in the
 					paper in the context of speech recognition, where one phoneme may depend on
 					multiple subsequent sound frames.
+			folded_memory (optional): (encoder outputs, condition) pair whose concatenation
+				(the condition repeated at each time step) is memory. The keys and the context are
+				computed from the pair instead: the condition is projected once by its rows of the
+				memory layer, so memory itself is only used to create the memory layer with the
+				shape of the checkpoint and is never run.
 			name: Name to use when creating ops.
 		"""
 		#Create normalization function
@@ -162,6 +173,32 @@ class LocationSensitiveAttention(BahdanauAttention):
 			dtype=tf.float32, name="location_features_layer")
 		self._cumulate = cumulate_weights
 
+		self.memory_condition = None
+		if folded_memory is not None:
+			encoder_outputs, condition = folded_memory
+			depth = encoder_outputs.shape[-1].value
+			kernel = self.memory_layer.kernel
+			with tf.name_scope("folded_memory"):
+				# Masked past the length of each sequence, as BahdanauAttention masks its memory
+				self._values = encoder_outputs
+				if memory_length is not None:
+					mask = tf.sequence_mask(memory_length, maxlen=tf.shape(encoder_outputs)[1],
+						dtype=encoder_outputs.dtype)
+					self._values = encoder_outputs * tf.expand_dims(mask, -1)
+				self._keys = tf.tensordot(self._values, kernel[:depth], axes=1) + tf.expand_dims(
+					tf.matmul(condition, kernel[depth:]), 1)
+				self._batch_size = tf.shape(self._keys)[0]
+				self._alignments_size = tf.shape(self._keys)[1]
+			self.memory_condition = condition
+
+	@property
+	def context_size(self):
+		"""Depth of the context vectors"""
+		size = self.values.get_shape()[-1].value
+		if self.memory_condition is not None:
+			size += self.memory_condition.get_shape()[-1].value
+		return size
+
 	def __call__(self, query, state):
 		"""Score the query based on the keys and values.
 		Args:
@@ -214,6 +214,29 @@ class EncoderConvolutions3D:
         self.scope = "enc_conv_layers" if scope is None else scope
         self.enc_conv_num_blocks = hparams.enc_conv_num_blocks
         self.c = hparams.num_init_filters
+
+    # Kernel sizes of the layers of the blocks (the first layer of the first block is wider), see
+    # block_kernel_sizes
+    FIRST_KERNEL_SIZE = 5
+    KERNEL_SIZE = 3
+    NUM_RESIDUAL_LAYERS = 2
+
+    @classmethod
+    def block_kernel_sizes(cls, i, num_blocks):
+        """Kernel sizes of the layers of block i: the layer strided in space, the residual layers
+        and, in the last block, the last layer.
+        """
+        first = cls.FIRST_KERNEL_SIZE if i == 0 else cls.KERNEL_SIZE
+        last = [cls.KERNEL_SIZE] if i == num_blocks - 1 else []
+        return [first] + [cls.KERNEL_SIZE] * cls.NUM_RESIDUAL_LAYERS + last
+
+    @classmethod
+    def temporal_radius(cls, hparams):
+        """Number of frames on each side of a frame its features depend on (the layers of
+        __call__ are never strided in time and each adds kernel_size // 2 frames).
+        """
+        return sum(kernel_size // 2 for i in range(hparams.enc_conv_num_blocks)
+                   for kernel_size in cls.block_kernel_sizes(i, hparams.enc_conv_num_blocks))
     
     def __call__(self, inputs):
         with tf.variable_scope(self.scope):
@@ -221,14 +244,15 @@ class EncoderConvolutions3D:
             c = self.c
 
             for i in range(self.enc_conv_num_blocks):
-                x = self.conv3d(x, (5 if i == 0 else 3), c, (1, 2, 2), self.activation,
+                kernel_sizes = self.block_kernel_sizes(i, self.enc_conv_num_blocks)
+                x = self.conv3d(x, kernel_sizes[0], c, (1, 2, 2), self.activation,
                            self.is_training, "conv_layer_{}_".format(i + 1) + self.scope)
-                for j in range(2):
-                        x = self.conv3d(x, 3, c, 1, self.activation, self.is_training, 
+                for j in range(self.NUM_RESIDUAL_LAYERS):
+                        x = self.conv3d(x, kernel_sizes[1 + j], c, 1, self.activation, self.is_training, 
                             "conv_layer_{}_{}_".format(i + 1, j + 1) + self.scope, residual=True)
                 
                 if i == self.enc_conv_num_blocks - 1:
-                    x = self.conv3d(x, 3, c, (1, 3, 3), self.activation, self.is_training, 
+                    x = self.conv3d(x, kernel_sizes[-1], c, (1, 3, 3), self.activation, self.is_training, 
                             "conv_layer_{}_{}_".format(i + 1, 'last') + self.scope)
 
                 c *= 2
@@ -7,7 +7,6 @@ from tensorflow.contrib.seq2seq import dynamic_decode
 from synthesizer.models.architecture_wrappers import TacotronEncoderCell, TacotronDecoderCell
 from synthesizer.models.custom_decoder import CustomDecoder
 from synthesizer.models.attention import LocationSensitiveAttention
-from synthesizer.hparams import hparams
 
 import numpy as np
 
@@ -32,7 +31,8 @@ class Tacotron():
     
     def initialize(self, inputs, input_lengths, embed_targets, mel_targets=None, 
                    stop_token_targets=None, linear_targets=None, targets_lengths=None, gta=False,
-                   global_step=None, is_training=False, is_evaluating=False, split_infos=None):
+                   global_step=None, is_training=False, is_evaluating=False, split_infos=None,
+                   encoder_chunk=None):
         """
         Initializes the model for inference sets "mel_outputs" and "alignments" fields.
         Args:
@@ -45,6 +45,9 @@ class Tacotron():
             - mel_targets: float32 Tensor with shape [N, T_out, M] where N is batch size, 
             T_out is number of steps in the output time series, M is num_mels, and values are 
             entries in the mel spectrogram. Only needed for training.
+            - encoder_chunk: float32 Tensor with shape [N, F, H, W, 3] of any number F of frames,
+            also run through the encoder convolutions to set "tower_encoder_chunk_features".
+            Only used for inference.
         """
         if mel_targets is None and stop_token_targets is not None:
             raise ValueError("no multi targets were provided but token_targets were given")
@@ -86,7 +89,12 @@ class Tacotron():
             ##############
             #print (inputs)
             
-            p_inputs = tf.py_func(split_func, [inputs, split_infos[:, 0]], lout_float)
+            # With a single tower the split is the whole input, so the py_func (which can't be
+            # serialized into a frozen graph, see export.freeze) is only needed on multiple GPUs
+            if hp.tacotron_num_gpus == 1:
+                p_inputs = [inputs]
+            else:
+                p_inputs = tf.py_func(split_func, [inputs, split_infos[:, 0]], lout_float)
             p_mel_targets = tf.py_func(split_func, [mel_targets, split_infos[:, 1]],
                                        lout_float) if mel_targets is not None else mel_targets
             #p_stop_token_targets = tf.py_func(split_func, [stop_token_targets, split_infos[:, 2]],
@@ -100,7 +108,7 @@ class Tacotron():
             batch_size = tf.shape(inputs)[0]
             mel_channels = hp.num_mels
             for i in range(hp.tacotron_num_gpus):
-                tower_inputs.append(tf.reshape(p_inputs[i], [batch_size, hparams.T, hparams.img_size, hparams.img_size, 3]))
+                tower_inputs.append(tf.reshape(p_inputs[i], [batch_size, hp.T, hp.img_size, hp.img_size, 3]))
                 if p_mel_targets is not None:
                     tower_mel_targets.append(
                         tf.reshape(p_mel_targets[i], [batch_size, -1, mel_channels]))
@@ -115,6 +123,9 @@ class Tacotron():
         self.tower_alignments = []
         #self.tower_stop_token_prediction = []
         self.tower_mel_outputs = []
+        self.tower_encoder_outputs = []
+        self.tower_encoder_conv_features = []
+        self.tower_encoder_chunk_features = []
         
         tower_embedded_inputs = []
         tower_enc_conv_output_shape = []
@@ -137,6 +148,12 @@ class Tacotron():
                     # post processing when doing GTA synthesis
                     post_condition = hp.predict_linear and not gta
                     
+                    # The inference graph does not concatenate the speaker embedding to the
+                    # encoder outputs (see folded_memory below) and only records the alignments
+                    # if asked to
+                    inference = not (is_training or is_evaluating or gta)
+                    alignment_history = hp.alignment_history or not inference
+                    
                     # Embeddings ==> [batch_size, sequence_length, embedding_dim]
  					
                     #embedded_inputs = tf.nn.embedding_lookup(self.embedding_table, tower_inputs[i])
@@ -153,13 +170,22 @@ class Tacotron():
                                    zoneout=hp.tacotron_zoneout_rate, scope="encoder_LSTM"))
                     
                     encoder_outputs = encoder_cell(embedded_inputs, tower_input_lengths[i])
+                    self.tower_encoder_conv_features.append(encoder_cell.conv_features_input)
+                    
+                    # Same convolutions on a chunk of any number of frames, to only compute the
+                    # features of the new frames of overlapping windows
+                    if encoder_chunk is not None:
+                        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                            self.tower_encoder_chunk_features.append(
+                                encoder_cell.conv_features(tf.cast(encoder_chunk, tf.float32)))
                     
                     # For shape visualization purpose
                     enc_conv_output_shape = encoder_cell.conv_output_shape
 
                     ### SV2TT2 ###
                     
-                    # Append the speaker embedding to the encoder output at each timestep
+                    # Append the speaker embedding to the encoder output at each timestep (at
+                    # inference, only used to create the attention memory layer)
                     tileable_shape = [-1, 1, self._hparams.speaker_embedding_size]
                     tileable_embed_targets = tf.reshape(tower_embed_targets[i], tileable_shape)
                     tiled_embed_targets = tf.tile(tileable_embed_targets, 
@@ -182,7 +208,10 @@ class Tacotron():
                                                                          tower_input_lengths[i],
                                                                          [-1]),
                                                                      smoothing=hp.smoothing,
-                                                                     cumulate_weights=hp.cumulative_weights)
+                                                                     cumulate_weights=hp.cumulative_weights,
+                                                                     folded_memory=(encoder_outputs,
+                                                                                    tower_embed_targets[i])
+                                                                     if inference else None)
                     # Decoder LSTM Cells
                     decoder_lstm = DecoderRNN(is_training, layers=hp.decoder_layers,
                                               size=hp.decoder_lstm_units,
@@ -208,7 +237,8 @@ class Tacotron():
                         prenet,
                         attention_mechanism,
                         decoder_lstm,
-                        frame_projection)
+                        frame_projection,
+                        alignment_history=alignment_history)
                     
                     # Define the helper for our decoder
                     if is_training or is_evaluating or gta:
@@ -279,13 +309,18 @@ class Tacotron():
                         linear_outputs = linear_specs_projection(post_outputs)
                     
                     # Grab alignments from the final decoder state
-                    alignments = tf.transpose(final_decoder_state.alignment_history.stack(),
-                                              [1, 2, 0])
+                    if alignment_history:
+                        alignments = tf.transpose(final_decoder_state.alignment_history.stack(),
+                                                  [1, 2, 0])
+                    else:
+                        # [batch_size, encoder_steps, 0]: no decoder step recorded
+                        alignments = tf.zeros([batch_size, tf.shape(encoder_outputs)[1], 0])
                     
                     self.tower_decoder_output.append(decoder_output)
                     self.tower_alignments.append(alignments)
                     #self.tower_stop_token_prediction.append(stop_token_prediction)
                     self.tower_mel_outputs.append(mel_outputs)
+                    self.tower_encoder_outputs.append(encoder_outputs)
                     tower_embedded_inputs.append(embedded_inputs)
                     tower_enc_conv_output_shape.append(enc_conv_output_shape)
                     tower_encoder_cond_outputs.append(encoder_cond_outputs)
@@ -0,0 +1,234 @@
+"""
+Inference-only transforms of a frozen GraphDef (see synthesizer/export.py).
+
+- fold_constants evaluates once the subgraphs that only depend on constants (the variables read
+  through Identity ops, the rsqrt(variance + epsilon) * gamma of the batch normalizations, ...)
+  and replaces them with their value.
+- fold_batch_norms merges the (constant) scale and shift of the batch normalization following a
+  Conv3D or Conv2D into the kernel and bias of the convolution: conv(x, k) * s + b becomes
+  conv(x, k * s) + b, which removes two elementwise passes over every encoder activation.
+
+tf.graph_transforms and optimize_for_inference only fold fused batch normalizations into Conv2D,
+while the encoder uses Conv3D with the non-fused batch normalization.
+"""
+from synthesizer.infolog import log
+import tensorflow as tf
+import numpy as np
+import collections
+import time
+
+# Ops never folded, even with constant inputs: the control flow of the decoder and Griffin-Lim
+# loops and the ops that only make sense at run time
+_UNFOLDABLE_OPS = {"Enter", "Exit", "Merge", "Switch", "NextIteration", "LoopCond", "ControlTrigger",
+                   "Placeholder", "PlaceholderWithDefault", "NoOp", "Assert", "Print", "PyFunc"}
+
+_CONV_OPS = {"Conv2D": b"NHWC", "Conv3D": b"NDHWC"}
+
+
+def _node_name(input_name):
+    """Name of the node of a NodeDef input ("^node", "node" or "node:port")."""
+    return input_name.lstrip("^").split(":")[0]
+
+def _const_node(name, value):
+    node = tf.NodeDef()
+    node.op = "Const"
+    node.name = name
+    node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr["value"].CopyFrom(tf.make_tensor_proto(value))
+    return node
+
+def _const_value(node):
+    return tf.make_ndarray(node.attr["value"].tensor) if node.op == "Const" else None
+
+def _consumers(graph_def):
+    consumers = {node.name: [] for node in graph_def.node}
+    for node in graph_def.node:
+        for input_name in node.input:
+            consumers[_node_name(input_name)].append(node)
+    return consumers
+
+
+def fold_constants(graph_def, max_bytes=1 << 26):
+    """
+    Returns a copy of graph_def where every single-output node only depending on constants is
+    replaced by a Const node of the same name holding its value.
+
+    Args:
+        graph_def: frozen GraphDef
+        max_bytes: integer, values larger than this are left to be computed at run time
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+
+    # Operations each operation is a control dependency of
+    control_consumers = collections.defaultdict(list)
+    for op in graph.get_operations():
+        for control in op.control_inputs:
+            control_consumers[control.name].append(op)
+
+    # Operations are listed in topological order
+    static = set()
+    for op in graph.get_operations():
+        if (op.type in _UNFOLDABLE_OPS or op.op_def.is_stateful or len(op.outputs) != 1
+                or op.outputs[0].dtype in (tf.resource, tf.variant, tf.string)):
+            continue
+        if (op.type != "Const" and not op.inputs):
+            continue
+        if (all(tensor.op.name in static for tensor in op.inputs)
+                and all(control.name in static for control in op.control_inputs)):
+            static.add(op.name)
+
+    # Only the boundary of the static subgraphs is evaluated, the rest becomes unused
+    fetches = []
+    for name in static:
+        op = graph.get_operation_by_name(name)
+        if (op.type == "Const"):
+            continue
+        output = op.outputs[0]
+        num_elements = output.shape.num_elements()
+        if (num_elements is not None and num_elements * output.dtype.size > max_bytes):
+            continue
+        if (not any(consumer.name not in static for consumer in output.consumers())
+                and not any(control.name not in static for control in control_consumers[name])):
+            continue
+        fetches.append(output)
+
+    with tf.Session(graph=graph) as session:
+        values = session.run(fetches) if fetches else []
+    folded = {tensor.op.name: value for tensor, value in zip(fetches, values) if value.nbytes <= max_bytes}
+
+    output_def = tf.GraphDef()
+    output_def.versions.CopyFrom(graph_def.versions)
+    output_def.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if (node.name in folded):
+            output_def.node.extend([_const_node(node.name, folded[node.name])])
+        else:
+            output_def.node.extend([node])
+    log("Folded %d constant subgraphs" % len(folded))
+    return output_def
+
+
+def fold_batch_norms(graph_def):
+    """
+    Returns a copy of graph_def where the constant scale and shift following a convolution (and
+    its bias) are merged into the kernel and bias of the convolution. Expects the constants to be
+    folded first (fold_constants).
+    """
+    output_def = tf.GraphDef()
+    output_def.CopyFrom(graph_def)
+    nodes = {node.name: node for node in output_def.node}
+    consumers = _consumers(output_def)
+
+    def single_consumer(node, op_types):
+        node_consumers = consumers[node.name]
+        if (len(node_consumers) == 1 and node_consumers[0].op in op_types):
+            return node_consumers[0]
+        return None
+
+    def const_operand(node, other_name):
+        """Value of the constant operand of a binary node whose other operand is other_name."""
+        names = [_node_name(name) for name in node.input if not name.startswith("^")]
+        if (len(names) != 2 or other_name not in names):
+            return None
+        const_name = names[1] if names[0] == other_name else names[0]
+        return _const_value(nodes[const_name])
+
+    num_folded = 0
+    for conv in list(output_def.node):
+        if (conv.op not in _CONV_OPS or conv.attr["data_format"].s != _CONV_OPS[conv.op]):
+            continue
+        kernel = _const_value(nodes[_node_name(conv.input[1])])
+        if (kernel is None):
+            continue
+        channels = kernel.shape[-1]
+
+        # conv -> [BiasAdd] -> Mul (scale) -> [Add (shift)]
+        bias_add = single_consumer(conv, ("BiasAdd",))
+        last = bias_add if bias_add is not None else conv
+        bias = np.zeros(channels, kernel.dtype)
+        if (bias_add is not None):
+            bias = _const_value(nodes[_node_name(bias_add.input[1])])
+            if (bias is None):
+                continue
+        mul = single_consumer(last, ("Mul",))
+        if (mul is None):
+            continue
+        scale = const_operand(mul, last.name)
+        if (scale is None or scale.size != channels or scale.shape[-1:] != (channels,)):
+            continue
+        output = mul
+        shift = np.zeros(channels, kernel.dtype)
+        add = single_consumer(mul, ("Add", "AddV2"))
+        if (add is not None):
+            add_shift = const_operand(add, mul.name)
+            if (add_shift is not None and add_shift.size == channels and add_shift.shape[-1:] == (channels,)):
+                output, shift = add, add_shift
+
+        folded_kernel = _const_node(conv.name + "/folded_kernel", (kernel * scale.reshape(-1)).astype(kernel.dtype))
+        folded_bias = _const_node(conv.name + "/folded_bias", (bias * scale.reshape(-1) + shift.reshape(-1)).astype(kernel.dtype))
+        output_def.node.extend([folded_kernel, folded_bias])
+        conv.input[1] = folded_kernel.name
+        if (bias_add is None):
+            bias_add = output_def.node.add()
+            bias_add.op = "BiasAdd"
+            bias_add.name = conv.name + "/folded_bias_add"
+            bias_add.input.extend([conv.name, folded_bias.name])
+            bias_add.attr["T"].CopyFrom(conv.attr["T"])
+            bias_add.device = conv.device
+        else:
+            bias_add.input[1] = folded_bias.name
+
+        # The consumers of the scale and shift now read the biased convolution
+        for consumer in consumers[output.name]:
+            for i, input_name in enumerate(consumer.input):
+                if (input_name in (output.name, output.name + ":0")):
+                    consumer.input[i] = bias_add.name
+                elif (input_name == "^" + output.name):
+                    consumer.input[i] = "^" + bias_add.name
+        consumers[bias_add.name] = consumers[output.name]
+        num_folded += 1
+
+    log("Folded %d batch normalizations into convolutions" % num_folded)
+    return output_def
+
+
+def optimize_for_inference(graph_def, output_names):
+    """
+    Constant folds graph_def, folds its batch normalizations and prunes the nodes that became
+    unused.
+    Args:
+        graph_def: frozen GraphDef
+        output_names: list of the names of the nodes the graph is used for
+    """
+    graph_def = fold_batch_norms(fold_constants(graph_def))
+    return tf.graph_util.extract_sub_graph(graph_def, output_names)
+
+
+def compare(original_def, optimized_def, feed_dict, fetches, runs=5):
+    """
+    Runs both graphs on the same inputs.
+    Args:
+        feed_dict: dictionary of tensor names to values
+        fetches: list of names of deterministic tensors to compare
+        runs: integer, number of timed runs of each graph (after a warmup run)
+    Returns:
+        (maximum absolute error, largest output magnitude, seconds per run of the original graph,
+        seconds per run of the optimized graph)
+    """
+    outputs, durations = [], []
+    for graph_def in (original_def, optimized_def):
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        with tf.Session(graph=graph) as session:
+            outputs.append(session.run(fetches, feed_dict=feed_dict))
+            start = time.time()
+            for _ in range(runs):
+                session.run(fetches, feed_dict=feed_dict)
+            durations.append((time.time() - start) / runs)
+
+    error = max(float(np.max(np.abs(a - b))) for a, b in zip(*outputs))
+    magnitude = max(float(np.max(np.abs(a))) for a in outputs[0])
+    return error, magnitude, durations[0], durations[1]
@@ -0,0 +1,162 @@
+from synthesizer.utils import ValueWindow
+from concurrent.futures import Future
+import threading
+import traceback
+import queue
+import time
+
+_STOP = object()
+
+
+class StagePipeline:
+    """Runs a chain of processing stages, each on its own thread, connected by bounded queues.
+
+    While stage i works on item N, stage i - 1 already works on item N + 1, so the throughput of
+    the pipeline is set by its slowest stage rather than by the sum of all the stages. The
+    bounded queues apply backpressure: put() blocks once `depth` items wait for the first stage.
+    """
+
+    def __init__(self, stages, depth=1, report_every=None):
+        """
+        Args:
+            stages: list of (name, callable) tuples. Each callable receives the output of the
+            previous stage (or the item passed to put() for the first one). Returning None drops
+            the item, the return value of the last stage is ignored
+            depth: integer, number of items that can wait in front of each stage
+            report_every: integer, if set the stage timings are printed every report_every items
+            leaving the pipeline
+        """
+        self.report_every = report_every
+        self.num_done = 0
+        self.names = [name for name, _ in stages]
+        self.timings = {name: ValueWindow(100) for name in self.names}
+        self._queues = [queue.Queue(maxsize=depth) for _ in stages]
+        self._threads = [threading.Thread(target=self._run, args=(i, fn), name=name, daemon=True)
+                         for i, (name, fn) in enumerate(stages)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item):
+        """
+        Feeds an item to the first stage, blocking while the first queue is full.
+        """
+        self._queues[0].put(item)
+
+    def close(self):
+        """
+        Waits for every item already put to go through all the stages, then stops the threads.
+        """
+        self._queues[0].put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def report(self):
+        """
+        :return: a one-line summary of the average duration of every stage
+        """
+        stages = ", ".join("{}: {:.1f} ms".format(name, self.timings[name].average * 1000)
+                           for name in self.names)
+        slowest = max(self.names, key=lambda name: self.timings[name].average)
+        return "pipeline stages [{}], bound by {}".format(stages, slowest)
+
+    def _run(self, i, fn):
+        inbox = self._queues[i]
+        outbox = self._queues[i + 1] if i + 1 < len(self._queues) else None
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                if outbox is not None:
+                    outbox.put(_STOP)
+                return
+
+            start = time.time()
+            try:
+                item = fn(item)
+            except Exception:
+                traceback.print_exc()
+                item = None
+            self.timings[self.names[i]].append(time.time() - start)
+
+            if outbox is not None and item is not None:
+                outbox.put(item)
+            elif outbox is None:
+                self.num_done += 1
+                if self.report_every and self.num_done % self.report_every == 0:
+                    print(self.report())
+
+
+class WindowBatcher:
+    """Groups the windows submitted by several threads into batches run by a single model call.
+
+    submit() returns a Future right away. A worker thread takes the first waiting window, keeps
+    collecting windows until max_batch_size are waiting or max_delay seconds have passed since
+    the first one, runs them in one call and hands every caller back its own output. A
+    backlogged stream (submitting several ready windows at once) or several streams therefore
+    share a single session.run instead of one call per window.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_delay=0.01):
+        """
+        Args:
+            run_batch: callable receiving a list of inputs and returning the list of their
+            outputs, in the same order
+            max_batch_size: integer, maximum number of inputs per call
+            max_delay: float, maximum number of seconds the first input of a batch waits for
+            other inputs
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1, got {}".format(max_batch_size))
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batch_sizes = ValueWindow(100)
+        self._run_batch = run_batch
+        self._inbox = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs):
+        """
+        :return: a Future resolved with the output of inputs
+        """
+        future = Future()
+        self._inbox.put((inputs, future))
+        return future
+
+    def close(self):
+        """
+        Runs the inputs already submitted, then stops the worker thread.
+        """
+        self._inbox.put(_STOP)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._inbox.get(timeout=remaining) if remaining > 0 else self._inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._inbox.put(_STOP) # stop once this batch is done
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._inbox.get()
+            if item is _STOP:
+                return
+
+            batch = self._collect(item)
+            self.batch_sizes.append(len(batch))
+            try:
+                outputs = self._run_batch([inputs for inputs, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
@@ -0,0 +1,254 @@
+"""
+Pool of resident models of several speakers, to serve streams of different speakers from one
+process.
+
+Each (checkpoint, preset) is loaded on first use into a Synthesizer with its own hparams, graph and
+session (see synthesizer/hotswap.py for how the hparams are built). When the models loaded exceed
+the memory budget (which also covers the default model, resident outside of the pool), the least
+recently used ones are closed; they are loaded again on their next use. A model is never closed
+while a call runs on it.
+
+The presets of the pool may change the STREAM_HPARAMS of the default model: the streams are sized
+by the hparams of the model they are routed to.
+"""
+from synthesizer.infolog import log
+from synthesizer.hotswap import load_hparams
+from contextlib import contextmanager
+import numpy as np
+import collections
+import functools
+import glob
+import os
+import threading
+import traceback
+
+
+@functools.lru_cache(maxsize=None)
+def _checkpoint_bytes(checkpoint):
+    return sum(os.path.getsize(path) for path in glob.glob(checkpoint + ".*"))
+
+def model_bytes(hparams):
+    """
+    Estimated memory of the model of hparams: the size of the files of its checkpoint, i.e. the
+    weights, their index and the meta graph (standing for the graph built from it).
+    """
+    return _checkpoint_bytes(hparams.eval_ckpt)
+
+
+class _Entry:
+    def __init__(self, synthesizer, size, generation):
+        self.synthesizer = synthesizer
+        self.size = size
+        self.generation = generation
+        self.calls = 0
+
+
+class ModelPool:
+    """
+    Models keyed by (checkpoint, preset), loaded and warmed up on demand, evicted in least recently used order
+    beyond the memory budget.
+    """
+
+    def __init__(self, factory, cpu_based, default, memory_budget=None):
+        """
+        Args:
+            factory: callable, returns a new (not loaded) Synthesizer from hparams
+            cpu_based: the method of synthesis the models are loaded for
+            default: the synthesizer of the default model (e.g. a SwappableSynthesizer), whose
+            CARRIED_HPARAMS the models of the pool get and whose size counts in the budget
+            memory_budget: bytes of models (see model_bytes) kept loaded, including the default
+            model, None for no limit
+        """
+        self.cpu_based = cpu_based
+        self.memory_budget = memory_budget
+        self._factory = factory
+        self._default = default
+        self._hparams = {}
+        # Loaded models, least recently used first
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def hparams(self, key):
+        """
+        Hparams of the model of key = (checkpoint, preset), without loading it.
+        """
+        with self._lock:
+            hparams = self._hparams.get(key)
+        if hparams is None:
+            checkpoint, preset = key
+            hparams = load_hparams(preset, checkpoint, self._default.hparams)
+            with self._lock:
+                hparams = self._hparams.setdefault(key, hparams)
+        return hparams
+
+    def start_load(self, key):
+        """
+        Loads the model of key from a background thread (if it is not loaded yet), failures are
+        logged.
+        """
+        def run():
+            try:
+                with self.pinned(key):
+                    pass
+            except Exception:
+                log("Loading model of %s failed:\n%s" % (key[0], traceback.format_exc()))
+        thread = threading.Thread(target=run, name="model-load", daemon=True)
+        thread.start()
+        return thread
+
+    def loaded_bytes(self):
+        """
+        Estimated memory of the models loaded, including the default model.
+        """
+        with self._lock:
+            return self._loaded_bytes()
+
+    def _loaded_bytes(self):
+        return model_bytes(self._default.hparams) + sum(entry.size for entry in self._entries.values())
+
+    @contextmanager
+    def pinned(self, key):
+        """
+        Context yielding (synthesizer, generation) of the model of key = (checkpoint, preset),
+        loaded if needed and not evicted before the context exits. generation changes whenever the
+        model is loaded again.
+        """
+        entry = self._acquire(key)
+        try:
+            yield entry.synthesizer, entry.generation
+        finally:
+            with self._lock:
+                entry.calls -= 1
+                evicted = self._evict()
+            self._close(evicted)
+
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.calls += 1
+                    self._entries.move_to_end(key)
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Loaded by another thread, its entry can be evicted again before this thread gets it
+            loading.wait()
+
+        try:
+            hparams = self.hparams(key)
+            log("Loading model of %s into the pool" % key[0])
+            synthesizer = self._factory(hparams)
+            synthesizer.load(cpu_based=self.cpu_based)
+            window = np.full((hparams.T, hparams.img_size, hparams.img_size, 3), 0.5, dtype=np.float32)
+            synthesizer.synthesize_batch([window], cpu_based=self.cpu_based)
+            with self._lock:
+                self._generation += 1
+                entry = self._entries[key] = _Entry(synthesizer, model_bytes(hparams), self._generation)
+                entry.calls += 1
+                evicted = self._evict()
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        self._close(evicted)
+        return entry
+
+    def _evict(self):
+        """
+        Removes the least recently used models not in use until the loaded ones fit in the budget,
+        returns them. Called with the lock held.
+        """
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        total = self._loaded_bytes()
+        for key, entry in list(self._entries.items()):
+            if total <= self.memory_budget:
+                break
+            if entry.calls == 0:
+                del self._entries[key]
+                total -= entry.size
+                evicted.append((key, entry))
+        return evicted
+
+    def _close(self, evicted):
+        for key, entry in evicted:
+            log("Evicting model of %s from the pool (%.1f MB)" % (key[0], entry.size / 2.**20))
+            entry.synthesizer.close()
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.items())
+            self._entries.clear()
+        self._close(entries)
+
+
+class RoutedSynthesizer:
+    """
+    Synthesizer of a stream, with the synthesis API of Synthesizer: each call runs on the model of
+    the speaker the stream is routed to in the pool, or on the default synthesizer if the stream is
+    not routed. The route is looked up on every call, so it can change while the stream runs.
+    """
+
+    def __init__(self, pool, default, route):
+        """
+        Args:
+            pool: the ModelPool of the speakers
+            default: the synthesizer of the streams without a route (a SwappableSynthesizer)
+            route: callable, returns the (checkpoint, preset) of the stream or None
+        """
+        self._pool = pool
+        self._default = default
+        self._route = route
+
+    @property
+    def routed(self):
+        return self._route() is not None
+
+    @property
+    def hparams(self):
+        key = self._route()
+        return self._default.hparams if key is None else self._pool.hparams(key)
+
+    @contextmanager
+    def pinned(self):
+        """
+        Context yielding (synthesizer, generation) of the model of the stream, see
+        ModelPool.pinned. generation identifies the model, it changes when the route does.
+        """
+        key = self._route()
+        if key is None:
+            with self._default.pinned() as (synthesizer, generation):
+                yield synthesizer, (None, generation)
+        else:
+            with self._pool.pinned(key) as (synthesizer, generation):
+                yield synthesizer, (key, generation)
+
+    def synthesize_spectrograms(self, faces, return_alignments=False):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_spectrograms(faces, return_alignments)
+
+    def synthesize_wavs(self, faces, return_alignments=False):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_wavs(faces, return_alignments)
+
+    def synthesize_batch(self, windows, cpu_based=True, encoder_features=None):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.synthesize_batch(windows, cpu_based, encoder_features)
+
+    def encoder_features(self, frames, cpu_based=True):
+        with self.pinned() as (synthesizer, _):
+            return synthesizer.encoder_features(frames, cpu_based)
+
+    def griffin_lim(self, mel, hparams=None):
+        """
+        Vocodes mel with the hparams of the model that synthesized it (that of the current route
+        if None), the stream can be routed elsewhere in between.
+        """
+        from synthesizer.inference import Synthesizer
+        return Synthesizer.griffin_lim(mel, self.hparams if hparams is None else hparams)
@@ -0,0 +1,246 @@
+"""
+Quantized mel spectrogram model: the frozen mel graph (see synthesizer/export.py) is converted to
+TFLite with post-training quantization, and run by TFLiteTacotron behind the synthesis API of
+Tacotron2 (method_of_synthesis "quantized", vocoded on the CPU like "cpu").
+
+- "dynamic" quantizes the weights to int8, the activations stay float and are quantized on the
+  fly by the kernels that support it.
+- "int8" also quantizes the activations, with ranges calibrated on sample windows.
+
+The ops without a TFLite kernel (the decoder loop, Conv3D on older runtimes, ...) are kept as
+tensorflow ops (SELECT_TF_OPS) and run in float32.
+
+The conversion reports the mel error and the per-window latency of the quantized model against the
+float32 one. The prenet dropout of the decoder is active at inference, so two float32 runs already
+differ: the report gives this difference as the noise floor of the error. Before the report, the
+quantized model is checked against the float32 one on a window (which also runs the decoder loop
+through the tensorflow ops kept in the model), the conversion fails if they differ by more than
+the noise floor.
+
+Usage: python -m synthesizer.quantize --checkpoint <ckpt> --preset <json> --output_dir <dir>
+       [--mode dynamic|int8] [--calibration_dir <faces>] [--calibration_windows 16]
+"""
+from synthesizer.infolog import log
+from synthesizer import export
+import tensorflow as tf
+import numpy as np
+import argparse
+import json
+import os
+import threading
+import time
+
+MODES = ("dynamic", "int8")
+# Largest mel error of the quantized model accepted by verify, relative to the noise floor
+VERIFY_NOISE_RATIO = 2.
+
+
+def quantized_model_path(directory, hparams, mode):
+    frozen_name = os.path.basename(export.frozen_graph_path(directory, hparams, with_wav=False))
+    return os.path.join(directory, frozen_name.replace(".pb", "_{}.tflite".format(mode)))
+
+def input_shapes(hparams):
+    """The TFLite model runs a single window."""
+    return {"inputs": [1, hparams.T, hparams.img_size, hparams.img_size, 3],
+            "input_lengths": [1],
+            "speaker_embeddings": [1, hparams.speaker_embedding_size]}
+
+def feed_of(window, hparams):
+    """Input arrays of a window, in the order of export.INPUT_NAMES."""
+    return [np.asarray(window, dtype=np.float32)[np.newaxis],
+            np.asarray([len(window)], dtype=np.int32),
+            np.zeros([1, hparams.speaker_embedding_size], dtype=np.float32)]
+
+
+def load_windows(directory, hparams, count):
+    """
+    Up to count windows of hparams.T faces read from the .jpg files under directory (in the
+    numerical order of their names, like the cut directories of Lip2Wav), or random windows if
+    directory is None.
+    """
+    shape = (hparams.T, hparams.img_size, hparams.img_size, 3)
+    if directory is None:
+        random = np.random.RandomState(0)
+        return [random.uniform(size=shape).astype(np.float32) for _ in range(count)]
+
+    import cv2
+    fnames = []
+    for root, _, files in sorted(os.walk(directory)):
+        jpgs = [f for f in files if f.endswith(".jpg") and f[:-4].isdigit()]
+        fnames.extend(os.path.join(root, f) for f in sorted(jpgs, key=lambda f: int(f[:-4])))
+    faces = []
+    for fname in fnames[:count * hparams.T]:
+        face = cv2.imread(fname, cv2.IMREAD_COLOR)
+        if np.shape(face) != ():
+            faces.append(cv2.resize(face, (hparams.img_size, hparams.img_size)))
+    windows = [np.asarray(faces[i:i + hparams.T], dtype=np.float32) / 255.
+               for i in range(0, len(faces) - hparams.T + 1, hparams.T)]
+    if not windows:
+        raise ValueError("no window of {} faces under {}".format(hparams.T, directory))
+    return windows
+
+
+def convert(frozen_graph_path, output_path, hparams, mode="dynamic", calibration_windows=None):
+    """
+    Converts the frozen mel graph to a quantized TFLite model written to output_path.
+    Args:
+        mode: one of MODES
+        calibration_windows: list of windows the activation ranges are calibrated on (int8 mode)
+    """
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        frozen_graph_path, list(export.INPUT_NAMES), [export.MEL_OUTPUT_NAMES[0]], input_shapes(hparams))
+    converter.target_spec.supported_ops = set([tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "int8":
+        if not calibration_windows:
+            raise ValueError("int8 quantization needs calibration windows")
+        def representative_dataset():
+            for window in calibration_windows:
+                yield feed_of(window, hparams)
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+
+    model = converter.convert()
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(model)
+    os.replace(tmp_path, output_path)
+    log("Quantized model (%s) written to %s (%.1f MB)" % (mode, output_path, len(model) / 2.**20))
+    return output_path
+
+
+class TFLiteTacotron:
+    """
+    Quantized mel spectrogram model, with the synthesis API of Tacotron2. The windows of a batch
+    are run one after the other, and the windows of several threads one at a time (the tensors of
+    the interpreter are shared).
+    """
+
+    def __init__(self, path, hparams):
+        log("Loading quantized model: %s" % path)
+        self._hparams = hparams
+        self.xla_jit = False
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self._lock = threading.Lock()
+        inputs = {detail["name"]: detail["index"] for detail in self.interpreter.get_input_details()}
+        self._input_indices = [inputs[name] for name in export.INPUT_NAMES]
+        self._mel_index = self.interpreter.get_output_details()[0]["index"]
+        print ("LOADED MODEL")
+
+    def my_synthesize(self, seqs):
+        return self.my_synthesize_batch([seqs])
+
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the mel spectrograms of a batch of windows, no alignments are returned.
+        """
+        if encoder_features is not None:
+            raise ValueError("the quantized model does not take encoder features")
+        mels = []
+        for window in windows:
+            feed = feed_of(window, self._hparams)
+            with self._lock:
+                for index, value in zip(self._input_indices, feed):
+                    self.interpreter.set_tensor(index, value)
+                self.interpreter.invoke()
+                mels.append(self.interpreter.get_tensor(self._mel_index)[0].T)
+        return mels, None
+
+
+def verify(float_model, quantized_model, window):
+    """
+    Raises ValueError if the mel spectrogram of quantized_model on window does not match the one
+    of float_model: a different shape, values that are not finite, or a mean error beyond
+    VERIFY_NOISE_RATIO times the difference between two float32 runs.
+    """
+    float_mel = float_model.my_synthesize(window)[0][0]
+    noise_floor = float(np.mean(np.abs(float_mel - float_model.my_synthesize(window)[0][0])))
+    quantized_mel = quantized_model.my_synthesize(window)[0][0]
+    if quantized_mel.shape != float_mel.shape:
+        raise ValueError("the quantized model outputs mels of shape %s instead of %s" % (
+            quantized_mel.shape, float_mel.shape))
+    if not np.all(np.isfinite(quantized_mel)):
+        raise ValueError("the quantized model outputs values that are not finite")
+    error = float(np.mean(np.abs(float_mel - quantized_mel)))
+    if error > VERIFY_NOISE_RATIO * max(noise_floor, 1e-3):
+        raise ValueError("the quantized model does not match the float32 one (mean error %.4f, "
+                         "noise floor %.4f)" % (error, noise_floor))
+    log("Quantized model verified: mean error %.4f, noise floor %.4f" % (error, noise_floor))
+
+
+def compare(float_model, quantized_model, windows):
+    """
+    Returns the report of the mel error and per-window latency of quantized_model against
+    float_model on windows.
+    """
+    def run(model):
+        start = time.time()
+        mels = [model.my_synthesize(window)[0][0] for window in windows]
+        return mels, (time.time() - start) / len(windows)
+
+    # Warmup runs
+    float_model.my_synthesize(windows[0])
+    quantized_model.my_synthesize(windows[0])
+    float_mels, float_latency = run(float_model)
+    float_mels_again, _ = run(float_model)
+    quantized_mels, quantized_latency = run(quantized_model)
+
+    def mean_abs_error(mels):
+        return float(np.mean([np.mean(np.abs(a - b)) for a, b in zip(float_mels, mels)]))
+    return {
+        "windows": len(windows),
+        "mel_mean_abs_error": mean_abs_error(quantized_mels),
+        "mel_max_abs_error": float(max(np.max(np.abs(a - b)) for a, b in zip(float_mels, quantized_mels))),
+        "float_noise_floor": mean_abs_error(float_mels_again),
+        "float_latency_ms": float_latency * 1000,
+        "quantized_latency_ms": quantized_latency * 1000,
+    }
+
+
+def main():
+    # Imported here as synthesizer.inference imports this module
+    from synthesizer import inference as sif
+
+    parser = argparse.ArgumentParser(description="Converts the mel model to a quantized TFLite model and reports its error and latency")
+    parser.add_argument("--checkpoint", help="Path to trained checkpoint", required=True)
+    parser.add_argument("--preset", help="Speaker-specific hyper-params", type=str, required=True)
+    parser.add_argument("--output_dir", help="Directory the frozen graph, the quantized model and its report are written to", type=str, required=True)
+    parser.add_argument("--mode", help="Quantize the weights only (dynamic range) or the weights and activations (int8)", type=str, required=False, choices=MODES, default="dynamic")
+    parser.add_argument("--calibration_dir", help="Directory of face .jpg files (e.g. a cut directory) used for calibration and for the report, random windows if not set", type=str, required=False, default=None)
+    parser.add_argument("--calibration_windows", help="Number of windows used for calibration", type=int, required=False, default=16)
+    parser.add_argument("--report_windows", help="Number of windows used for the report", type=int, required=False, default=8)
+    args = parser.parse_args()
+
+    with open(args.preset) as f:
+        sif.hparams.parse_json(f.read())
+    sif.hparams.set_hparam("eval_ckpt", args.checkpoint)
+
+    # Exports the float32 frozen graph if needed, it is also the reference of the report
+    float_synthesizer = sif.Synthesizer(verbose=False, frozen_graph_dir=args.output_dir, shared_graph=False)
+    float_synthesizer.load(cpu_based=True)
+
+    windows = load_windows(args.calibration_dir, sif.hparams, args.calibration_windows + args.report_windows)
+    calibration_windows = windows[:args.calibration_windows] or windows
+    report_windows = windows[args.calibration_windows:] or windows
+    path = convert(export.frozen_graph_path(args.output_dir, sif.hparams, with_wav=False),
+                   quantized_model_path(args.output_dir, sif.hparams, args.mode), sif.hparams,
+                   mode=args.mode, calibration_windows=calibration_windows)
+
+    quantized_model = TFLiteTacotron(path, sif.hparams)
+    try:
+        verify(float_synthesizer._model_tacotron2, quantized_model, report_windows[0])
+    except ValueError:
+        # Not left where the runtime would load it
+        os.remove(path)
+        raise
+    report = compare(float_synthesizer._model_tacotron2, quantized_model, report_windows)
+    report["mode"] = args.mode
+    with open(path[:-len(".tflite")] + "_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Inference sessions of the Tacotron models, optionally compiled with the XLA JIT (hparams.xla_jit).
+
+With the JIT, tensorflow clusters the compilable ops (the encoder convolutions, the postnet and
+the math of the decoder cell) into fused kernels. Compilation happens on the first run of the
+graph and can fail (an op without an XLA kernel on the device, not enough memory, ...), so the
+session is checked with a first run and reopened without the JIT if that run fails.
+
+The sizes of the thread pools come from hparams.intra_op_threads and hparams.inter_op_threads,
+see synthesizer/autotune.py.
+
+The models run their windows through a WindowCallable, which keeps the python overhead of a call
+low.
+"""
+from synthesizer.infolog import log
+import tensorflow as tf
+import numpy as np
+import threading
+
+
+def session_config(xla_jit=False, intra_op_threads=0, inter_op_threads=0):
+    config = tf.ConfigProto()
+    #Memory allocation on the GPUs as needed
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    config.intra_op_parallelism_threads = intra_op_threads
+    config.inter_op_parallelism_threads = inter_op_threads
+    if xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+def open_session(hparams, graph=None, setup=None, check=None):
+    """
+    Opens an inference session on graph (the default graph if None).
+
+    Args:
+        hparams: the JIT is enabled if hparams.xla_jit is set, the thread pools are sized by
+        hparams.intra_op_threads and hparams.inter_op_threads
+        setup: callable, called with the session once it is opened (to initialize and restore the
+        variables)
+        check: callable, called with the session to run the graph once when the JIT is enabled.
+        If it raises a tensorflow error, the session is closed and reopened without the JIT
+    Returns:
+        (session, whether the JIT is enabled)
+    """
+    xla_jit = hparams.xla_jit
+    while True:
+        session = tf.Session(graph=graph, config=session_config(
+            xla_jit, hparams.intra_op_threads, hparams.inter_op_threads))
+        if setup is not None:
+            setup(session)
+        if not xla_jit or check is None:
+            return session, xla_jit
+        try:
+            check(session)
+            log("XLA JIT enabled")
+            return session, xla_jit
+        except tf.errors.OpError as e:
+            log("XLA JIT compilation failed, falling back to the regular executor: %s" % e.message)
+            session.close()
+            xla_jit = False
+
+
+class WindowCallable:
+    """
+    Runs fetches on batches of windows through Session.make_callable, which skips the feed_dict
+    processing of Session.run.
+
+    The inputs other than the windows (the lengths, the speaker embeddings and split_infos, which
+    only depend on the batch size) are built once per batch size. A single window is fed as a
+    view, a batch is copied into an input buffer of the calling thread, reused by its next batches
+    (windows can be synthesized from several threads at once).
+    """
+
+    def __init__(self, session, fetches, inputs, input_lengths, speaker_embeddings, split_infos=None):
+        """
+        Args:
+            inputs, input_lengths, speaker_embeddings, split_infos: the placeholders of the model,
+            split_infos is None if the graph does not use it (frozen graphs)
+        """
+        feed_list = [inputs, input_lengths, speaker_embeddings] + ([split_infos] if split_infos is not None else [])
+        self._callable = session.make_callable(fetches, feed_list=feed_list)
+        self._window_shape = inputs.shape.as_list()[1:]
+        self._embedding_size = speaker_embeddings.shape.as_list()[1]
+        self._split_infos = split_infos is not None
+        self._constants = {}
+        self._local = threading.local()
+
+    def constants(self, batch_size):
+        constants = self._constants.get(batch_size)
+        if constants is None:
+            constants = [np.full([batch_size], self._window_shape[0], dtype=np.int32),
+                         np.zeros([batch_size, self._embedding_size], dtype=np.float32)]
+            if self._split_infos:
+                constants.append(np.asarray([[self._window_shape[0], 0, 0, 0]], dtype=np.int32))
+            # Racing threads build the same arrays, either can be kept
+            self._constants[batch_size] = constants
+        return constants
+
+    def batch(self, windows):
+        if len(windows) == 1:
+            return np.asarray(windows[0], dtype=np.float32)[np.newaxis]
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or len(buffer) < len(windows):
+            buffer = self._local.buffer = np.empty([len(windows)] + self._window_shape, dtype=np.float32)
+        for i, window in enumerate(windows):
+            buffer[i] = window
+        # A leading slice of the buffer is contiguous, so it is fed without any copy
+        return buffer[:len(windows)]
+
+    def __call__(self, windows):
+        return self._callable(self.batch(windows), *self.constants(len(windows)))
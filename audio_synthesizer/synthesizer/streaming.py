@@ -0,0 +1,608 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+import numpy as np
+import cv2
+
+# Policies applied when a bounded buffer is full
+INGEST_POLICIES = ("block", "drop_oldest", "skip_window")
+# Directory of the files backing the shared rings (a tmpfs on Linux), see FrameRingBuffer
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+class Window(namedtuple("Window", ("frames", "num_valid", "is_final", "start"))):
+    """`namedtuple` describing a window handed out by a `WindowAssembler`.
+    Contains:
+      - `frames`: float32 array of shape [window_len, img_size, img_size, 3] holding the
+        normalized frames of the window.
+      - `num_valid`: number of real frames at the start of the window, the remaining ones are
+        padding (repeats of the last real frame).
+      - `is_final`: True if the window was flushed because the stream went idle, i.e. it ends the
+        current utterance.
+      - `start`: index of the first frame of the window among all the frames put in the
+        assembler, consecutive windows share frames if start increased by less than window_len.
+    """
+
+
+class FrameRef(namedtuple("FrameRef", ("path", "capacity", "frame_shape", "start", "length"))):
+    """`namedtuple` locating frames in the shared `FrameRingBuffer` of another process, sent to
+    a process instead of the frames themselves (see `FrameRingBuffer.attach`).
+    Contains:
+      - `path`: path of the file backing the ring.
+      - `capacity`, `frame_shape`: the sizes of the ring.
+      - `start`, `length`: absolute index of the first frame and number of frames.
+    """
+
+
+class WindowStitcher:
+    """Stitches the outputs of overlapping synthesis windows into one continuous stream.
+
+    Consecutive windows are expected to be shifted by hop_len units along their last axis
+    (mel frames for spectrograms, samples for waveforms). Every call to push() returns only the
+    part of the stream that no later window can change, so latency is bounded by the hop instead
+    of the full window. The fade_len units at the seam between two windows are linearly
+    crossfaded to hide the discontinuity at the window boundary.
+    """
+
+    def __init__(self, window_len, hop_len, fade_len):
+        """
+        Args:
+            window_len: integer, length of every window along the last axis
+            hop_len: integer, shift between two consecutive windows along the last axis
+            fade_len: integer, length of the crossfade between two windows. It is clamped to
+            both the hop and the overlap between two windows
+        """
+        if not 0 < hop_len <= window_len:
+            raise ValueError("hop_len must be in (0, window_len], got {}".format(hop_len))
+        self.window_len = window_len
+        self.hop_len = hop_len
+        self.fade_len = max(0, min(fade_len, hop_len, window_len - hop_len))
+
+        # Fade-in weights of the incoming window (the outgoing one gets 1 - ramp)
+        self._ramp = np.linspace(0., 1., self.fade_len + 2)[1:-1]
+        self._tail = None
+
+    def reset(self):
+        """
+        Forgets the pending tail, the next window is treated as the start of a new stream.
+        """
+        self._tail = None
+
+    def push(self, window, valid_len=None):
+        """
+        Adds the next window to the stream.
+        :param window: numpy array whose last axis has length window_len
+        :param valid_len: if set, the window is the last one of the stream and only its first
+        valid_len units are real. Everything up to valid_len is returned and the stream is reset
+        :return: the newly finalized part of the stream, as a new array
+        """
+        n, f = self.window_len, self.fade_len
+        assert window.shape[-1] == n, "expected a window of length {}".format(n)
+        end = n - f if valid_len is None else valid_len
+
+        if self._tail is None:
+            out = np.array(window[..., :end])
+        else:
+            start = n - self.hop_len - f
+            faded = self._tail * (1. - self._ramp) + window[..., start:start + f] * self._ramp
+            out = np.concatenate((faded, window[..., start + f:max(end, start + f)]), axis=-1)
+
+        # Keep the end of the window around until the next window overlaps it
+        self._tail = np.array(window[..., n - f:]) if valid_len is None else None
+        return out
+
+    def flush(self):
+        """
+        Ends the stream and returns whatever is still pending.
+        :return: the pending tail (possibly empty), or None if nothing was pushed
+        """
+        tail, self._tail = self._tail, None
+        return tail
+
+
+class FrameRingBuffer:
+    """Preallocated ring buffer of normalized frames.
+
+    Every frame is stored twice, at slot i and at slot i + capacity, so that any run of up to
+    capacity consecutive frames is available as one contiguous view of the storage, without
+    copying it out of the ring when it wraps around.
+    """
+
+    def __init__(self, capacity, frame_shape, dtype=np.float32, shared=False, path=None):
+        """
+        Args:
+            capacity: integer, number of frames the ring can hold
+            frame_shape: tuple, shape of a single frame, e.g. (img_size, img_size, 3)
+            dtype: dtype of the stored (normalized) frames
+            shared: allocate the ring in shared memory, other processes map its frames from
+            the FrameRef returned by ref()
+            path: map the shared ring of another process (read only) instead of allocating one
+        """
+        self.capacity = capacity
+        self.frame_shape = tuple(frame_shape)
+        shape = (2 * capacity,) + self.frame_shape
+        if path is not None:
+            self._storage = np.memmap(path, dtype=dtype, mode="r", shape=shape)
+        elif shared:
+            fd, path = tempfile.mkstemp(prefix="frames-",
+                                        dir=SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None)
+            os.close(fd)
+            self._storage = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+            # The file is removed with the ring, the processes that mapped it keep their mapping
+            weakref.finalize(self, os.remove, path)
+        else:
+            self._storage = np.zeros(shape, dtype=dtype)
+        self.path = path
+
+    @classmethod
+    def attach(cls, ref):
+        """
+        Maps the shared ring of the FrameRef of another process.
+        """
+        return cls(ref.capacity, ref.frame_shape, path=ref.path)
+
+    def ref(self, start, length):
+        """
+        :return: a FrameRef of the `length` frames starting at absolute index `start` of a
+        shared ring
+        """
+        if self.path is None:
+            raise ValueError("Only the frames of a shared ring can be referenced")
+        return FrameRef(self.path, self.capacity, self.frame_shape, start, length)
+
+    def write(self, index, frame):
+        """
+        Stores the frame with absolute index `index`, scaling its pixels from [0, 255] to [0, 1].
+        """
+        slot = index % self.capacity
+        dst = self._storage[slot]
+        dst[...] = frame
+        dst *= 1. / 255.
+        self._storage[slot + self.capacity] = dst
+
+    def window(self, start, length):
+        """
+        :return: a view on the `length` frames starting at absolute index `start`
+        """
+        assert length <= self.capacity, "a window can't be longer than the ring"
+        slot = start % self.capacity
+        return self._storage[slot:slot + length]
+
+
+class WindowAssembler:
+    """Assembles incoming frames into (possibly overlapping) windows.
+
+    Producers put() frames from any thread, the consumer blocks in get_window() and only wakes up
+    once a full window is ready, or once no frame arrived for idle_timeout seconds. In the latter
+    case the frames received so far are flushed as a final window, padded by repeating the last
+    frame, so that the tail of an utterance is not held back when the speaker stops.
+
+    Frames are written once into a FrameRingBuffer and full windows are handed out as views on
+    the ring. A window stays valid until it is passed to release(), producers block instead of
+    overwriting it when the ring is full. Windows must be released in the order they were handed
+    out.
+
+    The number of frames waiting for a window can be bounded with max_buffered. When the consumer
+    is slower than real time the policy then decides what happens to a new frame: "block" the
+    producer, "drop_oldest", i.e. drop the oldest hop of waiting frames, or "skip_window", i.e.
+    drop as many hops of the oldest waiting frames as needed for the next window to be made of the
+    most recent frames. Frames are always dropped by whole hops, so window starts stay a multiple
+    of hop_len apart (see EncoderFeatureCache and WindowStitcher).
+    """
+
+    def __init__(self, window_len, hop_len, frame_shape, capacity=None, idle_timeout=None,
+                 max_buffered=None, policy="block", shared=False):
+        """
+        Args:
+            window_len: integer, number of frames in a window
+            hop_len: integer, number of new frames between two consecutive windows
+            frame_shape: tuple, shape of a single (resized) frame
+            capacity: integer, number of frames the ring buffer can hold (defaults to two
+            windows). It has to cover max_buffered plus the frames of the pinned windows
+            idle_timeout: float, seconds without new frames after which a partial window is
+            flushed. None disables flushing
+            max_buffered: integer, maximum number of frames waiting for a window (at least
+            window_len). None only bounds them by the capacity of the ring
+            policy: one of INGEST_POLICIES, what to do with a new frame once max_buffered frames
+            are waiting
+            shared: keep the frames in shared memory, so that windows can be sent to another
+            process as a FrameRef (see frame_ref)
+        """
+        capacity = self._check_sizes(window_len, hop_len, capacity, max_buffered)
+        if policy not in INGEST_POLICIES:
+            raise ValueError("Unknown ingest policy: {}".format(policy))
+        self.window_len = window_len
+        self.hop_len = hop_len
+        self.idle_timeout = idle_timeout
+        self.max_buffered = max_buffered
+        self.policy = policy
+        self.dropped_frames = 0
+
+        self._shared = shared
+        self._ring = FrameRingBuffer(capacity, frame_shape, shared=shared)
+        self._frame_shape = tuple(frame_shape)
+
+        # Absolute frame indices: [_start, _end) are buffered, _pinned holds the starts of the
+        # windows handed out to the consumer and not released yet
+        self._start = 0
+        self._end = 0
+        self._pinned = deque()
+
+        self._cond = threading.Condition()
+        self._last_put = time.monotonic()
+        self._closed = False
+
+    @staticmethod
+    def _check_sizes(window_len, hop_len, capacity, max_buffered):
+        """
+        Validates the sizes given to the constructor, returns the capacity of the ring.
+        """
+        if not 0 < hop_len <= window_len:
+            raise ValueError("hop_len must be in (0, window_len], got {}".format(hop_len))
+        capacity = 2 * window_len if capacity is None else capacity
+        if capacity < window_len:
+            raise ValueError("capacity must be at least window_len, got {}".format(capacity))
+        if max_buffered is not None and max_buffered < window_len:
+            raise ValueError("max_buffered must be at least window_len, got {}".format(max_buffered))
+        return capacity
+
+    def qsize(self):
+        """
+        Number of buffered frames, including the ones shared with the previous window.
+        """
+        with self._cond:
+            return self._end - self._start
+
+    def reshape(self, window_len, hop_len, frame_shape, capacity=None, max_buffered=None):
+        """
+        Changes the windows and the frames handed out from now on, e.g. once the stream is
+        synthesized by a model with another window length or image size. Waits for the windows
+        handed out to be released, then moves the waiting frames (resized to frame_shape) to a new
+        ring, the next window starts with them. The oldest ones are dropped if they do not fit.
+        Takes the sizes of the constructor.
+        """
+        capacity = self._check_sizes(window_len, hop_len, capacity, max_buffered)
+        with self._cond:
+            while self._pinned:
+                self._cond.wait()
+            num_kept = min(self._end - self._start, capacity)
+            if max_buffered is not None:
+                num_kept = min(num_kept, max_buffered)
+            start = self._end - num_kept
+            self.dropped_frames += start - self._start
+
+            ring = FrameRingBuffer(capacity, frame_shape, shared=self._shared)
+            for i, frame in enumerate(self._ring.window(start, num_kept)):
+                if frame.shape != ring.frame_shape:
+                    frame = cv2.resize(frame, (ring.frame_shape[1], ring.frame_shape[0]))
+                ring.write(start + i, frame * 255.)
+            self._ring = ring
+            self._frame_shape = ring.frame_shape
+            self._start = start
+            self.window_len = window_len
+            self.hop_len = hop_len
+            self.max_buffered = max_buffered
+            self._cond.notify_all()
+
+    def put(self, frame):
+        """
+        Adds a frame of shape frame_shape (pixels in [0, 255]), frames of another size are resized
+        to it. Blocks while the ring is full, or while max_buffered frames are waiting with the
+        "block" policy.
+        """
+        with self._cond:
+            if frame.shape != self._frame_shape:
+                # Decoded for the frame shape before a reshape()
+                frame = cv2.resize(frame, (self._frame_shape[1], self._frame_shape[0]))
+            if self.max_buffered is not None:
+                self._shed()
+            while self._end - self._oldest() >= self._ring.capacity and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return
+            self._ring.write(self._end, frame)
+            self._end += 1
+            self._last_put = time.monotonic()
+
+            # Wake the consumer when a window is ready or when the idle timer has to be started
+            buffered = self._end - self._start
+            if buffered >= self.window_len or buffered == 1:
+                self._cond.notify_all()
+
+    def close(self):
+        """
+        Wakes up the consumer, get_window() returns None once the buffered frames are drained.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def release(self, window):
+        """
+        Lets producers overwrite the frames of a window once the consumer is done with it.
+        """
+        if window.is_final:
+            return # flushed windows are copies, they don't pin the ring
+        with self._cond:
+            self._pinned.popleft()
+            self._cond.notify_all()
+
+    def frame_ref(self, window):
+        """
+        :return: a FrameRef of the frames of a window handed out by a shared assembler, valid
+        until the window is released, or None for a flushed window (a copy, outside of the ring)
+        """
+        if window.is_final:
+            return None
+        with self._cond:
+            return self._ring.ref(window.start, len(window.frames))
+
+    def stats(self):
+        """
+        :return: a (number of frames waiting for a window, number of dropped frames) tuple
+        """
+        with self._cond:
+            return self._end - self._start, self.dropped_frames
+
+    def get_window(self):
+        """
+        Blocks until the next window is ready.
+        :return: a Window, or None if the assembler was closed
+        """
+        with self._cond:
+            while True:
+                buffered = self._end - self._start
+                if buffered >= self.window_len:
+                    window = self._pop_window()
+                    self._cond.notify_all() # wake producers blocked by max_buffered
+                    return window
+                if self._closed:
+                    return self._flush_window() if buffered else None
+                if self.idle_timeout is not None and buffered:
+                    remaining = self._last_put + self.idle_timeout - time.monotonic()
+                    if remaining <= 0:
+                        return self._flush_window()
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+    def try_get_window(self):
+        """
+        Non-blocking version of get_window() that only hands out full windows.
+        :return: a Window, or None if no full window is ready yet
+        """
+        with self._cond:
+            if self._end - self._start < self.window_len:
+                return None
+            window = self._pop_window()
+            self._cond.notify_all()
+            return window
+
+    def flush(self):
+        """
+        Hands out the buffered frames as a padded window right away, for consumers that drive
+        the idle timeout themselves (e.g. with an event loop timer).
+        :return: a Window with is_final set, or None if no frame is buffered
+        """
+        with self._cond:
+            if self._end == self._start:
+                return None
+            return self._flush_window()
+
+    def _shed(self):
+        buffered = self._end - self._start
+        if buffered < self.max_buffered:
+            return
+
+        if self.policy == "block":
+            while self._end - self._start >= self.max_buffered and not self._closed:
+                self._cond.wait()
+        elif self.policy == "drop_oldest":
+            self._start += self.hop_len
+            self.dropped_frames += self.hop_len
+        elif self.policy == "skip_window":
+            # Drop just enough hops for the next window to be completed by the newest frames
+            num_hops = (buffered - self.window_len) // self.hop_len + 1
+            self._start += num_hops * self.hop_len
+            self.dropped_frames += num_hops * self.hop_len
+
+    def _oldest(self):
+        return self._pinned[0] if self._pinned else self._start
+
+    def _pop_window(self):
+        start = self._start
+        frames = self._ring.window(start, self.window_len)
+        self._pinned.append(start)
+        # Keep the frames shared with the next window (none when windows are disjoint)
+        self._start += self.hop_len
+        return Window(frames, self.window_len, False, start)
+
+    def _flush_window(self):
+        start = self._start
+        num_valid = self._end - start
+        padded = np.empty((self.window_len,) + self._frame_shape, dtype=np.float32)
+        padded[:num_valid] = self._ring.window(start, num_valid)
+        padded[num_valid:] = padded[num_valid - 1]
+        self._start = self._end
+        self._cond.notify_all()
+        return Window(padded, num_valid, True, start)
+
+
+class EncoderFeatureCache:
+    """Caches the encoder convolution features of the frames shared by consecutive windows.
+
+    The encoder convolutions are not strided in time, so the features of a frame only depend on
+    the `radius` frames on each side of it. For a window overlapping the previous one, only the
+    new frames are run through the convolutions, together with a halo of `radius` frames on each
+    side, and the features of the other frames come from the cache. The encoder cost of a window
+    then grows with the hop instead of the window length.
+
+    The features of the last `radius` frames of a window lack their right context (the window ends
+    there) and are recomputed with the next window. The first frames of a window keep the features
+    computed with the real frames before them, where running the window from scratch would see
+    zero padding, so the output differs slightly from the uncached one at the window start.
+    """
+
+    def __init__(self, window_len, radius, capacity=None):
+        """
+        Args:
+            window_len: integer, number of frames in a window
+            radius: integer, number of frames on each side of a frame its features depend on
+            capacity: integer, number of frames whose features are kept (defaults to two windows)
+        """
+        capacity = 2 * window_len if capacity is None else capacity
+        if capacity < window_len:
+            raise ValueError("capacity must be at least window_len, got {}".format(capacity))
+        self.window_len = window_len
+        self.radius = radius
+        self.capacity = capacity
+
+        # Absolute frame indices: the features of [_begin, _end) are cached with their context
+        self._features = None
+        self._begin = 0
+        self._end = 0
+
+    def reset(self):
+        """
+        Drops the cached features, e.g. once a stream is interrupted.
+        """
+        self._begin = self._end = 0
+
+    def features(self, compute, frames, start):
+        """
+        Returns the features of a window, computing only the ones that are not cached.
+        Args:
+            compute: callable returning the features [n, num_features] of n consecutive frames
+            frames: array of the window_len frames of the window
+            start: absolute index of the first frame of the window (see Window.start)
+        """
+        end = start + len(frames)
+        if not self._begin <= start <= self._end:
+            self._begin = self._end = start # the window does not continue the cached frames
+
+        first_new = self._end
+        chunk_start = max(start, first_new - self.radius)
+        chunk = compute(frames[chunk_start - start:])
+        if self._features is None:
+            self._features = np.empty((self.capacity,) + chunk.shape[1:], dtype=chunk.dtype)
+        self._features[np.arange(first_new, end) % self.capacity] = chunk[first_new - chunk_start:]
+
+        self._end = max(first_new, end - self.radius)
+        self._begin = max(self._begin, end - self.capacity)
+        return self._features[np.arange(start, end) % self.capacity]
+
+
+class FrameDecoder:
+    """Decodes encoded face images (e.g. PNG payloads of MQTT messages) on a small thread pool.
+
+    submit() only enqueues the raw bytes, so it is cheap enough to be called from the network
+    thread. cv2 releases the GIL while decoding, so several frames are decoded in parallel, but
+    they are always delivered to the sink in the order they were submitted, from a delivery thread
+    of their own (the sink may block). Payloads that can't be decoded are logged and dropped.
+
+    The number of pending payloads can be bounded with max_pending. Once it is reached, submit()
+    either blocks ("block" policy) or drops the new payload (any other policy).
+    """
+
+    def __init__(self, sink, num_workers=2, size=None, max_pending=None, policy="block"):
+        """
+        Args:
+            sink: callable receiving every decoded frame (BGR uint8 image), in submission order
+            num_workers: integer, number of decoding threads
+            size: integer, if set frames are also resized to (size, size) on the worker threads
+            max_pending: integer, maximum number of payloads waiting to be decoded or delivered
+            policy: one of INGEST_POLICIES, what to do with a new payload once max_pending
+            payloads are pending
+        """
+        if policy not in INGEST_POLICIES:
+            raise ValueError("Unknown ingest policy: {}".format(policy))
+        self._sink = sink
+        self._size = size
+        self.max_pending = max_pending
+        self.policy = policy
+        self.dropped_frames = 0
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._pending = deque()
+        self._lock = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._deliver, name="frame-delivery", daemon=True)
+        self._thread.start()
+
+    def qsize(self):
+        """
+        Number of payloads submitted but not delivered to the sink yet.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, payload):
+        """
+        Schedules the decoding of an encoded image.
+        :param payload: bytes-like object holding the encoded image, it is not copied
+        """
+        with self._lock:
+            if self.max_pending is not None and len(self._pending) >= self.max_pending:
+                if self.policy != "block":
+                    self.dropped_frames += 1
+                    return
+                while len(self._pending) >= self.max_pending:
+                    self._lock.wait()
+            self._pending.append(self._executor.submit(self._decode, payload, self._size))
+            self._lock.notify_all()
+
+    def set_size(self, size):
+        """
+        Resizes the frames of the payloads submitted from now on to (size, size).
+        """
+        with self._lock:
+            self._size = size
+
+    def close(self):
+        """
+        Waits for the pending payloads to be decoded and delivered.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._thread.join()
+
+    @staticmethod
+    def _decode(payload, size):
+        frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is not None and size is not None:
+            frame = cv2.resize(frame, (size, size))
+        return frame
+
+    def _deliver(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._lock.wait()
+                if not self._pending:
+                    return
+                future = self._pending[0]
+
+            # Frames finishing out of order wait at the head of the queue for their predecessors
+            try:
+                frame = future.result()
+            except Exception as e:
+                print("dropping frame that could not be decoded: {}".format(e))
+                frame = None
+            else:
+                if frame is None:
+                    print("dropping frame that could not be decoded")
+            with self._lock:
+                self._pending.popleft()
+                self._lock.notify_all()
+
+            if frame is not None:
+                try:
+                    self._sink(frame)
+                except Exception:
+                    traceback.print_exc()
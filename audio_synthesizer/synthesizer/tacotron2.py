@@ -1,13 +1,12 @@
-from synthesizer.utils.text import text_to_sequence
 from synthesizer.infolog import log
 from synthesizer.models import create_model
-from synthesizer.utils import plot
+from synthesizer.utils import startup
+from synthesizer.session import open_session, WindowCallable
 from synthesizer import audio
 import tensorflow as tf
 import numpy as np
 import os
 from profilehooks import timecall
-from tensorflow.python.compiler.tensorrt import trt_convert as trt
 
 
 class Tacotron2:
@@ -34,18 +33,29 @@ class Tacotron2:
         # SV2TTS
         speaker_embeddings = tf.placeholder(tf.float32, shape=(None, 256), 
                name="speaker_embeddings")
+        # Chunk of consecutive frames whose encoder features are computed on their own
+        encoder_chunk = tf.placeholder(tf.float32, shape=(None, None, hparams.img_size,
+                                    hparams.img_size, 3), name="encoder_chunk")
         with tf.variable_scope("Tacotron_model") as scope:
             self.model = create_model(model_name, hparams)
             if gta:
                 self.model.initialize(inputs, input_lengths, speaker_embeddings, targets, gta=gta, split_infos=split_infos)
             else:
-                self.model.initialize(inputs[0], input_lengths[0], speaker_embeddings[0], split_infos=split_infos[0])
+                self.model.initialize(inputs[0], input_lengths[0], speaker_embeddings[0], split_infos=split_infos[0],
+                                      encoder_chunk=encoder_chunk)
             
             self.mel_outputs = self.model.tower_mel_outputs
             self.linear_outputs = self.model.tower_linear_outputs if (hparams.predict_linear and not gta) else None
             self.alignments = self.model.tower_alignments
             #self.stop_token_prediction = self.model.tower_stop_token_prediction
             self.targets = targets
+
+        # Stable names for the outputs, used when freezing the graph (see synthesizer/export.py)
+        tf.identity(self.mel_outputs[0], name="mel_outputs")
+        tf.identity(self.alignments[0], name="alignments")
+        tf.identity(self.model.tower_encoder_outputs[0], name="encoder_outputs")
+        if not gta:
+            tf.identity(self.model.tower_encoder_chunk_features[0], name="encoder_chunk_features")
         
         self.gta = gta
         self._hparams = hparams
@@ -63,60 +73,92 @@ class Tacotron2:
         self.speaker_embeddings = speaker_embeddings
         self.targets = targets
         self.split_infos = split_infos
+        self.encoder_chunk = encoder_chunk
+        if not gta:
+            self.encoder_chunk_features = self.model.tower_encoder_chunk_features[0]
+            self.encoder_conv_features = self.model.tower_encoder_conv_features[0]
+        startup.mark("graph built")
         
         log("Loading checkpoint: %s" % checkpoint_path)
-        #Memory allocation on the GPUs as needed
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.allow_soft_placement = True
-        
-        self.session = tf.Session(config=config)
-        self.session.run(tf.global_variables_initializer())
-        
         saver = tf.train.Saver()
-        saver.restore(self.session, hparams.eval_ckpt)
+        def restore(session):
+            session.run(tf.global_variables_initializer())
+            saver.restore(session, hparams.eval_ckpt)
+        def check(session):
+            window = np.zeros((hparams.T, hparams.img_size, hparams.img_size, 3), dtype=np.float32)
+            session.run(self.mel_outputs, feed_dict=self.my_synthesize_prep_input([window]))
+        self.session, self.xla_jit = open_session(hparams, setup=restore, check=check)
+        startup.mark("checkpoint restored")
+
+        # Windows are run through make_callable, unless use_callable is cleared (to compare both)
+        self.use_callable = not gta
+        if not gta:
+            self._synthesize_callable = WindowCallable(
+                self.session, [self.mel_outputs, self.alignments],
+                inputs[0], input_lengths[0], speaker_embeddings, split_infos[0])
 
         print ("LOADED MODEL")
 
     
     @timecall(immediate=True)
-    def my_synthesize_prep_input(self, seqs):
-        seqs = [seqs]
-        input_lengths = [len(seq) for seq in seqs]
-        input_seqs, max_seq_len = self._prepare_inputs(seqs)
-        split_infos = [[max_seq_len, 0, 0, 0]]
+    def my_synthesize_prep_input(self, windows):
+        # Windows all have hparams.T frames, so a batch is stacked without padding (and a single
+        # window is fed as a batch of one through a view, without any copy)
+        input_seqs = np.asarray(windows[0])[np.newaxis] if len(windows) == 1 else np.stack(windows)
+        input_lengths = [len(seqs) for seqs in windows]
+        split_infos = [[len(windows[0]), 0, 0, 0]]
         feed_dict = {
             self.inputs: input_seqs,
             self.input_lengths: np.asarray(input_lengths, dtype=np.int32),
-            self.speaker_embeddings:np.zeros([1,256], dtype=np.float32),
+            self.speaker_embeddings:np.zeros([len(windows),256], dtype=np.float32),
             self.split_infos: np.asarray(split_infos, dtype=np.int32),
         }
 
         return feed_dict
 
+    def my_encoder_features(self, chunk):
+        """
+        Encoder convolution features [frames, features] of a chunk of consecutive frames.
+        """
+        return self.session.run(self.encoder_chunk_features,
+                                feed_dict={self.encoder_chunk: np.asarray(chunk)[np.newaxis]})[0]
+
     @timecall(immediate=True)
     def my_synthesize_generate_mel_specs(self, feed_dict):
         mels, alignments = self.session.run([self.mel_outputs, self.alignments], feed_dict=feed_dict)
         return mels, alignments
 
 
-    @timecall(immediate=True)
     def my_synthesize(self, seqs):
         """
         Lighter synthesis function that directly returns the mel spectrograms.
         """
-        # Prepare the input
-        feed_dict = self.my_synthesize_prep_input(seqs)
-        
-        '''
-        mels, alignments, stop_tokens = self.session.run(
-            [self.mel_outputs, self.alignments, self.stop_token_prediction],
-            feed_dict=feed_dict)
-        mels, alignments, stop_tokens = list(mels[0]), alignments[0], stop_tokens[0]
-        '''
+        return self.my_synthesize_batch([seqs])
+
+    @timecall(immediate=True)
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the mel spectrograms of a batch of windows with a single session.run.
+        The encoder convolutions are skipped if their features [batch, frames, features] are given
+        (see my_encoder_features).
+        """
+        if self.use_callable and encoder_features is None:
+            mels, alignments = self._synthesize_callable(windows)
+        else:
+            # Prepare the input
+            feed_dict = self.my_synthesize_prep_input(windows)
+            if encoder_features is not None:
+                feed_dict[self.encoder_conv_features] = np.asarray(encoder_features)
+            
+            '''
+            mels, alignments, stop_tokens = self.session.run(
+                [self.mel_outputs, self.alignments, self.stop_token_prediction],
+                feed_dict=feed_dict)
+            mels, alignments, stop_tokens = list(mels[0]), alignments[0], stop_tokens[0]
+            '''
 
-        # Generate mel spectrograms
-        mels, alignments = self.my_synthesize_generate_mel_specs(feed_dict)
+            # Generate mel spectrograms
+            mels, alignments = self.my_synthesize_generate_mel_specs(feed_dict)
         mels, alignments= list(mels[0]), alignments[0]
 
         # Trim the output
@@ -133,6 +175,9 @@ class Tacotron2:
         return [mel.T for mel in mels], alignments
     
     def synthesize(self, texts, basenames, out_dir, log_dir, mel_filenames, embed_filenames):
+        # Only needed by this (offline) method, the text frontend and matplotlib are slow to import
+        from synthesizer.utils.text import text_to_sequence
+        from synthesizer.utils import plot
         hparams = self._hparams
         cleaner_names = [x.strip() for x in hparams.cleaners.split(",")]
               
@@ -1,10 +1,9 @@
-from synthesizer.utils.text import text_to_sequence
 from synthesizer.infolog import log
 from synthesizer.models import create_model
-from synthesizer.utils import plot
+from synthesizer.utils import startup
+from synthesizer.session import open_session, WindowCallable
 from synthesizer import audio
 import tensorflow as tf
-from tensorflow.python.tools import freeze_graph
 import numpy as np
 import os
 
@@ -33,22 +32,37 @@ class Tacotron2:
         # SV2TTS
         speaker_embeddings = tf.compat.v1.placeholder(tf.float32, shape=(None, 256), 
                name="speaker_embeddings")
+        # Chunk of consecutive frames whose encoder features are computed on their own
+        encoder_chunk = tf.compat.v1.placeholder(tf.float32, shape=(None, None, hparams.img_size,
+                                    hparams.img_size, 3), name="encoder_chunk")
         with tf.compat.v1.variable_scope("Tacotron_model") as scope:
             self.model = create_model(model_name, hparams)
             if gta:
                 self.model.initialize(inputs, input_lengths, speaker_embeddings, targets, gta=gta, split_infos=split_infos)
             else:
-                self.model.initialize(inputs[0], input_lengths[0], speaker_embeddings[0], split_infos=split_infos[0])
+                self.model.initialize(inputs[0], input_lengths[0], speaker_embeddings[0], split_infos=split_infos[0],
+                                      encoder_chunk=encoder_chunk)
             
             self.mel_outputs = self.model.tower_mel_outputs
             self.linear_outputs = self.model.tower_linear_outputs if (hparams.predict_linear and not gta) else None
             self.alignments = self.model.tower_alignments
             #self.stop_token_prediction = self.model.tower_stop_token_prediction
             self.targets = targets
-            self.mel_transposed = tf.transpose(tf.reshape(self.mel_outputs[0], [hparams.mel_step_size,hparams.num_mels]))
-            self.wav_output = audio.inv_mel_spectrogram_tensorflow(self.mel_transposed , hparams)
+            # Griffin-Lim inverts one spectrogram at a time, so it is mapped over the batch
+            self.wav_output = tf.map_fn(
+                lambda mel: audio.inv_mel_spectrogram_tensorflow(
+                    tf.transpose(tf.reshape(mel, [hparams.mel_step_size,hparams.num_mels])), hparams),
+                self.mel_outputs[0], dtype=tf.float32)
             print(self.wav_output)
 
+        # Stable names for the outputs, used when freezing the graph (see synthesizer/export.py)
+        tf.identity(self.mel_outputs[0], name="mel_outputs")
+        tf.identity(self.alignments[0], name="alignments")
+        tf.identity(self.model.tower_encoder_outputs[0], name="encoder_outputs")
+        if not gta:
+            tf.identity(self.model.tower_encoder_chunk_features[0], name="encoder_chunk_features")
+        tf.identity(self.wav_output, name="wav_outputs")
+
         self.gta = gta
         self._hparams = hparams
         #pad input sequences with the <pad_token> 0 ( _ )
@@ -65,18 +79,30 @@ class Tacotron2:
         self.speaker_embeddings = speaker_embeddings
         self.targets = targets
         self.split_infos = split_infos
+        self.encoder_chunk = encoder_chunk
+        if not gta:
+            self.encoder_chunk_features = self.model.tower_encoder_chunk_features[0]
+            self.encoder_conv_features = self.model.tower_encoder_conv_features[0]
+        startup.mark("graph built")
         
         log("Loading checkpoint: %s" % checkpoint_path)
-        #Memory allocation on the GPUs as needed
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.allow_soft_placement = True
-        
-        self.session = tf.Session(config=config)
-        self.session.run(tf.global_variables_initializer())
-        
         saver = tf.train.Saver()
-        saver.restore(self.session, hparams.eval_ckpt)
+        def restore(session):
+            session.run(tf.global_variables_initializer())
+            saver.restore(session, hparams.eval_ckpt)
+        def check(session):
+            window = np.zeros((hparams.T, hparams.img_size, hparams.img_size, 3), dtype=np.float32)
+            session.run(self.wav_output, feed_dict=self.my_synthesize_prep_input([window]))
+        self.session, self.xla_jit = open_session(hparams, setup=restore, check=check)
+        startup.mark("checkpoint restored")
+
+        # Windows are run through make_callable, unless use_callable is cleared (to compare both)
+        self.use_callable = not gta
+        if not gta:
+            placeholders = (inputs[0], input_lengths[0], speaker_embeddings, split_infos[0])
+            self._synthesize_callable = WindowCallable(self.session, self.wav_output, *placeholders)
+            self._synthesize_mels_callable = WindowCallable(
+                self.session, [self.mel_outputs, self.alignments], *placeholders)
         print ("LOADED MODEL")
 
         #save_path = saver.save(self.session, "/data/jlr_model/inference_model.ckpt")
@@ -88,62 +114,81 @@ class Tacotron2:
         """
         Lighter synthesis function that directly returns the mel spectrograms.
         """
-        
-        # Prepare the input
-        seqs = [seqs]
-        input_lengths = [len(seq) for seq in seqs]
-        input_seqs, max_seq_len = self._prepare_inputs(seqs)
-        split_infos = [[max_seq_len, 0, 0, 0]]
-        feed_dict = {
+        return self.my_synthesize_batch([seqs])[0]
+
+    def my_synthesize_prep_input(self, windows):
+        # Windows all have hparams.T frames, so a batch is stacked without padding (and a single
+        # window is fed as a batch of one through a view, without any copy)
+        input_seqs = np.asarray(windows[0])[np.newaxis] if len(windows) == 1 else np.stack(windows)
+        input_lengths = [len(seqs) for seqs in windows]
+        split_infos = [[len(windows[0]), 0, 0, 0]]
+        return {
             self.inputs: input_seqs,
             self.input_lengths: np.asarray(input_lengths, dtype=np.int32),
-            self.speaker_embeddings:np.zeros([1,256], dtype=np.float32),
+            self.speaker_embeddings:np.zeros([len(windows),256], dtype=np.float32),
             self.split_infos: np.asarray(split_infos, dtype=np.int32),
         }
-        
-        '''
-        mels, alignments, stop_tokens = self.session.run(
-            [self.mel_outputs, self.alignments, self.stop_token_prediction],
-            feed_dict=feed_dict)
-        mels, alignments, stop_tokens = list(mels[0]), alignments[0], stop_tokens[0]
-        '''
-        wav = self.session.run(
-            self.wav_output, feed_dict=feed_dict)
-        wav = audio.inv_preemphasis(wav, self._hparams.preemphasis, self._hparams.preemphasize)
-        return wav
-    
-    def save_as_pb(self):
 
-        # Save check point for graph frozen later
-        ckpt_filepath = self.save(directory='./', filename='test')
-        pbtxt_filename = filename + '.pbtxt'
-        pbtxt_filepath = os.path.join(directory, pbtxt_filename)
-        pb_filepath = os.path.join(directory, filename + '.pb')
-        # This will only save the graph but the variables will not be saved.
-        # You have to freeze your model first.
-        tf.train.write_graph(
-            graph_or_graph_def=self.sess.graph_def,
-            logdir=directory,
-            name=pbtxt_filename,
-            as_text=True)
+    def my_encoder_features(self, chunk):
+        """
+        Encoder convolution features [frames, features] of a chunk of consecutive frames.
+        """
+        return self.session.run(self.encoder_chunk_features,
+                                feed_dict={self.encoder_chunk: np.asarray(chunk)[np.newaxis]})[0]
 
-        # Freeze graph
-        # Method 1
-        freeze_graph.freeze_graph(input_graph=pbtxt_filepath, input_saver='', input_binary=False, input_checkpoint=ckpt_filepath, output_node_names='cnn/output', restore_op_name='save/restore_all', filename_tensor_name='save/Const:0', output_graph=pb_filepath, clear_devices=True, initializer_nodes='')
-        
-        # Method 2
-        '''
-        graph = tf.get_default_graph()
-        input_graph_def = graph.as_graph_def()
-        output_node_names = ['cnn/output']
-        output_graph_def = graph_util.convert_variables_to_constants(self.sess, input_graph_def, output_node_names)
-        with tf.gfile.GFile(pb_filepath, 'wb') as f:
-            f.write(output_graph_def.SerializeToString())
-        '''
-        
+    def my_synthesize_feed(self, windows, encoder_features=None):
+        feed_dict = self.my_synthesize_prep_input(windows)
+        if encoder_features is not None:
+            feed_dict[self.encoder_conv_features] = np.asarray(encoder_features)
+        return feed_dict
+
+    def my_synthesize_mels_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the mel spectrograms of a batch of windows, like the my_synthesize_batch of
+        tacotron2.py: only the mel outputs are fetched, so Griffin-Lim does not run.
+        """
+        if self.use_callable and encoder_features is None:
+            mels, alignments = self._synthesize_mels_callable(windows)
+        else:
+            mels, alignments = self.session.run([self.mel_outputs, self.alignments],
+                                                feed_dict=self.my_synthesize_feed(windows, encoder_features))
+        return [mel.T for mel in list(mels[0])], alignments[0]
+
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        """
+        Synthesizes the wavs of a batch of windows with a single session.run.
+        The encoder convolutions are skipped if their features [batch, frames, features] are given
+        (see my_encoder_features).
+        """
+        if self.use_callable and encoder_features is None:
+            wavs = self._synthesize_callable(windows)
+        else:
+            feed_dict = self.my_synthesize_feed(windows, encoder_features)
+            
+            '''
+            mels, alignments, stop_tokens = self.session.run(
+                [self.mel_outputs, self.alignments, self.stop_token_prediction],
+                feed_dict=feed_dict)
+            mels, alignments, stop_tokens = list(mels[0]), alignments[0], stop_tokens[0]
+            '''
+            wavs = self.session.run(
+                self.wav_output, feed_dict=feed_dict)
+        return [audio.inv_preemphasis(wav, self._hparams.preemphasis, self._hparams.preemphasize)
+                for wav in wavs]
+    
+    def save_as_pb(self, output_dir):
+        """
+        Freezes the restored model (mel and wav outputs) into output_dir, returns the .pb path.
+        """
+        from synthesizer import export
+        pb_filepath = export.frozen_graph_path(output_dir, self._hparams, with_wav=True)
+        export.freeze(self.session, pb_filepath, with_wav=True)
         return pb_filepath
     
     def synthesize(self, texts, basenames, out_dir, log_dir, mel_filenames, embed_filenames):
+        # Only needed by this (offline) method, the text frontend and matplotlib are slow to import
+        from synthesizer.utils.text import text_to_sequence
+        from synthesizer.utils import plot
         hparams = self._hparams
         cleaner_names = [x.strip() for x in hparams.cleaners.split(",")]
               
@@ -282,3 +327,25 @@ class Tacotron2:
         #Determine each mel length by the stop token predictions. (len = first occurence of 1 in stop_tokens row wise)
         output_lengths = [row.index(1) for row in np.round(stop_tokens).tolist()]
         return output_lengths
+
+
+class MelModel:
+    """
+    Mel spectrogram outputs of a wav model (the Tacotron2 of this module or a FrozenTacotronTpg),
+    with the synthesis API of the Tacotron2 of tacotron2.py. Both share the graph, the session
+    and the weights of the wav model.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self.session = model.session
+        self.xla_jit = model.xla_jit
+
+    def my_synthesize(self, seqs):
+        return self.my_synthesize_batch([seqs])
+
+    def my_synthesize_batch(self, windows, encoder_features=None):
+        return self._model.my_synthesize_mels_batch(windows, encoder_features)
+
+    def my_encoder_features(self, chunk):
+        return self._model.my_encoder_features(chunk)
@@ -0,0 +1,78 @@
+import asyncio
+
+from synthesizer.aio import AsyncMqttClient, LocalBroker, ingest
+
+
+async def wait_until(condition, timeout=1.):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_ingest_through_the_local_broker():
+    async def main():
+        broker = LocalBroker()
+        # Same arguments as the AsyncMqttClient factory of the runtime
+        receiver = broker.client("receiver", "localhost", 1883)
+        sender = broker.client("sender", "localhost", 1883)
+        await receiver.connect()
+        await sender.connect()
+        receiver.subscribe([("jetson/faces", 2), ("jetson/faces/+", 2)])
+
+        received = []
+        async def on_message(topic, payload):
+            if payload == b"bad":
+                raise ValueError("bad payload")
+            received.append((topic, payload))
+        task = asyncio.get_running_loop().create_task(ingest(receiver, on_message))
+
+        sender.publish("jetson/faces", b"1")
+        sender.publish("jetson/faces/a", b"bad")
+        sender.publish("jetson/faces/a", b"2")
+        sender.publish("jetson/audio", b"not subscribed")
+        sender.publish("jetson/faces/b", b"3")
+        await wait_until(lambda: len(received) == 3)
+
+        # Ingest ends once the receiver is disconnected
+        await receiver.disconnect()
+        await asyncio.wait_for(task, 1.)
+        return received
+    assert asyncio.run(main()) == [("jetson/faces", b"1"), ("jetson/faces/a", b"2"), ("jetson/faces/b", b"3")]
+
+
+def test_client_reconnects_with_backoff_and_subscribes_again():
+    async def main():
+        loop = asyncio.get_running_loop()
+        client = AsyncMqttClient("test", "localhost", min_reconnect_delay=0.01, max_reconnect_delay=0.03)
+        # Stand-ins for the network calls of the paho client
+        attempts, subscriptions = [], []
+        def reconnect():
+            attempts.append(loop.time())
+            if len(attempts) < 4:
+                raise ConnectionRefusedError("broker down")
+            client._on_connect(client._client, None, {}, 0)
+        client._client.reconnect = reconnect
+        client._client.subscribe = subscriptions.append
+        client._connected = loop.create_future()
+        client._on_connect(client._client, None, {}, 0)
+        client.subscribe([("jetson/faces", 2)])
+
+        client._on_disconnect(client._client, None, 1)
+        # A second notification of the same loss does not start another reconnection
+        client._on_disconnect(client._client, None, 1)
+        await wait_until(lambda: len(attempts) == 4)
+        await asyncio.sleep(0.05)
+
+        # The connection loss does not end the stream of messages, disconnect() does
+        assert client._messages.empty()
+        await asyncio.wait_for(client.disconnect(), 1.)
+        assert await client.get_message() is None
+        return attempts, subscriptions, client._reconnect_delay
+    attempts, subscriptions, delay = asyncio.run(main())
+    assert len(attempts) == 4
+    gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+    # 0.02, 0.03 (capped), 0.03 between the attempts
+    assert gaps[0] >= 0.015 and gaps[1] >= 0.025 and gaps[2] >= 0.025
+    assert subscriptions == [[("jetson/faces", 2)], [("jetson/faces", 2)]]
+    assert delay == 0.01
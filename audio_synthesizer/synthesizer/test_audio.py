@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from synthesizer import audio
+from synthesizer.hparams import hparams
+
+
+def test_numpy_griffin_lim_runs_after_the_graph_is_built():
+    # Built by the wav output of the shared graph (see tacotron_tpg.py)
+    with tf.Graph().as_default():
+        mel = tf.placeholder(tf.float32, [hparams.num_mels, hparams.mel_step_size])
+        audio.inv_mel_spectrogram_tensorflow(mel, hparams)
+    mel = np.full((hparams.num_mels, hparams.mel_step_size), -hparams.max_abs_value / 2, dtype=np.float32)
+    wav = audio.inv_mel_spectrogram(mel, hparams)
+    assert len(wav) > 0 and np.all(np.isfinite(wav))
+
+def test_mel_bases_follow_the_hparams():
+    other = type(hparams)(**hparams.values())
+    other.set_hparam("num_mels", hparams.num_mels // 2)
+    for hp in (hparams, other, hparams):
+        mel = np.ones((hp.num_mels, 4), dtype=np.float32)
+        assert audio._mel_to_linear(mel, hp).shape == (hp.n_fft // 2 + 1, 4)
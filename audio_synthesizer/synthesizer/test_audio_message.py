@@ -0,0 +1,79 @@
+import os
+import struct
+import numpy as np
+import pytest
+
+import audio_message
+from audio_message import (decode_audio_message, encode_audio_message, is_audio_message, split_audio_messages,
+                           track_sequence)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_message_round_trip():
+    samples = np.array([0, 1, -1, 32767, -32768, 40000.4, -40000.6])
+    payload = encode_audio_message(samples, 16000, stream_id="cam-é", sequence=7, start_time=12.5,
+                                   end_of_stream=True)
+    assert is_audio_message(payload)
+    message = decode_audio_message(payload)
+    assert message.samples.tolist() == [0, 1, -1, 32767, -32768, 32767, -32768]
+    assert (message.sample_rate, message.stream_id, message.sequence) == (16000, "cam-é", 7)
+    assert message.start_time == 12.5 and message.sent_time >= 12.5
+    assert message.end_of_stream
+
+def test_messages_keep_the_gaps_in_their_sequence():
+    payloads = [encode_audio_message(np.zeros(4), 16000, stream_id="a", sequence=sequence)
+                for sequence in (0, 1, 5, 2 ** 32 - 1)]
+    messages = [decode_audio_message(payload) for payload in payloads]
+    assert [message.sequence for message in messages] == [0, 1, 5, 2 ** 32 - 1]
+    assert not any(message.end_of_stream for message in messages)
+    # Without a start time, the audio starts when the message is sent
+    assert all(message.start_time == message.sent_time for message in messages)
+
+@pytest.mark.parametrize("payload", [
+    b"RIFF\0\0\0\0WAVEfmt ",
+    b"JLRA\x01",
+    encode_audio_message(np.zeros(2), 16000)[:-4].replace(b"JLRA", b"JLRB", 1),
+])
+def test_bad_headers_are_rejected(payload):
+    with pytest.raises(ValueError, match="not an audio message"):
+        decode_audio_message(payload)
+
+def test_other_versions_are_rejected():
+    payload = bytearray(encode_audio_message(np.zeros(2), 16000))
+    struct.pack_into("<B", payload, len(audio_message.MAGIC), audio_message.VERSION + 1)
+    with pytest.raises(ValueError, match="version"):
+        decode_audio_message(bytes(payload))
+
+def test_window_is_split_into_chunks_and_reassembled():
+    wav = np.arange(-5000, 5000, 3.7)
+    payloads = split_audio_messages(wav, 16000, 1000, stream_id="a", first_sequence=4, start_time=1.,
+                                    end_of_stream=True)
+    messages = [decode_audio_message(payload) for payload in payloads]
+    assert [len(message.samples) for message in messages] == [1000, 1000, 703]
+    assert [message.sequence for message in messages] == [4, 5, 6]
+    assert [message.end_of_stream for message in messages] == [False, False, True]
+    # The player writes the samples of the chunks one after the other
+    assert np.array_equal(np.concatenate([message.samples for message in messages]), np.rint(wav))
+    last_sequences = {"a": 3}
+    assert [track_sequence(last_sequences, message) for message in messages] == [0, 0, 0]
+
+def test_whole_window_without_chunks():
+    payloads = split_audio_messages(np.ones(10), 16000, 0)
+    assert len(payloads) == 1 and len(decode_audio_message(payloads[0]).samples) == 10
+
+def test_lost_and_restarted_chunks_are_detected():
+    messages = [decode_audio_message(payload) for payload in split_audio_messages(np.zeros(50), 16000, 10)]
+    last_sequences = {}
+    assert [track_sequence(last_sequences, messages[i]) for i in (0, 1, 4, 0)] == [0, 0, 2, -1]
+    # Each stream has its own sequence
+    other = decode_audio_message(encode_audio_message(np.zeros(2), 16000, stream_id="b", sequence=9))
+    assert track_sequence(last_sequences, other) == 0
+    assert last_sequences == {"": 0, "b": 9}
+
+def test_synthesizer_and_player_share_the_same_module():
+    with open(os.path.join(ROOT, "audio_synthesizer", "audio_message.py"), "rb") as f:
+        synthesizer = f.read()
+    with open(os.path.join(ROOT, "audio_player", "audio_message.py"), "rb") as f:
+        player = f.read()
+    assert synthesizer == player
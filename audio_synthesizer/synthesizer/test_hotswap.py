@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+import pytest
+
+from synthesizer import hotswap
+from synthesizer.hotswap import SwappableSynthesizer
+
+
+@pytest.fixture
+def swappable(monkeypatch, closed, new_synthesizer):
+    # The new preset changes the window length and image size of the stream
+    monkeypatch.setattr(hotswap, "load_hparams",
+                        lambda preset, ckpt, current=None: SimpleNamespace(T=3, img_size=4, eval_ckpt=ckpt))
+    first = new_synthesizer(SimpleNamespace(T=2, img_size=2, eval_ckpt="first"))
+    return SwappableSynthesizer(first, True, new_synthesizer), closed
+
+
+def test_swap_closes_an_idle_model_at_once(swappable):
+    synthesizer, closed = swappable
+    synthesizer.swap("second", "preset")
+    assert closed == ["first"]
+    assert (synthesizer.generation, synthesizer.hparams.T) == (1, 3)
+    assert synthesizer.synthesize_batch([None]) == ["second"]
+
+def test_previous_model_is_closed_after_its_last_call(swappable):
+    synthesizer, closed = swappable
+    with synthesizer.pinned() as (first, generation):
+        with synthesizer.pinned():
+            synthesizer.swap("second", "preset")
+        # Still in use by the outer call, which keeps running on the previous model
+        assert closed == []
+        assert first.synthesize_batch([None]) == ["first"]
+        assert synthesizer.synthesize_batch([None]) == ["second"]
+    assert closed == ["first"]
+    assert generation == 0
+
+def test_each_swap_retires_the_model_it_replaces(swappable):
+    synthesizer, closed = swappable
+    with synthesizer.pinned():
+        synthesizer.swap("second", "preset")
+        with synthesizer.pinned() as (_, generation):
+            synthesizer.swap("third", "preset")
+            assert generation == 1
+        assert closed == ["second"]
+    assert closed == ["second", "first"]
+    assert synthesizer.generation == 2
+    synthesizer.close()
+    assert closed == ["second", "first", "third"]
@@ -0,0 +1,74 @@
+import threading
+import pytest
+
+from synthesizer.pipeline import StagePipeline, WindowBatcher
+
+
+def test_batcher_returns_every_output_to_its_caller():
+    batches = []
+    def run_batch(inputs):
+        batches.append(list(inputs))
+        return [x * 10 for x in inputs]
+    batcher = WindowBatcher(run_batch, max_batch_size=3, max_delay=0.05)
+    futures = [batcher.submit(i) for i in range(7)]
+    assert [future.result(1.) for future in futures] == [i * 10 for i in range(7)]
+    batcher.close()
+    # Inputs keep their submission order and batches never exceed max_batch_size
+    assert [x for batch in batches for x in batch] == list(range(7))
+    assert max(len(batch) for batch in batches) <= 3
+    assert len(batches) < 7
+
+def test_batcher_groups_the_windows_of_several_threads():
+    started = threading.Barrier(4)
+    batches = []
+    def run_batch(inputs):
+        batches.append(len(inputs))
+        return inputs
+    batcher = WindowBatcher(run_batch, max_batch_size=4, max_delay=0.5)
+    results = {}
+    def stream(i):
+        started.wait()
+        results[i] = batcher.submit(i).result(2.)
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == {i: i for i in range(4)}
+    assert batches == [4]
+
+def test_batcher_fails_the_whole_batch_and_keeps_running():
+    calls = []
+    def run_batch(inputs):
+        calls.append(list(inputs))
+        if len(calls) == 1:
+            raise RuntimeError("model failure")
+        return inputs
+    batcher = WindowBatcher(run_batch, max_batch_size=2, max_delay=0.05)
+    failed = [batcher.submit(0), batcher.submit(1)]
+    for future in failed:
+        with pytest.raises(RuntimeError):
+            future.result(1.)
+    assert batcher.submit(2).result(1.) == 2
+    batcher.close()
+
+def test_batcher_close_runs_the_submitted_windows():
+    batcher = WindowBatcher(lambda inputs: inputs, max_batch_size=2, max_delay=0.)
+    futures = [batcher.submit(i) for i in range(5)]
+    batcher.close()
+    assert [future.result(0) for future in futures] == list(range(5))
+
+def test_batcher_rejects_an_empty_batch_size():
+    with pytest.raises(ValueError):
+        WindowBatcher(lambda inputs: inputs, max_batch_size=0)
+
+
+def test_pipeline_runs_the_stages_in_order():
+    out = []
+    pipeline = StagePipeline([("double", lambda x: x * 2), ("skip_odd", lambda x: x if x % 4 else None),
+                              ("collect", out.append)], depth=1)
+    for i in range(6):
+        pipeline.put(i)
+    pipeline.close()
+    assert out == [2, 6, 10]
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+import pytest
+
+from synthesizer import pool
+from synthesizer.pool import ModelPool, model_bytes
+
+
+def checkpoint(tmp_path, name, size):
+    """A checkpoint of size bytes, split like a tensorflow one."""
+    prefix = str(tmp_path / name)
+    for suffix, part in ((".data-00000-of-00001", size - size // 2), (".index", size // 4),
+                         (".meta", size // 2 - size // 4)):
+        with open(prefix + suffix, "wb") as f:
+            f.write(b"\0" * part)
+    return prefix
+
+def hparams(ckpt):
+    return SimpleNamespace(T=2, img_size=2, eval_ckpt=ckpt)
+
+
+@pytest.fixture
+def make_pool(tmp_path, monkeypatch, closed, new_synthesizer):
+    monkeypatch.setattr(pool, "load_hparams", lambda preset, ckpt, current=None: hparams(ckpt))
+    def make(memory_budget):
+        default = new_synthesizer(hparams(checkpoint(tmp_path, "default", 100)))
+        return ModelPool(new_synthesizer, True, default, memory_budget=memory_budget), closed
+    return make
+
+def key(tmp_path, name):
+    return (checkpoint(tmp_path, name, 100), "preset")
+
+
+def test_model_bytes_counts_every_file_of_the_checkpoint(tmp_path):
+    assert model_bytes(hparams(checkpoint(tmp_path, "model", 100))) == 100
+
+def test_pool_evicts_the_least_recently_used_model(tmp_path, make_pool):
+    models, closed = make_pool(300)
+    a, b, c = (key(tmp_path, name) for name in "abc")
+    for k in (a, b, a, c):
+        with models.pinned(k):
+            pass
+    assert closed == [b[0]]
+    assert models.loaded_bytes() == 300
+
+def test_pool_budget_includes_the_default_model(tmp_path, make_pool):
+    models, closed = make_pool(150)
+    a = key(tmp_path, "a")
+    with models.pinned(a) as (_, first):
+        pass
+    # The default model takes 100 of the 150 bytes, the model is closed once its call is done
+    assert closed == [a[0]]
+    assert models.loaded_bytes() == 100
+    with models.pinned(a) as (_, second):
+        pass
+    assert second != first
+
+def test_pool_does_not_evict_a_model_in_use(tmp_path, make_pool):
+    models, closed = make_pool(200)
+    a, b = key(tmp_path, "a"), key(tmp_path, "b")
+    with models.pinned(a):
+        with models.pinned(b):
+            assert closed == []
+            assert models.loaded_bytes() == 300
+        # b is more recently used, but a is still in use
+        assert closed == [b[0]]
+    assert models.loaded_bytes() == 200
@@ -0,0 +1,260 @@
+import os
+import threading
+import numpy as np
+import pytest
+import cv2
+
+from synthesizer.streaming import EncoderFeatureCache, FrameDecoder, FrameRingBuffer, WindowAssembler, WindowStitcher
+
+FRAME_SHAPE = (2, 2, 3)
+
+
+def frame(value):
+    return np.full(FRAME_SHAPE, value, dtype=np.uint8)
+
+def values(frames):
+    """Pixel value of each frame of a window, back in [0, 255]."""
+    return [int(round(f[0, 0, 0] * 255)) for f in frames]
+
+
+def test_ring_window_is_contiguous_across_the_wrap():
+    ring = FrameRingBuffer(4, FRAME_SHAPE)
+    for i in range(6):
+        ring.write(i, frame(i))
+    window = ring.window(2, 4)
+    assert values(window) == [2, 3, 4, 5]
+    # A view on the mirrored storage, not a copy
+    assert np.shares_memory(window, ring._storage)
+
+def test_ring_normalizes_the_frames():
+    ring = FrameRingBuffer(2, FRAME_SHAPE)
+    ring.write(0, frame(255))
+    assert np.allclose(ring.window(0, 1), 1.)
+
+
+def test_assembler_hands_out_overlapping_windows():
+    assembler = WindowAssembler(4, 2, FRAME_SHAPE, capacity=8)
+    for i in range(6):
+        assembler.put(frame(i))
+    first = assembler.get_window()
+    assert (first.start, first.num_valid, first.is_final) == (0, 4, False)
+    assert values(first.frames) == [0, 1, 2, 3]
+    second = assembler.try_get_window()
+    assert second.start == 2
+    assert values(second.frames) == [2, 3, 4, 5]
+    assert assembler.try_get_window() is None
+
+def test_assembler_pads_the_flushed_window():
+    assembler = WindowAssembler(4, 4, FRAME_SHAPE)
+    for i in range(3):
+        assembler.put(frame(i))
+    assembler.close()
+    window = assembler.get_window()
+    assert (window.num_valid, window.is_final) == (3, True)
+    assert values(window.frames) == [0, 1, 2, 2]
+    assert assembler.get_window() is None
+
+def test_pinned_window_blocks_the_producer_until_released():
+    assembler = WindowAssembler(4, 4, FRAME_SHAPE, capacity=4)
+    for i in range(4):
+        assembler.put(frame(i))
+    window = assembler.get_window()
+    producer = threading.Thread(target=assembler.put, args=(frame(4),), daemon=True)
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    # The frames of the pinned window were not overwritten
+    assert values(window.frames) == [0, 1, 2, 3]
+    assembler.release(window)
+    producer.join(1.)
+    assert not producer.is_alive()
+    assert assembler.qsize() == 1
+
+def test_skip_window_drops_whole_hops():
+    assembler = WindowAssembler(4, 2, FRAME_SHAPE, capacity=16, max_buffered=4, policy="skip_window")
+    for i in range(6):
+        assembler.put(frame(i))
+    assert assembler.stats() == (4, 2)
+    window = assembler.get_window()
+    assert window.start == 2
+    assert values(window.frames) == [2, 3, 4, 5]
+
+def test_drop_oldest_drops_one_hop_at_a_time():
+    assembler = WindowAssembler(4, 2, FRAME_SHAPE, capacity=16, max_buffered=6, policy="drop_oldest")
+    for i in range(10):
+        assembler.put(frame(i))
+    assert assembler.stats() == (6, 4)
+    first = assembler.get_window()
+    second = assembler.get_window()
+    # The windows still start a whole number of hops apart
+    assert (first.start, second.start) == (4, 6)
+    assert values(first.frames) == [4, 5, 6, 7]
+    assert values(second.frames) == [6, 7, 8, 9]
+
+def test_block_policy_waits_for_the_consumer():
+    assembler = WindowAssembler(4, 4, FRAME_SHAPE, capacity=16, max_buffered=4, policy="block")
+    for i in range(4):
+        assembler.put(frame(i))
+    producer = threading.Thread(target=assembler.put, args=(frame(4),), daemon=True)
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    assembler.get_window()
+    producer.join(1.)
+    assert not producer.is_alive()
+    assert assembler.stats() == (1, 0)
+
+def test_reshape_carries_the_waiting_frames_to_the_new_windows():
+    assembler = WindowAssembler(4, 2, FRAME_SHAPE, capacity=8)
+    for i in range(6):
+        assembler.put(frame(i))
+    window = assembler.get_window()
+    reshaping = threading.Thread(target=assembler.reshape, args=(3, 3, (4, 4, 3)), kwargs={"max_buffered": 3},
+                                 daemon=True)
+    reshaping.start()
+    reshaping.join(0.1)
+    # The frames of the pinned window are not moved before it is released
+    assert reshaping.is_alive()
+    assembler.release(window)
+    reshaping.join(1.)
+    assert not reshaping.is_alive()
+    # Only the newest max_buffered frames are kept, resized to the new frame shape
+    assert assembler.stats() == (3, 1)
+    window = assembler.get_window()
+    assert (window.start, window.frames.shape) == (3, (3, 4, 4, 3))
+    assert values(window.frames) == [3, 4, 5]
+    assembler.release(window)
+    # Frames decoded for the previous shape are resized as they arrive
+    assembler.put(frame(6))
+    assert assembler.qsize() == 1
+
+
+def test_shared_ring_is_mapped_from_the_frame_ref():
+    assembler = WindowAssembler(4, 2, FRAME_SHAPE, capacity=8, shared=True)
+    for i in range(4):
+        assembler.put(frame(i))
+    window = assembler.get_window()
+    ref = assembler.frame_ref(window)
+    assert (ref.start, ref.length) == (0, 4)
+    assert values(FrameRingBuffer.attach(ref).window(ref.start, ref.length)) == [0, 1, 2, 3]
+    # Flushed windows are copies, outside of the ring
+    assembler.close()
+    assert assembler.frame_ref(assembler.get_window()) is None
+    # The file backing the ring goes away with it
+    del assembler
+    assert not os.path.exists(ref.path)
+
+
+def test_assembler_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        WindowAssembler(4, 5, FRAME_SHAPE)
+    with pytest.raises(ValueError):
+        WindowAssembler(4, 2, FRAME_SHAPE, capacity=3)
+    with pytest.raises(ValueError):
+        WindowAssembler(4, 2, FRAME_SHAPE, policy="unknown")
+
+
+def windows_of(signal, window_len, hop_len, count):
+    return [signal[i * hop_len:i * hop_len + window_len] for i in range(count)]
+
+def test_stitcher_rebuilds_a_continuous_signal():
+    signal = np.arange(40, dtype=np.float32)
+    stitcher = WindowStitcher(8, 4, 2)
+    windows = windows_of(signal, 8, 4, 5)
+    out = [stitcher.push(window) for window in windows[:-1]]
+    out.append(stitcher.push(windows[-1], valid_len=5))
+    # Every window returns the hop it finalized, the last one everything up to valid_len
+    assert [len(chunk) for chunk in out] == [6, 4, 4, 4, 3]
+    assert np.allclose(np.concatenate(out), signal[:4 * 4 + 5])
+    assert stitcher.flush() is None
+
+def test_stitcher_crossfades_the_seam():
+    stitcher = WindowStitcher(8, 4, 2)
+    stitcher.push(np.zeros(8))
+    seam = stitcher.push(np.ones(8))
+    # The tail of the first window fades out while the second one fades in
+    assert np.allclose(seam[:2], [1. / 3, 2. / 3])
+    assert np.allclose(seam[2:], 1.)
+
+def test_stitcher_without_overlap_concatenates():
+    stitcher = WindowStitcher(4, 4, 2)
+    assert stitcher.fade_len == 0
+    out = [stitcher.push(window) for window in windows_of(np.arange(12.), 4, 4, 3)]
+    assert np.allclose(np.concatenate(out), np.arange(12.))
+
+def test_stitcher_reset_starts_a_new_stream():
+    stitcher = WindowStitcher(8, 4, 2)
+    stitcher.push(np.zeros(8))
+    stitcher.reset()
+    assert len(stitcher.push(np.ones(8))) == 6
+
+
+RADIUS = 1
+# Every frame is a distinct power of two, so a feature tells which frames it was computed from
+SIGNAL = 2. ** np.arange(40).reshape(-1, 1)
+
+def moving_sum(chunk):
+    """Features with a temporal radius of RADIUS, zero padded at the ends like the encoder."""
+    padded = np.pad(chunk, ((RADIUS, RADIUS), (0, 0)), mode="constant")
+    return np.stack([padded[i:i + 2 * RADIUS + 1].sum(axis=0) for i in range(len(chunk))])
+
+def streamed_features(start, end):
+    """Features expected from the cache: every frame sees the real frames before it, the frames
+    at the end of the window see its end."""
+    return np.stack([SIGNAL[max(0, k - RADIUS):min(end, k + RADIUS + 1)].sum(axis=0)
+                     for k in range(start, end)])
+
+def test_encoder_cache_only_computes_the_new_frames_and_their_halo():
+    cache = EncoderFeatureCache(8, RADIUS)
+    chunks = []
+    def compute(chunk):
+        chunks.append(len(chunk))
+        return moving_sum(chunk)
+    for start in range(0, 20, 2):
+        features = cache.features(compute, SIGNAL[start:start + 8], start)
+        assert np.array_equal(features, streamed_features(start, start + 8))
+    # The hop of new frames, the radius frames recomputed before them and the halo of the
+    # previous window's end
+    assert chunks == [8] + [2 + 2 * RADIUS] * 9
+
+def test_encoder_cache_recomputes_a_window_that_does_not_continue():
+    cache = EncoderFeatureCache(8, RADIUS)
+    chunks = []
+    def compute(chunk):
+        chunks.append(len(chunk))
+        return moving_sum(chunk)
+    cache.features(compute, SIGNAL[0:8], 0)
+    # Frames 8 to 11 were dropped, the window has no cached frame
+    features = cache.features(compute, SIGNAL[12:20], 12)
+    assert np.array_equal(features, moving_sum(SIGNAL[12:20]))
+    cache.reset()
+    cache.features(compute, SIGNAL[14:22], 14)
+    assert chunks == [8, 8, 8]
+
+
+def encoded(value):
+    return cv2.imencode(".png", np.full((4, 4, 3), value, dtype=np.uint8))[1].tobytes()
+
+def test_decoder_delivers_in_order_and_drops_bad_payloads():
+    delivered = []
+    decoder = FrameDecoder(lambda f: delivered.append((int(f[0, 0, 0]), threading.current_thread().name)),
+                           num_workers=3, size=2)
+    for payload in [encoded(1), b"", encoded(2), b"not an image", encoded(3)]:
+        decoder.submit(payload)
+    decoder.close()
+    assert [value for value, _ in delivered] == [1, 2, 3]
+    # The sink never runs on the thread of submit()
+    assert all(name == "frame-delivery" for _, name in delivered)
+    assert decoder.qsize() == 0
+
+def test_decoder_survives_a_failing_sink():
+    delivered = []
+    def sink(f):
+        delivered.append(int(f[0, 0, 0]))
+        if len(delivered) == 1:
+            raise RuntimeError("sink failure")
+    decoder = FrameDecoder(sink)
+    decoder.submit(encoded(1))
+    decoder.submit(encoded(2))
+    decoder.close()
+    assert delivered == [1, 2]
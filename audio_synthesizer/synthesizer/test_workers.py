@@ -0,0 +1,75 @@
+import os
+import signal
+import time
+import numpy as np
+import pytest
+
+from synthesizer.streaming import FrameRingBuffer, WindowAssembler
+from synthesizer.workers import WorkerLost, WorkerPool
+
+# Set in the main process by the test, a forked worker would inherit it
+STATE = {}
+
+
+class RingReader:
+    def __init__(self, name):
+        self.name = name
+
+    def state(self):
+        return self.name, dict(STATE), os.getpid()
+
+    def read(self, ref):
+        frames = FrameRingBuffer.attach(ref).window(ref.start, ref.length)
+        return [int(round(f[0, 0, 0] * 255)) for f in frames]
+
+
+class Sleeper:
+    def __init__(self):
+        self.model = "default"
+
+    def pid(self):
+        return os.getpid()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def swap(self, model):
+        self.model = model
+
+    def get_model(self):
+        return self.model
+
+
+def test_workers_start_fresh_and_map_the_shared_frames():
+    STATE["main"] = True
+    assembler = WindowAssembler(4, 2, (2, 2, 3), capacity=8, shared=True)
+    for i in range(6):
+        assembler.put(np.full((2, 2, 3), i, dtype=np.uint8))
+    first = assembler.get_window()
+    second = assembler.get_window()
+    workers = WorkerPool(1, RingReader, "reader")
+    try:
+        name, state, pid = workers.submit("a", "state").result(60)
+        assert (name, state) == ("reader", {})
+        assert pid != os.getpid()
+        refs = [assembler.frame_ref(window) for window in (first, second)]
+        assert [workers.submit("a", "read", ref).result(60) for ref in refs] == [[0, 1, 2, 3], [2, 3, 4, 5]]
+    finally:
+        workers.close()
+        STATE.clear()
+
+def test_dead_worker_fails_its_call_and_its_replacement_gets_the_broadcasts():
+    workers = WorkerPool(1, Sleeper, check_interval=0.05)
+    try:
+        workers.broadcast("swap", "first", replay=True)
+        workers.broadcast("swap", "second", replay=True)
+        pid = workers.submit("a", "pid").result(60)
+        running = workers.submit("a", "sleep", 5)
+        time.sleep(1)
+        os.kill(pid, signal.SIGKILL)
+        with pytest.raises(WorkerLost):
+            running.result(4)
+        assert workers.submit("a", "pid").result(60) != pid
+        assert workers.submit("a", "get_model").result(60) == "second"
+    finally:
+        workers.close()
@@ -1,3 +1,7 @@
+import threading
+import time
+
+
 class ValueWindow():
   def __init__(self, window_size=100):
     self._window_size = window_size
@@ -20,3 +24,31 @@ class ValueWindow():
 
   def reset(self):
     self._values = []
+
+
+class Timeline():
+  """Records named milestones (e.g. of the startup of a service) and reports when each one was
+  reached, relative to the creation of the timeline and to the previous milestone.
+  """
+  def __init__(self):
+    self._start = time.time()
+    self._marks = []
+    self._lock = threading.Lock()
+
+  def mark(self, name):
+    with self._lock:
+      self._marks.append((time.time(), name))
+
+  def report(self, title="startup timeline"):
+    with self._lock:
+      marks = sorted(self._marks)
+    lines = [title + ":"]
+    previous = self._start
+    for t, name in marks:
+      lines.append("  {:7.2f} s (+{:6.2f} s)  {}".format(t - self._start, t - previous, name))
+      previous = t
+    return "\n".join(lines)
+
+
+# Timeline of the process startup, created by the first import of synthesizer.utils
+startup = Timeline()
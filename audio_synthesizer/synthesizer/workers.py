@@ -0,0 +1,204 @@
+"""
+Worker processes, each owning a loaded model, to scale the synthesis of many streams across the CPU
+cores: the model, Griffin-Lim and the python code of the streams run in several processes instead
+of sharing the GIL of a single one.
+
+The streams are dispatched with affinity: all the windows of a stream go to the same worker, which
+runs them in order and keeps the state of the stream (stitching, vocoder context, cached encoder
+features) between them. A new stream goes to the worker with the fewest streams.
+
+Each worker is a multiprocess Pool of a single process, started with the spawn method: a worker
+(and the process that replaces it if it dies) is a fresh interpreter, which imports the main module
+again without running its `if __name__ == "__main__"` block, rather than a fork of the main process
+inheriting its threads and state. The state of a worker is built in the worker process by the
+factory given to WorkerPool, and calls are dispatched to its methods by name. Large arguments, such
+as the frames of a window, are better passed through shared memory (see streaming.FrameRef).
+
+The pool replaces a worker that dies, but drops the call it was running: WorkerPool watches the pid
+of each worker, fails that call with WorkerLost, and runs the broadcasts made with replay=True (such
+as the model swaps of control messages) again on the replacement before its next calls. The streams
+of the worker continue on the replacement with their state reset.
+"""
+from multiprocess import get_context
+from multiprocess.pool import Pool
+from concurrent.futures import Future, wait
+from collections import deque
+import os
+import signal
+import threading
+
+# State of the worker process, built by _init
+_worker = None
+
+
+def _init(factory, args):
+    global _worker
+    # Interrupts are handled by the main process, which drains the workers before closing them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker = factory(*args)
+
+def _call(method, args):
+    return getattr(_worker, method)(*args)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class WorkerLost(RuntimeError):
+    """
+    Raised by the future of a call whose worker died while running it.
+    """
+
+
+class WorkerPool:
+    """
+    Worker processes the calls of each stream are dispatched to, see the module docstring.
+    """
+
+    def __init__(self, num_workers, factory, *args, check_interval=1.):
+        """
+        Args:
+            num_workers: number of worker processes
+            factory: callable, returns the state of a worker from args (called in the worker
+            process, the calls of submit and broadcast run its methods)
+            check_interval: seconds between the checks that the workers are alive
+        """
+        context = get_context("spawn")
+        self._pools = [Pool(1, initializer=_init, initargs=(factory, args), context=context)
+                       for _ in range(num_workers)]
+        # Worker of each stream, and number of streams of each worker
+        self._streams = {}
+        self._num_streams = [0] * num_workers
+        self._lock = threading.Lock()
+        # Futures of the calls queued on each worker, oldest first, the pid of each worker, and the
+        # broadcasts to run again on the workers that replace dead ones
+        self._pending = [deque() for _ in range(num_workers)]
+        self._pids = [None] * num_workers
+        self._lost = [False] * num_workers
+        self._replayed = []
+        self._calls_lock = threading.Lock()
+        for worker in range(num_workers):
+            self._watch(worker)
+        self.check_interval = check_interval
+        self._closed = threading.Event()
+        self._monitor = threading.Thread(target=self._check_workers, name="worker-monitor", daemon=True)
+        self._monitor.start()
+
+    def __len__(self):
+        return len(self._pools)
+
+    def _done(self, worker, future, result=None, error=None):
+        with self._calls_lock:
+            try:
+                self._pending[worker].remove(future)
+            except ValueError:
+                # Already failed, its worker died
+                return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _run(self, worker, func, args):
+        future = Future()
+        with self._calls_lock:
+            self._pending[worker].append(future)
+        try:
+            self._pools[worker].apply_async(func, args,
+                                            callback=lambda result: self._done(worker, future, result),
+                                            error_callback=lambda error: self._done(worker, future, error=error))
+        except ValueError as error:
+            # The pool is closed
+            self._done(worker, future, error=error)
+        return future
+
+    def _apply(self, worker, method, args):
+        return self._run(worker, _call, (method, args))
+
+    def _watch(self, worker):
+        # Runs after the initializer, queued before the next calls of the worker
+        def started(future):
+            if future.exception() is None:
+                self._pids[worker] = future.result()
+        self._run(worker, os.getpid, ()).add_done_callback(started)
+
+    def _check_workers(self):
+        while not self._closed.wait(self.check_interval):
+            for worker, pid in enumerate(self._pids):
+                # The pool reaps its dead workers, the pid no longer exists
+                if pid is None or _alive(pid):
+                    continue
+                with self._calls_lock:
+                    self._pids[worker] = None
+                    self._lost[worker] = True
+                    # The calls of a worker run in order, the oldest pending one was running
+                    lost = self._pending[worker].popleft() if self._pending[worker] else None
+                    replayed = list(self._replayed)
+                if lost is not None:
+                    lost.set_exception(WorkerLost("worker process %d died" % pid))
+                for method, args in replayed:
+                    self._apply(worker, method, args)
+                self._watch(worker)
+
+    def submit(self, stream_id, method, *args):
+        """
+        Runs method(*args) on the worker of stream_id (assigned on its first call), returns a
+        concurrent.futures.Future of the result. The calls of a stream run in the order they are
+        submitted. The arguments are pickled later on a thread of the pool, they must not change
+        in the meantime.
+        """
+        with self._lock:
+            worker = self._streams.get(stream_id)
+            if worker is None:
+                worker = min(range(len(self._pools)), key=self._num_streams.__getitem__)
+                self._streams[stream_id] = worker
+                self._num_streams[worker] += 1
+            return self._apply(worker, method, args)
+
+    def broadcast(self, method, *args, replay=False):
+        """
+        Runs method(*args) on every worker, returns the futures of their results. With replay, it
+        also runs on the workers that later replace dead ones, in the order of the broadcasts.
+        """
+        if replay:
+            with self._calls_lock:
+                self._replayed.append((method, args))
+        return [self._apply(worker, method, args) for worker in range(len(self._pools))]
+
+    def release(self, stream_id, method=None, *args):
+        """
+        Ends the affinity of stream_id, after running method(*args) on its worker if given (to drop
+        the state of the stream). Its next call goes to the worker with the fewest streams.
+        """
+        with self._lock:
+            worker = self._streams.pop(stream_id, None)
+            if worker is None:
+                return None
+            self._num_streams[worker] -= 1
+            # Queued before any call of a new stream with the same id
+            return self._apply(worker, method, args) if method is not None else None
+
+    def close(self):
+        """
+        Waits for the calls queued on the workers, then stops them.
+        """
+        for pool in self._pools:
+            pool.close()
+        # Still watching the workers, a call lost by a dead one would never finish
+        while True:
+            with self._calls_lock:
+                pending = [future for futures in self._pending for future in futures]
+            if not pending:
+                break
+            wait(pending)
+        self._closed.set()
+        self._monitor.join()
+        for pool, lost in zip(self._pools, self._lost):
+            # The pool of a dead worker keeps waiting for the result of its lost call
+            if lost:
+                pool.terminate()
+            pool.join()